@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# armybuilder/batchvalidation.py
+#===============================================================================
+#   Validate many army list files without the GUI, e.g. all lists sent in
+#   for a tournament. The files are spread across a pool of worker processes
+#   which load the catalog once each (or inherit it from the parent process).
+#===============================================================================
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from catalog import Catalog
+from kowsim.kow.fileio import ArmyListReader
+from kowsim.kow.validation import ArmyListValidator, ValidationMessage, RuleTimings, DefaultRegistry, RS_STANDARD
+
+ARMYLIST_EXTENSIONS = (".txt", ".lst")
+
+MESSAGE_TYPE_NAMES = { ValidationMessage.VM_CRITICAL: "critical", ValidationMessage.VM_WARNING: "warning",
+                       ValidationMessage.VM_INFO: "info" }
+
+
+def ListArmyListFiles(paths, extensions=ARMYLIST_EXTENSIONS):
+   """ Return the given files plus the army list files found in the given directories (not recursive), sorted by name. """
+   filenames = []
+   for path in paths:
+      if os.path.isdir(path):
+         filenames.extend([os.path.join(path, fn) for fn in sorted(os.listdir(path))
+                           if os.path.splitext(fn)[1].lower() in extensions and not fn.startswith(".")])
+      else: filenames.append(path)
+   return filenames
+
+def ValidateFile(catalog, filename, rules):
+   """ Load and validate one army list file. Returns a dict with the list's points, the messages of the
+   validation *rules*, the warnings of the reader, and the time taken in total and by each rule. Files which
+   can't be read get an 'error' entry instead of messages. """
+   start = time.time()
+   result = { "file": filename, "name": None, "pointsLimit": None, "pointsTotal": None, "valid": False,
+              "error": None, "warnings": [], "messages": [], "ruleSeconds": {} }
+   try:
+      armylist, warnings = ArmyListReader(catalog).LoadFromFile(filename)
+      timings = RuleTimings()
+      msgs = ArmyListValidator(armylist, rules, timings=timings).Check()
+      result["ruleSeconds"] = dict([(name, timings.TotalTime(name)) for name in timings.ListRuleNames()])
+   except Exception as e: # invalid files come in all forms: bad numbers, missing lines, wrong encoding
+      result["error"] = "%s: %s" % (type(e).__name__, e)
+   else:
+      result.update({ "name": armylist.CustomName(), "pointsLimit": armylist.PointsLimit(), "pointsTotal": armylist.PointsTotal(),
+                      "valid": not any([m.IsCritical() for m in msgs]), "warnings": warnings,
+                      "messages": [{ "type": MESSAGE_TYPE_NAMES[m.MsgType()], "short": m.ShortDesc(), "long": m.LongDesc() }
+                                   for m in msgs] })
+   result["seconds"] = time.time() - start
+   return result
+
+
+#===============================================================================
+# Worker processes
+#===============================================================================
+_catalog = None # of the current process, inherited by forked workers
+
+def _InitWorker(basedir):
+   global _catalog
+   if _catalog is None or _catalog.BaseDir() != basedir: # not inherited, e.g. on Windows
+      _catalog = LoadCatalog(basedir)
+
+def _ValidateInWorker(args):
+   filename, ruleSet, disabled = args
+   return ValidateFile(_catalog, filename, DefaultRegistry().Rules(ruleSet, disabled))
+
+def LoadCatalog(basedir):
+   """ Load the force lists, items and validation rule plugins of *basedir*. """
+   catalog = Catalog(basedir)
+   catalog.LoadForceChoices()
+   catalog.LoadItems()
+   catalog.LoadValidationRules()
+   return catalog
+
+
+#===============================================================================
+# BatchReport
+#===============================================================================
+class BatchReport(object):
+   def __init__(self, results, elapsed, ruleSet=RS_STANDARD, disabled=()):
+      self.results = results # dicts as returned by ValidateFile, in order of the files
+      self.elapsed = elapsed
+      self.ruleSet = ruleSet
+      self.disabled = disabled
+
+   def NumErrors(self): return sum([1 for r in self.results if r["error"] is not None])
+   def NumInvalid(self): return sum([1 for r in self.results if not r["valid"] and r["error"] is None])
+   def NumValid(self): return sum([1 for r in self.results if r["valid"]])
+
+   def Totals(self):
+      return { "files": len(self.results), "valid": self.NumValid(), "invalid": self.NumInvalid(),
+               "errors": self.NumErrors(), "seconds": self.elapsed, "ruleSet": self.ruleSet, "disabledRules": sorted(self.disabled) }
+
+   def RuleTimings(self):
+      """ RuleTimings with the time each rule took per file. """
+      timings = RuleTimings(len(self.results) or 1)
+      for r in self.results:
+         for name, seconds in r["ruleSeconds"].iteritems(): timings.Record(name, seconds)
+      return timings
+
+   def WriteJson(self, f):
+      json.dump({ "totals": self.Totals(), "results": self.results }, f, indent=2, sort_keys=True)
+      f.write("\n")
+
+   def WriteCsv(self, f):
+      """ One row per message, or a single row without message for files without any. """
+      def Enc(s): return s.encode("utf-8") if isinstance(s, unicode) else s
+
+      writer = csv.writer(f)
+      writer.writerow(["File", "Army list", "Points", "Points limit", "Valid", "Type", "Message", "Seconds"])
+      for r in self.results:
+         head = [Enc(r["file"]), Enc(r["name"] or ""), r["pointsTotal"], r["pointsLimit"], int(r["valid"])]
+         rows = [(m["type"], m["short"]) for m in r["messages"]] + [("load warning", w) for w in r["warnings"]]
+         if r["error"] is not None: rows.append(("error", r["error"]))
+         for msgType, text in rows or [("", "")]:
+            writer.writerow(head + [msgType, Enc(text), "%.4f" % r["seconds"]])
+
+
+def ValidateArmyLists(catalog, filenames, ruleSet=RS_STANDARD, disabled=(), processes=None):
+   """ Validate the army list files *filenames* with the rule set *ruleSet* of the default registry except the
+   rules named in *disabled* and return a BatchReport. The files are spread across a pool of *processes* worker
+   processes (None: one per CPU, 1: no pool). Workers load the catalog from its base directory unless they
+   inherit it. """
+   global _catalog
+   start = time.time()
+   if processes == 1 or len(filenames) <= 1:
+      rules = DefaultRegistry().Rules(ruleSet, disabled)
+      results = [ValidateFile(catalog, fn, rules) for fn in filenames]
+   else:
+      _catalog = catalog
+      pool = multiprocessing.Pool(processes, _InitWorker, (catalog.BaseDir(), ))
+      chunksize = max(len(filenames) // (8 * (processes or multiprocessing.cpu_count())), 1)
+      try: results = pool.map(_ValidateInWorker, [(fn, ruleSet, tuple(disabled)) for fn in filenames], chunksize)
+      finally:
+         pool.close()
+         pool.join()
+   return BatchReport(results, time.time() - start, ruleSet, disabled)
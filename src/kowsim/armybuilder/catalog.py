@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# armybuilder/catalog.py
+#===============================================================================
+import os
+import sys
+
+from parsers import ForceListCsvParser as Flcp
+from parsers import ItemCsvParser as Icp
+from kowsim.kow.unitindex import UnitIndex
+from kowsim.kow.validation import DefaultRegistry
+
+#===============================================================================
+# Catalog
+#   All force choices and magic items found in a base directory. Does not
+#   depend on Qt, so it can be used by command line tools (matchups.py,
+#   membench.py, optimize.py, validate.py). The army builder uses it through
+#   DataManager (load_data.py), which adds the Qt settings such as the base
+#   directory and the recent files.
+#===============================================================================
+class Catalog(object):
+   def __init__(self, basedir=None):
+      self._basedir = basedir
+      self._forceChoices = []
+      self._forceChoicesByName = {}
+      self._items = []
+      self._itemsByName = {}
+      self._unitIndex = None
+
+   def BaseDir(self): return self._basedir
+
+   def LoadForceChoices(self):
+      self._forceChoices = []
+      self._forceChoicesByName = {}
+
+      pars = Flcp()
+
+      for fn in os.listdir(os.path.join(self.BaseDir(), "data", "kow", "forces")):
+         if fn.startswith(".") or fn.endswith("#") or not fn.endswith(".csv"): # skip temporary lock files and unknown files
+            continue
+
+         try:
+            pars.ReadLinesFromFile(os.path.join(self.BaseDir(), "data", "kow", "forces", fn))
+            force = pars.Parse()
+
+            self._forceChoices.append(force)
+            self._forceChoicesByName[force.Name()] = force
+
+         except Exception as e:
+            sys.stderr.write("Error while parsing %s: %s\n" % (fn, e))
+      self._unitIndex = None
+
+   def LoadItems(self):
+      pars = Icp()
+      pars.ReadLinesFromFile(os.path.join(self.BaseDir(), "data", "kow", "items", "items.csv"))
+
+      self._items = pars.Parse()
+      self._itemsByName = { i.Name():i for i in self._items }
+
+   def LoadValidationRules(self, registry=None):
+      """ Load the validation rule plugins in data/kow/rules into *registry* (the default registry if None). """
+      if registry is None: registry = DefaultRegistry()
+      return registry.LoadPlugins(os.path.join(self.BaseDir(), "data", "kow", "rules"))
+
+   def ForceChoicesByName(self, name): return self._forceChoicesByName[name]
+   def ItemByName(self, name): return self._itemsByName[name]
+   def ListForceChoices(self): return self._forceChoices
+   def ListItems(self): return self._items
+   def UnitIndex(self):
+      """ Columnar index of the unit profiles of all forces for catalog-wide queries, built on first use. """
+      if self._unitIndex is None: self._unitIndex = UnitIndex(self._forceChoices)
+      return self._unitIndex
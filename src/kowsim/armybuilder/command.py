@@ -216,7 +216,7 @@ class ChangeUnitSizeCmd(Command, ReversibleCommandMixin):
    def Execute(self):
       sizeType = kowsim.kow.sizetype.Find(self._newSize).Name()
       unitname = self._unit.Profile().Name()
-      newProfile = self._unit.Detachment().Choices().GroupByName(unitname).ProfileForSize(sizeType)
+      newProfile = self._unit.Detachment().Choices().ProfileFor(unitname, sizeType)
       self._unit.SetProfile(newProfile)
       self._alModel.Touch()
             
@@ -261,9 +261,9 @@ class SetPrimaryDetachmentCmd(Command, ReversibleCommandMixin):
    def Execute(self):
       for det in self.alModel.data.ListDetachments():
          if det is self.detachment:
-            det._isPrimary = self.makePrimary
+            det.SetPrimary(self.makePrimary)
          else:
-            det._isPrimary = False
+            det.SetPrimary(False)
       self.alModel.Touch()
       
       
@@ -363,6 +363,21 @@ class DuplicateUnitCmd(Command, ReversibleCommandMixin):
 #===============================================================================
 # SaveArmyListCmd
 #===============================================================================
+def SavedStateKey(armylist):
+   """ Key for the content of an army list file: the list's content hash plus all custom names, which the
+   content hash ignores but which are saved as well. """
+   names = [armylist.CustomName()]
+   for det in armylist.ListDetachments():
+      names.append(det.CustomName())
+      names.extend([u.CustomName() for u in det.ListUnits()])
+   return (armylist.ContentHash(), tuple(names))
+
+def FileModificationTime(filename):
+   """ Modification time of *filename*, None if it doesn't exist (anymore). """
+   try: return os.path.getmtime(filename)
+   except OSError: return None
+
+
 class SaveArmyListCmd(Command):
    def __init__(self, alModel, alView, saveAs=False):
       Command.__init__(self, name="SaveArmyListCmd")
@@ -387,6 +402,13 @@ class SaveArmyListCmd(Command):
       else:
          filename = self.alView._lastFilename
       
+      key = SavedStateKey(self.alModel.data)
+      # no real change since the last save (e.g. an option chosen and cleared again) and the file is still as saved
+      if self.alView._lastSavedKey == (filename, key, FileModificationTime(filename)):
+         self.alModel.modified = False
+         self.hints = (ToggleModifiedHint(), )
+         return
+      
       try:
          alw = ArmyListWriter(self.alModel.data)
          alw.SaveToFile(filename)
@@ -394,6 +416,7 @@ class SaveArmyListCmd(Command):
          QtGui.QMessageBox.critical(self.alView, "Error while saving", "An error occurred while saving the army list:\n  %s" % e)
       else:
          self.alModel.modified = False
+         self.alView._lastSavedKey = (filename, key, FileModificationTime(filename))
          self.hints = (ToggleModifiedHint(), )
       
 
@@ -435,6 +458,7 @@ class LoadArmyListCmd(Command):
          
       view = self._mdiArea.AddArmySubWindow(ArmyListModel(armylist))
       view.SetLastFilename(filename)
+      if warnings == []: view._lastSavedKey = (filename, SavedStateKey(armylist), FileModificationTime(filename))
       QtGui.qApp.DataManager.AddRecentFile(filename)
       view.siRecentFilesChanged.emit()
       print view.ctrl._views
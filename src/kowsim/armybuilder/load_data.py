@@ -2,62 +2,25 @@
 
 # armybuilder/load_data.py
 #===============================================================================
-import os
-import sys
 from collections import deque
 
 from PySide.QtCore import QSettings
 
 import globals
-from parsers import ForceListCsvParser as Flcp
-from parsers import ItemCsvParser as Icp
+from catalog import Catalog
 
 #===============================================================================
 # DataManager
+#   Catalog of the army builder, located in the configured base directory.
 #===============================================================================
-class DataManager(object):
+class DataManager(Catalog):
    DefaultNumRecentFiles = 5
    
-   def __init__(self):
-      self._forceChoices = []
-      self._forceChoicesByName = {}
+   def BaseDir(self): return globals.BASEDIR
       
-   def LoadForceChoices(self):
-      self._forceChoices = []
-      self._forceChoicesByName = {}
-      
-      pars = Flcp()
-      
-      for fn in os.listdir(os.path.join(globals.BASEDIR, "data", "kow", "forces")):
-         if fn.startswith(".") or fn.endswith("#") or not fn.endswith(".csv"): # skip temporary lock files and unknown files
-            continue
-         
-         try:
-            pars.ReadLinesFromFile(os.path.join(globals.BASEDIR, "data", "kow", "forces", fn))
-            force = pars.Parse()
-            #print "Parsed %s (%d units)." % (force.Name(), force.NumUnits())
-         
-            self._forceChoices.append(force)
-            self._forceChoicesByName[force.Name()] = force
-         
-         except Exception as e:
-            sys.stderr.write("Error while parsing %s: %s\n" % (fn, e))
-         
    def LoadItems(self):
-      self._items = []
-      self._itemsByName = {}
-      
-      pars = Icp()
-      pars.ReadLinesFromFile(os.path.join(globals.BASEDIR, "data", "kow", "items", "items.csv"))
-      
-      self._items = pars.Parse()
-      self._itemsByName = { i.Name():i for i in self._items }
+      Catalog.LoadItems(self)
       print "Parsed %d magical items." % len(self._items)
-
-   def ForceChoicesByName(self, name): return self._forceChoicesByName[name]
-   def ItemByName(self, name): return self._itemsByName[name]
-   def ListForceChoices(self): return self._forceChoices
-   def ListItems(self): return self._items
    
    def AddRecentFile(self, filename):
       settings = QSettings("NoCompany", "KowArmyBuilder")
@@ -31,6 +31,7 @@ class MainWindow(QtGui.QMainWindow):
       QtGui.qApp.DataManager = DataManager()
       QtGui.qApp.DataManager.LoadForceChoices()
       QtGui.qApp.DataManager.LoadItems()
+      QtGui.qApp.DataManager.LoadValidationRules()
       
       #=========================================================================
       # Init main window
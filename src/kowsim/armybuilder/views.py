@@ -30,6 +30,7 @@ class ArmyListView(View):
       self._attachedPreview = None
       self._lastIndex = 0
       self._lastFilename = None
+      self._lastSavedKey = None # (filename, SavedStateKey, modification time of the file) of the last save
       self.setWindowTitle((self.ctrl.model.Data().CustomName() + "*"))
       self._initChildren()
       self._initLayout()
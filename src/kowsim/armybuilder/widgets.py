@@ -9,7 +9,11 @@ from PySide.QtCore import Qt
 
 from command import AddSpecificUnitCmd, ChangeUnitCmd, ChangeUnitSizeCmd, ChangeUnitItemCmd, SetUnitOptionsCmd
 from kowsim.kow.unittype import ALL_UNITTYPES
-from kowsim.kow.validation import ArmyListValidator, ValidationMessage, ALL_VALIDATIONRULES, COK_ADDITIONALRULES
+from kowsim.kow.force import Detachment
+from kowsim.kow.validation import ArmyListValidator, ValidationMessage, DefaultRegistry
+import kowsim.kow.validation as val
+from kowsim.util.cache import LruCache
+from mvc import hints as ALH
 from kowsim.mvc.mvcbase import View
 import kowsim.kow.stats as st
 import globals 
@@ -244,7 +248,8 @@ class ValidationWidget(View):
    def __init__(self, armyCtrl, parent=None):
       super(ValidationWidget, self).__init__(armyCtrl, parent)
       
-      self._validator = ArmyListValidator(armyCtrl.model.data, ALL_VALIDATIONRULES) # FIXME: Direct data access really necessary?
+      self._validator = ArmyListValidator(armyCtrl.model.data, DefaultRegistry().Rules(), LruCache(64)) # FIXME: Direct data access really necessary?
+      self._shownMessages = None # messages in the list widget
       self.setMinimumWidth(300)
       self.setMinimumHeight(120)
       
@@ -263,25 +268,45 @@ class ValidationWidget(View):
       ICN_ERROR16 = QtGui.QIcon(os.path.join(globals.BASEDIR, "data", "icons", "no16.png"))
       ICN_INFO16 = QtGui.QIcon(os.path.join(globals.BASEDIR, "data", "icons", "info16.png"))
       icnForMsgType = {ValidationMessage.VM_INFO : ICN_INFO16, ValidationMessage.VM_CRITICAL : ICN_ERROR16, ValidationMessage.VM_WARNING : QtGui.QIcon() }
-      lwi = QtGui.QListWidgetItem(icnForMsgType[message._msgType], message._shortDesc)
-      lwi.setToolTip(message._longDesc)
+      lwi = QtGui.QListWidgetItem(icnForMsgType[message.MsgType()], message.ShortDesc())
+      lwi.setToolTip(message.LongDesc())
       return lwi
+   
+   def _Invalidate(self, hints):
+      """ Forget the validator's messages which might be outdated after the changes described by *hints*. """
+      if not hints:
+         self._validator.Invalidate(val.DEP_ALL)
+         return
+      
+      for hint in hints:
+         if hint.IsType(ALH.ModifyUnitHint):
+            self._validator.Invalidate(val.DEP_POINTS | val.DEP_UNITS | val.DEP_ITEMS | val.DEP_NAMES, [hint.which.Detachment()])
+         elif hint.TypeIn((ALH.ModifyDetachmentHint, ALH.AddDetachmentHint)): # also sent when a detachment is removed
+            self._validator.Invalidate(val.DEP_ALL, [hint.which])
+         elif hint.IsType(ALH.ChangePrimaryDetachmentHint):
+            self._validator.Invalidate(val.DEP_PRIMARY)
+         elif hint.IsType(ALH.ChangeNameHint):
+            if isinstance(hint.which, Detachment): self._validator.Invalidate(val.DEP_NAMES, [hint.which])
+         elif not hint.IsType(ALH.ToggleModifiedHint):
+            self._validator.Invalidate(val.DEP_ALL)
       
    def UpdateContent(self, hints=None):
       # check if the rules have changed
-      if self.ctrl.model.settings["UseCokValidation"]:
-         self._validator._rules = ALL_VALIDATIONRULES + COK_ADDITIONALRULES
-      else:
-         self._validator._rules = ALL_VALIDATIONRULES
+      ruleSet = val.RS_COK if self.ctrl.model.settings["UseCokValidation"] else val.RS_STANDARD
+      self._validator.SetRules(DefaultRegistry().Rules(ruleSet))
+      self._Invalidate(hints)
          
       messages = self._validator.Check()
+      if messages == self._shownMessages: return # e.g. after undo or toggling an option back and forth
+      self._shownMessages = messages
+      
       self._messageLw.clear()
       valid = True
       warnings = False
       for msg in messages:
          self._messageLw.addItem(ValidationWidget.ListWidgetItemForMessage(msg))
-         if msg._msgType == ValidationMessage.VM_CRITICAL: valid = False
-         if msg._msgType == ValidationMessage.VM_WARNING: warnings = True
+         if msg.MsgType() == ValidationMessage.VM_CRITICAL: valid = False
+         if msg.MsgType() == ValidationMessage.VM_WARNING: warnings = True
       
       if not valid:
          self._messageLw.addItem("Errors occured - army list is invalid.")
@@ -5,7 +5,6 @@
 # TODO:
 #
 #  * Remove units when they die
-#  * 1-click nerve check?
 #  * automated movement to exact position after charge? 
 #  * exact moves by console (e.g. '/m b 1' could move the current unit back 1 inch)
 #  * set damage quantity when adding a damage marker 
@@ -18,6 +17,8 @@ from PySide.QtCore import Qt
 from constants import *
 from mousemodes import *
 from util.core import dot2d, len2d, dist2d
+from rng import DefaultStream
+from kow.nerve import NerveTableFor, ParseNerveString, NerveOutcomeNames, NERVE_WAVER
 
 import math, os
 
@@ -649,6 +650,8 @@ class RectBaseUnit(QtGui.QGraphicsRectItem):
       self.labelText = labelText
       
       self.owner = None # player who controls this unit
+      self.nerve = None # (waver, rout), waver is 0 if the unit doesn't waver. Asked for on the first nerve check if None
+      self.inspired = False # reroll rout results of nerve checks
       
       self.setZValue(Z_UNIT)
       
@@ -1039,6 +1042,22 @@ class RectBaseUnit(QtGui.QGraphicsRectItem):
          #self.SpawnRotator()
          self.scene().siStatusMessage.emit("Rotating %s. Left click to set rotation." % self.name)
       
+   def NerveCheck(self):
+      """ Roll a nerve test against the unit's damage markers and log its outcome. A Wavering marker is added if the unit wavers. """
+      if self.nerve is None and not self.SetNerve(): return
+      
+      damage = self.markers["Damage"].count if "Damage" in self.markers else 0
+      table = NerveTableFor(*self.nerve)
+      stream = self.owner.rng if self.owner is not None and self.owner.rng is not None else DefaultStream()
+      outcome, rolls = table.Test(damage, stream, inspiring=self.inspired)
+      
+      rollStr = ", rerolled ".join(["%d+%d" % r for r in rolls])
+      pSteady, pWaver, pRout = table.Probabilities(damage, self.inspired)
+      self.scene().siLogEvent.emit("%s takes a nerve check with %i damage: rolled %s - %s! (steady %.0f%%, wavering %.0f%%, routed %.0f%%)" % 
+                                   (self.name, damage, rollStr, NerveOutcomeNames[outcome], 100.*pSteady, 100.*pWaver, 100.*pRout))
+      
+      if outcome == NERVE_WAVER: self.AddMarker("Wavering")
+      
    def RemoveMarker(self, name):
       if name in self.markers:
          self.scene().removeItem(self.markers[name])
@@ -1051,6 +1070,21 @@ class RectBaseUnit(QtGui.QGraphicsRectItem):
       
       self.movementTemplate.setRotation(angle)
       
+   def SetInspired(self, inspired):
+      self.inspired = inspired
+      
+   def SetNerve(self):
+      """ Ask for the unit's nerve value. Returns False if the dialog was cancelled. """
+      current = "%s/%d" % (str(self.nerve[0]) if self.nerve[0] > 0 else "-", self.nerve[1]) if self.nerve is not None else "-/15"
+      while True:
+         text, accepted = QtGui.QInputDialog.getText(self.window(), self.name, "Nerve (waver/rout, e.g. 14/16 or -/15):", text=current)
+         if not accepted: return False
+         try:
+            self.nerve = ParseNerveString(text)
+            return True
+         except ValueError as e:
+            QtGui.QMessageBox.warning(self.window(), self.name, str(e))
+      
    def SetOwner(self, owner):
       self.owner = owner
       self.setBrush(owner.color)
@@ -1253,6 +1287,16 @@ class UnitContextMenu(QtGui.QMenu):
       carc = self.checkMenu.addAction("Arc/Facing")
       carc.triggered.connect(self.parentUnit.InitDetermineArc)
       
+      # Nerve
+      nrv = self.addAction("Nerve check")
+      nrv.triggered.connect(self.parentUnit.NerveCheck)
+      self.nerveMenu = self.addMenu("Nerve...")
+      snrv = self.nerveMenu.addAction("Set nerve")
+      snrv.triggered.connect(self.parentUnit.SetNerve)
+      insp = self.nerveMenu.addAction("Inspired")
+      insp.setCheckable(True)
+      insp.toggled.connect(self.parentUnit.SetInspired)
+      
       # Add marker menu
       self.signalMapper = QtCore.QSignalMapper(self)
       self.addMarkerMenu = self.addMenu("Add marker...")
@@ -1380,4 +1424,4 @@ class TextLabel(QtGui.QGraphicsTextItem):
 #    def mousePressEvent(self, e):
 #       if self.parent() is not None:
 #          self.parent().mousePressEvent(e)
-#       else: super(TextLabel, self).mousePressEvent(e)
\ No newline at end of file
+#       else: super(TextLabel, self).mousePressEvent(e)
\ No newline at end of file
@@ -1,11 +1,140 @@
-import random
+from array import array
+from collections import namedtuple
+import threading
 
+from odds import DistributionForChain
+from rng import DefaultStream
+from rollevents import DefaultBus, RollEvent
+from util.cache import LruCache
+
+try:
+   import numpy
+except ImportError: # numpy is optional, the pure Python backend below is used without it
+   numpy = None
+
+
+#===============================================================================
+# Batch helpers
+#   Dice results are kept as compact arrays of faces (numpy arrays if numpy is
+#   available, array.array otherwise) instead of lists of Python ints.
+#===============================================================================
+def CountAtLeast(faces, threshold):
+   """ Return the number of faces in *faces* which are greater than or equal to *threshold*. """
+   if numpy is not None:
+      return int(numpy.count_nonzero(numpy.asarray(faces) >= threshold))
+   n = 0
+   for f in faces:
+      if f >= threshold: n += 1
+   return n
+
+def CountAtLeastPerTrial(faces, numDicePerTrial, threshold):
+   """ Count successes separately for consecutive chunks of *faces*, the i-th chunk having
+   numDicePerTrial[i] dice. Returns a list of success counts, one per trial. """
+   if numpy is not None:
+      counts = numpy.asarray(numDicePerTrial, dtype=numpy.int64)
+      passed = (numpy.asarray(faces) >= threshold).astype(numpy.int64)
+      bounds = numpy.concatenate(([0], numpy.cumsum(counts)))
+      cum = numpy.concatenate(([0], numpy.cumsum(passed)))
+      return (cum[bounds[1:]] - cum[bounds[:-1]]).tolist()
+   res = []
+   i = 0
+   for n in numDicePerTrial:
+      passed = 0
+      for f in faces[i:i+n]:
+         if f >= threshold: passed += 1
+      res.append(passed)
+      i += n
+   return res
+
+def FacesToList(faces):
+   """ Convert a faces array (as returned by StandardDie.RollMany) to a list of ints. """
+   if numpy is not None and isinstance(faces, numpy.ndarray):
+      return faces.tolist()
+   return list(faces)
+
+
+#===============================================================================
+# FaceHistogram
+#   Result of rolling a pool of dice where only the number of dice per face
+#   matters. counts[face] holds the number of dice showing that face, so the
+#   size does not depend on the number of dice rolled.
+#===============================================================================
+class FaceHistogram(object):
+   MaxExpandedDice = 30 # up to this many dice, ToString lists every single face
+   
+   def __init__(self, sides=6):
+      self.sides = sides
+      self.counts = array('L', [0] * (sides+1)) # counts[0] is unused
+      
+   def __eq__(self, other):
+      return isinstance(other, FaceHistogram) and self.counts == other.counts
+   def __ne__(self, other):
+      return not self.__eq__(other)
+   def __repr__(self):
+      return "FaceHistogram(D%d: %s)" % (self.sides, self.ToString())
+   
+   def AddFaces(self, faces):
+      """ Add an array or list of faces to the histogram. """
+      counts = self.counts
+      if numpy is not None:
+         for face, n in enumerate(numpy.bincount(numpy.asarray(faces, dtype=numpy.intp), minlength=self.sides+1).tolist()):
+            counts[face] += n
+      else:
+         for f in faces:
+            counts[f] += 1
+   
+   def Count(self, face): return self.counts[face]
+   def CountAtLeast(self, threshold): return sum(self.counts[max(threshold, 1):])
+   def CountBelow(self, threshold): return sum(self.counts[1:max(threshold, 1)])
+   
+   def Faces(self):
+      """ Return all faces as a sorted list (one entry per die). """
+      faces = []
+      for face in range(1, self.sides+1):
+         faces.extend([face] * self.counts[face])
+      return faces
+   
+   def ToString(self):
+      if self.Total() <= FaceHistogram.MaxExpandedDice:
+         return ",".join([str(f) for f in self.Faces()])
+      return ", ".join(["%dx%d" % (self.counts[face], face) for face in range(1, self.sides+1) if self.counts[face] > 0])
+   
+   def Total(self): return sum(self.counts)
+   
+   @staticmethod
+   def FromFaces(sides, faces):
+      hist = FaceHistogram(sides)
+      hist.AddFaces(faces)
+      return hist
+
+
+#===============================================================================
+# StandardDie
+#===============================================================================
 class StandardDie:
    def __init__(self, sides=6):
       self.sides = sides
       
-   def Roll(self):
-      return random.randint(1, self.sides)
+   def Roll(self, stream=None):
+      """ Roll a single die using *stream* (rng.RandomStream, the default stream if None). """
+      if stream is None: stream = DefaultStream()
+      return stream.Die(self.sides)
+   
+   def RollMany(self, numDice, stream=None):
+      """ Roll *numDice* dice at once using *stream* and return the faces as a compact array. """
+      if stream is None: stream = DefaultStream()
+      return stream.Dice(self.sides, numDice)
+   
+   def RollHistogram(self, numDice, stream=None, chunkSize=65536):
+      """ Roll *numDice* dice using *stream* and return a FaceHistogram. The dice are drawn in chunks
+      of at most *chunkSize*, so memory use does not grow with the number of dice. """
+      if stream is None: stream = DefaultStream()
+      hist = FaceHistogram(self.sides)
+      while numDice > 0:
+         n = min(numDice, chunkSize)
+         hist.AddFaces(stream.Dice(self.sides, n))
+         numDice -= n
+      return hist
 
 D3 = StandardDie(3)
 D4 = StandardDie(4)
@@ -16,54 +145,188 @@ D12 = StandardDie(12)
 D20 = StandardDie(20)
 D100 = StandardDie(100)
 
+
+#===============================================================================
+# IndividualRoll
+#   A single stage of a roll command, e.g. '4+' or '5+r' (rerollable).
+#===============================================================================
 class IndividualRoll:
-   def __init__(self, die=D6, toPass=[4,5,6], reroll=False):
+   def __init__(self, die=D6, toPass=4, reroll=False, stream=None):
+      """ *toPass* is either the score needed to pass (e.g. 4 for '4+') or the list of passing faces. """
       self.die = die
-      self.toPass = toPass
+      self.stream = stream
+      if isinstance(toPass, int):
+         self.threshold = toPass # dice pass if they roll this score or more
+      else:
+         self.threshold = min(toPass) if len(toPass)>0 else die.sides+1
       self.reroll = reroll
       
       self.results = []
+      self.positions = [] # stream positions of the first roll and of a potential reroll
       self.numPassed = 0
       
+   @property
+   def toPass(self): return range(self.threshold, self.die.sides+1)
+      
    def __str__(self):
-      s = "%i+" % self.toPass[0]
+      s = "%i+" % self.threshold
       if self.reroll: s+= " rerollable"
       return s
       
    def Execute(self, numDice):
-      self.results.append([]) # self.results[0] holds the actual roll results (as a list), while self.results[1] holds results of a potential reroll.
+      stream = self.stream if self.stream is not None else DefaultStream()
       
-      for i in range(numDice):
-         r = self.die.Roll()
-         self.results[0].append(r)
-         if r in self.toPass: self.numPassed += 1
-         
-      print "Rolling %i dice on a %i+:" % (numDice, self.toPass[0]), ",".join([str(r) for r in self.results[0]])
-      print "%i successes." % self.numPassed
+      # self.results[0] holds the histogram of the actual roll, while self.results[1] holds the histogram of a potential reroll.
+      self.positions = [stream.Position()]
+      hist = self.die.RollHistogram(numDice, stream)
+      self.results = [hist]
+      self.numPassed = hist.CountAtLeast(self.threshold)
          
       if self.reroll:
-         numReroll = numDice - self.numPassed
-         originalSuccesses = self.numPassed
-         for j in range(numReroll):
-            r = self.die.Roll()
-            self.results[1].append(r)
-            if r in self.toPass: self.numPassed += 1
-
-         print "Rerolling %i dice:" % (numReroll), ",".join([str(r) for r in self.results[1]])
-         print "%i extra successes for %i total." % (self.numPassed - originalSuccesses, self.numPassed)
+         numReroll = hist.CountBelow(self.threshold)
+         self.positions.append(stream.Position())
+         rerolled = self.die.RollHistogram(numReroll, stream)
+         self.results.append(rerolled)
+         self.numPassed += rerolled.CountAtLeast(self.threshold)
       
       return self.numPassed, self.results
+   
+   def ExecuteTrials(self, numDicePerTrial):
+      """ Execute this roll for many independent trials at once. All dice of all trials are drawn
+      in a single batch. Returns a list with the number of successes for each trial. """
+      faces = self.die.RollMany(sum(numDicePerTrial), self.stream)
+      passed = CountAtLeastPerTrial(faces, numDicePerTrial, self.threshold)
+      
+      if self.reroll:
+         failed = [n - p for n, p in zip(numDicePerTrial, passed)]
+         rerolled = self.die.RollMany(sum(failed), self.stream)
+         extra = CountAtLeastPerTrial(rerolled, failed, self.threshold)
+         passed = [p + e for p, e in zip(passed, extra)]
+      
+      return passed
 
 
+#===============================================================================
+# RollPlan
+#   Immutable, compiled form of a roll command such as '20 4+ 4+r'. Plans are
+#   cached by their normalized command string, so commands which are rolled
+#   over and over again (macros, scripts) are only parsed once.
+#===============================================================================
+RollStage = namedtuple("RollStage", "threshold reroll")
+RollPlan = namedtuple("RollPlan", "commandString numDice sides stages") # sides is None for the default die
+
+_planCache = LruCache(256)
+_planCacheLock = threading.Lock() # the roll service compiles in the threads of its connections
+MaxSides = 1000 # histograms, events and statistics hold one count per face
+_diceBySides = dict([(die.sides, die) for die in (D3, D4, D6, D8, D10, D12, D20, D100)])
+_otherDice = LruCache(64) # sides => StandardDie, for the sizes typed in by users
+
+def _DieForSides(sides):
+   try: return _diceBySides[sides]
+   except KeyError:
+      die = _otherDice.Get(sides)
+      if die is None:
+         die = StandardDie(sides)
+         _otherDice.Put(sides, die)
+      return die
+
+def NormalizeRollString(s):
+   """ Normalize a roll command: lower case, single blanks between arguments. """
+   return " ".join(s.lower().split())
+
+def CompileRoll(s):
+   """ Return the RollPlan for the roll command *s*, parsing it only if it is not cached yet.
+   Raises ValueError for invalid commands. """
+   s = NormalizeRollString(s)
+   with _planCacheLock: plan = _planCache.Get(s)
+   if plan is None:
+      plan = _ParseRollString(s)
+      with _planCacheLock: _planCache.Put(s, plan)
+   return plan
+
+def _ParseRollString(s):
+   if len(s) == 0: # empty string, just roll a single die
+      return RollPlan(s, 1, None, ())
+   
+   # first, split string into arguments separated by blanks
+   subStrings = s.split()
+   
+   # the first substring is the number and type of dice to be rolled.
+   # if no type is given, use the default die.
+   if subStrings[0].isdigit():
+      numDice = int(subStrings[0])
+      sides = None
+   else: # probably '5d6' or something
+      i = subStrings[0].find('d') # look for the first 'd'
+      
+      if i == -1: # it's neither an integer nor does it include a 'd' - something is wrong here
+         raise ValueError("Invalid parameters for roll '%s'." % s)
+         
+      else:
+         # make sure that there's a number in front of the 'd'
+         if not subStrings[0][:i].isdigit():
+            raise ValueError("Invalid number of dice '%s' in roll '%s'." % (subStrings[0][:i], s))
+         else:
+            numDice = int(subStrings[0][:i])
+            
+         # then, determine the type of the dice
+         diceStr = subStrings[0][i+1:]
+         if diceStr.isdigit():
+            sides = int(diceStr)
+            if sides < 1: raise ValueError("Invalid number of sides '%s' in roll '%s'." % (diceStr, s))
+            if sides > MaxSides: raise ValueError("Dice with more than %d sides are not supported in roll '%s'." % (MaxSides, s))
+         else: # TODO: May add custom dice. But as of now, yield an error
+            raise ValueError("Unknown dice type '%s' in roll '%s'." % (diceStr, s))
+            
+   # now, if there are more arguments in the string, continue to parse them
+   stages = []
+   for subString in subStrings[1:]:
+      # initialization
+      toRoll = ""
+      idx = 0
+      reroll = False
+      
+      # should begin with a number which is the required roll
+      while idx < len(subString) and subString[idx].isdigit():
+         toRoll += subString[idx]
+         idx += 1
+      
+      if toRoll == "":
+         raise ValueError("Missing score to roll in '%s' of roll '%s'." % (subString, s))
+      toRoll = int(toRoll)
+      if idx < len(subString)-1:
+         # interpret the rest of the string.
+         # options until now: '+' (needs this score or more [default]), 'r' (reroll entire roll)
+         for c in subString[idx:]:
+            if c == '+':
+               pass
+            elif c == 'r':
+               reroll = True
+            else: raise ValueError("Unknown argument '%s' in roll '%s'." % (c, s))
+            
+      stages.append(RollStage(toRoll, reroll))
+      
+   return RollPlan(s, numDice, sides, tuple(stages))
+
+
+#===============================================================================
+# RollHandler
+#===============================================================================
 class RollHandler:
-   def __init__(self, s=""):
+   def __init__(self, s="", stream=None, source=None, eventBus=None):
       self.defaultDie = D6
       self.individualRolls = []
       self.numDice = 0
+      self.stream = stream # rng.RandomStream to roll with, the default stream if None
+      self.streamPosition = None # position of the stream when the last roll started
+      self.source = source # who is rolling, e.g. a player name. Passed on with the roll events
+      self.eventBus = eventBus # rollevents.RollEventBus to publish rolls to, the default bus if None
       
       self.finishedInit = False
       
-      if s!="":
+      if isinstance(s, RollPlan):
+         self.ApplyPlan(s)
+      elif s!="":
          self.InterpretString(s)
          
    def AllResultsToString(self, delimiter="\n"):
@@ -71,7 +334,10 @@ class RollHandler:
       
       partialStrings = []
       for res in self.allResults:
-         extraS = ",".join([str(r) for r in res[1]])
+         if len(self.individualRolls)>0: # res[1] holds the histograms of the first roll and of a potential reroll
+            extraS = " / ".join([hist.ToString() for hist in res[1]])
+         else:
+            extraS = res[1].ToString()
          if len(self.individualRolls)>0:
             extraS += " (%i successes)" % res[0]
          
@@ -81,6 +347,31 @@ class RollHandler:
             
       return s
          
+   def Odds(self):
+      """ Return the exact distribution (odds.RollDistribution) of final successes for the
+      current command without rolling any dice. """
+      if not self.finishedInit: raise ValueError("Can't compute odds yet - no command given!")
+      if len(self.individualRolls) == 0:
+         raise ValueError("No score to roll given, can't compute odds for successes.")
+      
+      stages = [(roll.die.sides, roll.threshold, roll.reroll) for roll in self.individualRolls]
+      return DistributionForChain(self.numDice, stages)
+   
+   def OddsToString(self, minChance=0.01):
+      """ Summarize the odds of the current command: expected successes and the chance to
+      roll at least k successes for each k which is neither (almost) impossible nor (almost) certain. """
+      dist = self.Odds()
+      s = "Expecting %.2f successes." % dist.Expected()
+      
+      tailStrs = []
+      for k in range(1, dist.MaxSuccesses()+1):
+         p = dist.AtLeast(k)
+         if minChance <= p <= 1.-minChance:
+            tailStrs.append("%d+: %.1f%%" % (k, 100.*p))
+      if len(tailStrs) > 0:
+         s += " " + ", ".join(tailStrs)
+      return s
+      
    def RollModeToString(self):
       s = "Rolling: "
       s += "%i dice" % self.numDice if self.numDice is not 1 else "1 die"
@@ -94,94 +385,62 @@ class RollHandler:
       return s
       
    def InterpretString(self, s):
-      self.commandString = s
-      
-      if len(s) == 0: # empty string, just roll a single die
-         self.numDice = 1
-         self.die = self.defaultDie
-         self.finishedInit = True
-         return
-      
-      # don't be case sensitive
-      s = s.lower()
-      
-      # first, split string into arguments separated by blanks
-      subStrings = s.split()
-      
-      # the first substring is the number and type of dice to be rolled.
-      # if no type is given, use the default die.
-      if subStrings[0].isdigit():
-         self.numDice = int(subStrings[0])
-         self.die = self.defaultDie
-      else: # probably '5d6' or something
-         i = subStrings[0].find('d') # look for the first 'd'
-         
-         if i == -1: # it's neither an integer nor does it include a 'd' - something is wrong here
-            raise ValueError("Invalid parameters for roll '%s'." % s)
-            
-         else:
-            # make sure that there's a number in front of the 'd'
-            if not subStrings[0][:i].isdigit():
-               raise ValueError("Invalid number of dice '%s' in roll '%s'." % (subStrings[0][:i], s))
-            else:
-               self.numDice = int(subStrings[0][:i])
-               
-            # then, determine the type of the dice
-            diceStr = subStrings[0][i+1:]
-            if diceStr.isdigit():
-               self.die = StandardDie(int(diceStr))
-            else: # TODO: May add custom dice. But as of now, yield an error
-               raise ValueError("Unknown dice type '%s' in roll '%s'." % (diceStr, s))
-               
-      # now, if there are more arguments in the string, continue to parse them
-      for subString in subStrings[1:]:
-         # initialization
-         toRoll = ""
-         idx = 0
-         reroll = False
-         
-         # should begin with a number which is the required roll
-         while subString[idx].isdigit() and idx < len(subString):
-            toRoll += subString[idx]
-            idx += 1
-            
-         toRoll = int(toRoll)
-         if idx < len(subString)-1:
-            # interpret the rest of the string.
-            # options until now: '+' (needs this score or more [default]), 'r' (reroll entire roll)
-            for c in subString[idx:]:
-               if c == '+':
-                  pass
-               elif c == 'r':
-                  reroll = True
-               else: raise ValueError("Unknown argument '%s' in roll '%s'." % (c, s))
-               
-         # finished parsing individual roll, assemble object for it
-         passedResults = range(toRoll, self.die.sides+1)
-         rpms = IndividualRoll(self.die, passedResults, reroll)
-         self.individualRolls.append(rpms)
-         
-      # done
+      """ Set up this handler for the roll command *s*. Parsing is skipped if the (normalized)
+      command was compiled before, see CompileRoll. """
+      self.ApplyPlan(CompileRoll(s))
+      
+   def ApplyPlan(self, plan):
+      """ Set up this handler for a compiled RollPlan. """
+      self.plan = plan
+      self.commandString = plan.commandString
+      self.numDice = plan.numDice
+      self.die = self.defaultDie if plan.sides is None else _DieForSides(plan.sides)
+      self.individualRolls = [IndividualRoll(self.die, stage.threshold, stage.reroll, self.stream) for stage in plan.stages]
       self.finishedInit = True
          
    def Roll(self):
       if not self.finishedInit: raise ValueError("Can't roll yet - no command given!")
       
       self.allResults = []
+      self.streamPosition = (self.stream if self.stream is not None else DefaultStream()).Position()
+      bus = self.eventBus if self.eventBus is not None else DefaultBus()
       diceLeft = self.numDice
       
       if len(self.individualRolls) > 0:
-         for idvRoll in self.individualRolls:
+         for i, idvRoll in enumerate(self.individualRolls):
             passed, results = idvRoll.Execute(numDice=diceLeft)
+            if bus.active:
+               bus.Publish(RollEvent(self.commandString, self.source, i, diceLeft, idvRoll.threshold, idvRoll.reroll,
+                                     results, idvRoll.positions, passed))
             if passed==0: break
             diceLeft = passed
             
             self.allResults.append([passed, results])
             
       else: # just roll some dice and be done
-         self.allResults.append([0, [self.die.Roll() for i in xrange(self.numDice)]])
+         hist = self.die.RollHistogram(self.numDice, self.stream)
+         self.allResults.append([0, hist])
+         if bus.active:
+            bus.Publish(RollEvent(self.commandString, self.source, None, self.numDice, None, False,
+                                  [hist], [self.streamPosition], 0))
             
       return self.allResults
+   
+   def RollTrials(self, numTrials):
+      """ Roll the whole command *numTrials* times (e.g. for what-if checks) and return a list
+      with the number of final successes per trial. Each stage draws the dice for all trials at once.
+      Without any individual rolls, the number of dice is returned for each trial. """
+      if not self.finishedInit: raise ValueError("Can't roll yet - no command given!")
+      
+      diceLeft = [self.numDice] * numTrials
+      for idvRoll in self.individualRolls:
+         diceLeft = idvRoll.ExecuteTrials(diceLeft)
+      return diceLeft
          
    def SetDefaultDie(self, die):
-      self.defaultDie = die
\ No newline at end of file
+      self.defaultDie = die
+      
+   def SetStream(self, stream):
+      self.stream = stream
+      for idvRoll in self.individualRolls:
+         idvRoll.stream = stream
\ No newline at end of file
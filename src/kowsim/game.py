@@ -2,11 +2,16 @@ from PySide import QtGui, QtCore
 from PySide.QtCore import Qt
 
 from player import Player
+from rng import RandomStream
+from rollevents import DefaultBus, RollStatistics
 
 class GameManager:
-   def __init__(self):
-      self._players = [Player("Player 1"), Player("Player 2", QtGui.QColor(11,121,5))]
+   def __init__(self, seed=None):
+      self.rng = RandomStream(seed) # master stream of the game, each player rolls with a substream of it
+      self._players = [Player("Player 1", rng=self.rng.Spawn("player1")), Player("Player 2", QtGui.QColor(11,121,5), self.rng.Spawn("player2"))]
       self._curPlayer = self._players[0]
+      self.rollStatistics = RollStatistics() # luck and face frequencies of all players' rolls
+      DefaultBus().Subscribe(self.rollStatistics)
    
    def GetCurrentPlayer(self):
       return self._curPlayer
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# kow/combat.py
+#===============================================================================
+#   Headless Monte Carlo resolver for a single melee or shooting attack of one
+#   unit against another: hit roll, damage roll and the defender's nerve test.
+#===============================================================================
+import multiprocessing
+
+from kowsim.dice import D6, CountAtLeastPerTrial, FacesToList
+from kowsim.odds import BinomialPmf
+from kowsim.rng import RandomStream
+from kowsim.kow.nerve import NerveTableFor, NERVE_WAVER, NERVE_ROUT
+
+
+def _ClampRoll(score):
+   """ A roll of 1 always fails, a 6 always succeeds. """
+   return min(max(score, 2), 6)
+
+def _PassChance(threshold, rerollOnes):
+   p = (7 - threshold) / 6.
+   return p + p / 6. if rerollOnes else p
+
+
+#===============================================================================
+# CombatSetup
+#   All numbers needed to resolve an attack, extracted from an attacking and
+#   a defending unit (UnitInstance, or UnitProfile for unmodified stats). Only
+#   needs the stats and RuleSet() of both.
+#===============================================================================
+class CombatSetup(object):
+   def __init__(self, attacker, defender, ranged=False, charging=False, defenderDamage=0, nerveModifier=0):
+      atkRules = attacker.RuleSet()
+
+      self.attacks = attacker.At()
+      if ranged:
+         self.toHit = attacker.Ra()
+         bonus = atkRules.Value("Piercing")
+      else:
+         self.toHit = attacker.Me()
+         bonus = atkRules.Value("Crushing Strength")
+         if charging: bonus += atkRules.Value("Thunderous Charge")
+
+      if self.toHit <= 0: # stat '-', unit can't attack this way
+         self.attacks = 0
+         self.toHit = 6
+      self.toHit = _ClampRoll(self.toHit)
+      self.toDamage = _ClampRoll(defender.De() - bonus)
+      self.rerollHitOnes = atkRules.HasRule("Elite")
+      self.rerollDamageOnes = atkRules.HasRule("Vicious")
+
+      self.nerveWaver, self.nerveBreak = defender.Ne()
+      self.defenderDamage = defenderDamage
+      self.nerveModifier = nerveModifier
+
+   def __repr__(self):
+      return "CombatSetup(%d attacks, hit on %d+, damage on %d+, Ne %d/%d)" % (self.attacks, self.toHit, self.toDamage, self.nerveWaver, self.nerveBreak)
+
+
+#===============================================================================
+# CombatResult
+#   Outcome of many simulated attacks. For exact results (AnalyzeCombat), the
+#   histogram and the waver/rout counts hold probabilities summing up to 1.
+#===============================================================================
+class CombatResult(object):
+   def __init__(self, damageHistogram=None, numWaver=0, numRout=0, numHits=0):
+      self.damageHistogram = damageHistogram if damageHistogram is not None else [] # damageHistogram[d] = number of trials with d damage
+      self.numWaver = numWaver
+      self.numRout = numRout
+      self.numHits = numHits # total over all trials
+
+   def __repr__(self):
+      trials = "exact" if isinstance(self.numRout, float) else "%d trials" % self.NumTrials()
+      return "CombatResult(%s, E(damage)=%.2f, waver %.1f%%, rout %.1f%%)" % (trials, self.ExpectedDamage(),
+                                                                           100.*self.WaverProbability(), 100.*self.RoutProbability())
+
+   def Merge(self, other):
+      if len(other.damageHistogram) > len(self.damageHistogram):
+         self.damageHistogram.extend([0] * (len(other.damageHistogram) - len(self.damageHistogram)))
+      for d, n in enumerate(other.damageHistogram):
+         self.damageHistogram[d] += n
+      self.numWaver += other.numWaver
+      self.numRout += other.numRout
+      self.numHits += other.numHits
+
+   def DamageProbabilities(self):
+      n = float(self.NumTrials())
+      return [c / n for c in self.damageHistogram]
+   def ExpectedDamage(self):
+      return sum(d*c for d, c in enumerate(self.damageHistogram)) / float(self.NumTrials())
+   def ExpectedHits(self): return self.numHits / float(self.NumTrials())
+   def NumTrials(self): return sum(self.damageHistogram)
+   def RoutProbability(self): return self.numRout / float(self.NumTrials())
+   def WaverProbability(self): return self.numWaver / float(self.NumTrials())
+
+
+#===============================================================================
+# Exact resolution
+#===============================================================================
+def AnalyzeSetup(setup):
+   """ Return the exact CombatResult for a CombatSetup. Hit and damage rolls chain into a single
+   binomial distribution of damage, which is combined with the nerve test table. """
+   pHit = _PassChance(setup.toHit, setup.rerollHitOnes)
+   damagePmf = BinomialPmf(setup.attacks, pHit * _PassChance(setup.toDamage, setup.rerollDamageOnes))
+   table = NerveTableFor(setup.nerveWaver, setup.nerveBreak)
+   offset = setup.defenderDamage + setup.nerveModifier
+   
+   res = CombatResult(damagePmf, 0., 0., setup.attacks * pHit)
+   for dmg, p in enumerate(damagePmf):
+      pSteady, pWaver, pRout = table.Probabilities(dmg + offset)
+      res.numWaver += p * pWaver
+      res.numRout += p * pRout
+   return res
+
+def AnalyzeCombat(attacker, defender, ranged=False, charging=False, defenderDamage=0, nerveModifier=0):
+   """ Like SimulateCombat, but compute the exact damage distribution and nerve test odds. """
+   return AnalyzeSetup(CombatSetup(attacker, defender, ranged, charging, defenderDamage, nerveModifier))
+
+
+#===============================================================================
+# Simulation
+#===============================================================================
+def _RollStage(stream, numDicePerTrial, threshold, rerollOnes):
+   """ Roll a hit or damage stage for many trials at once and return the successes per trial. """
+   faces = D6.RollMany(sum(numDicePerTrial), stream)
+   passed = CountAtLeastPerTrial(faces, numDicePerTrial, threshold)
+   if rerollOnes:
+      ones = [n - p for n, p in zip(numDicePerTrial, CountAtLeastPerTrial(faces, numDicePerTrial, 2))]
+      rerolled = D6.RollMany(sum(ones), stream)
+      passed = [p + e for p, e in zip(passed, CountAtLeastPerTrial(rerolled, ones, threshold))]
+   return passed
+
+BLOCK_SIZE = 1000 # trials rolled with one substream; chunks consist of whole blocks, so results don't depend on the chunk size
+
+def _SimulateBlock(setup, numTrials, stream):
+   """ Simulate *numTrials* attacks for a CombatSetup with the random stream of the block. """
+   hits = _RollStage(stream, [setup.attacks] * numTrials, setup.toHit, setup.rerollHitOnes)
+   damage = _RollStage(stream, hits, setup.toDamage, setup.rerollDamageOnes)
+   nerve1 = FacesToList(D6.RollMany(numTrials, stream))
+   nerve2 = FacesToList(D6.RollMany(numTrials, stream))
+
+   res = CombatResult([0] * (setup.attacks+1), numHits=sum(hits))
+   table = NerveTableFor(setup.nerveWaver, setup.nerveBreak)
+   offset = setup.defenderDamage + setup.nerveModifier
+   for dmg, n1, n2 in zip(damage, nerve1, nerve2):
+      res.damageHistogram[dmg] += 1
+      outcome = table.Outcome(n1 + n2, dmg + offset)
+      if outcome == NERVE_ROUT: res.numRout += 1
+      elif outcome == NERVE_WAVER: res.numWaver += 1
+   return res
+
+def _SimulateChunk(args):
+   """ Simulate the blocks, (number of trials, random stream) tuples, of a chunk. Runs in a worker process. """
+   setup, blocks = args
+   res = CombatResult([0] * (setup.attacks+1))
+   for numTrials, stream in blocks:
+      res.Merge(_SimulateBlock(setup, numTrials, stream))
+   return res
+
+def SimulateCombat(attacker, defender, trials=100000, ranged=False, charging=False, defenderDamage=0, nerveModifier=0,
+                   processes=None, chunkSize=20000, seed=None, stream=None):
+   """ Resolve an attack of *attacker* against *defender* (UnitInstance or UnitProfile objects) *trials*
+   times and return a CombatResult with the damage histogram as well as waver and rout probabilities.
+
+   The trials are split into blocks of BLOCK_SIZE trials, each rolled with its own substream of *stream*
+   (rng.RandomStream, a new stream seeded with *seed* if None), so results are reproducible for a given
+   seed. Chunks of about *chunkSize* trials (whole blocks) are spread across a pool of *processes* worker
+   processes (None: one per CPU, 1: no pool); neither changes the result.
+   """
+   setup = CombatSetup(attacker, defender, ranged, charging, defenderDamage, nerveModifier)
+   if stream is None: stream = RandomStream(seed)
+
+   blocks = []
+   done = 0
+   while done < trials:
+      n = min(BLOCK_SIZE, trials - done)
+      blocks.append((n, stream.Spawn(len(blocks))))
+      done += n
+   blocksPerChunk = max(chunkSize // BLOCK_SIZE, 1)
+   chunks = [(setup, blocks[i:i+blocksPerChunk]) for i in range(0, len(blocks), blocksPerChunk)]
+
+   if processes == 1 or len(chunks) == 1:
+      partialResults = map(_SimulateChunk, chunks)
+   else:
+      pool = multiprocessing.Pool(processes)
+      try: partialResults = pool.map(_SimulateChunk, chunks)
+      finally:
+         pool.close()
+         pool.join()
+
+   result = CombatResult([0] * (setup.attacks+1))
+   for res in partialResults:
+      result.Merge(res)
+   return result
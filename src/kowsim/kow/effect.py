@@ -3,6 +3,7 @@
 # kow/effect.py
 #===============================================================================
 from modifiers import MOD_ADD, MOD_SET
+from specialrule import DefaultRegistry
 import stats
 
 
@@ -16,6 +17,8 @@ import stats
 #   GrantSpecialRuleEffect or ModifyStatEffect
 #===============================================================================
 class UnitEffect(object):
+   __slots__ = ()
+   
    def __init__(self):
       pass
    
@@ -80,15 +83,24 @@ class UnitEffect(object):
       #=========================================================================
       elif s.startswith("Grant"):
          # syntax: Grant(name_of_special_rule)
+         #     or: Grant(name_of_special_rule, Cumulative), e.g. Grant(CS (1),Cumulative) to increase an existing CS
          if not ("(" in s and ")" in s):
             print "Invalid effect %s! Skipping." % (s)
             return None
          
          argsStart = s.index("(")+1
          argsEnd = s.rindex(")")
-         argsStr = s[argsStart:argsEnd].strip()
+         args = _SplitArguments(s[argsStart:argsEnd])
+         if len(args)==2 and args[1]=="Cumulative":
+            rule = DefaultRegistry().Parse(args[0])[0]
+            if rule is None or not rule.IsCumulative(): # granted values of cumulative rules add up when resolving
+               print "Invalid effect %s, %s is not cumulative! Skipping." % (s, args[0])
+               return None
+         elif len(args)!=1 or len(args[0])==0:
+            print "Invalid effect %s! Skipping." % (s)
+            return None
          
-         effect = GrantSpecialRuleEffect(argsStr) # TODO: Implement proper special rule objects instead of just strings
+         effect = GrantSpecialRuleEffect(args[0]) # TODO: Implement proper special rule objects instead of just strings
          return effect
       
       #=========================================================================
@@ -113,10 +125,46 @@ class UnitEffect(object):
          return None
 
 
+def _SplitArguments(s):
+   """ Split the arguments of an effect at the commas outside of parentheses, e.g. 'CS (1),Cumulative'. """
+   args = []
+   depth = 0
+   cur = ""
+   for c in s:
+      if c == "," and depth == 0:
+         args.append(cur.strip())
+         cur = ""
+         continue
+      if c == "(": depth += 1
+      elif c == ")": depth -= 1
+      cur += c
+   args.append(cur.strip())
+   return args
+
+
+#===============================================================================
+# Interning
+#   Effects are immutable, so all options and items share one instance per
+#   effect string (e.g. 'Set(Speed,9)' of every size of a unit).
+#===============================================================================
+_effectPool = {} # canonical effect string => effect (None for invalid effects)
+
+def InternEffect(s):
+   """ Return the shared effect for the effect string *s*, parsing it only once. Returns None for
+   invalid effects. """
+   s = s.strip()
+   try: return _effectPool[s]
+   except KeyError:
+      effect = _effectPool[s] = UnitEffect.ParseFromString(s)
+      return effect
+
+
 #===============================================================================
 # UnitEffect which grants a special rule when active.
 #===============================================================================
 class GrantSpecialRuleEffect(UnitEffect):
+   __slots__ = ("_specialRule", )
+   
    def __init__(self, specialRule=None):
       super(GrantSpecialRuleEffect, self).__init__()
       self._specialRule = specialRule
@@ -128,6 +176,8 @@ class GrantSpecialRuleEffect(UnitEffect):
 # UnitEffect which removes a normally active special rule.
 #===============================================================================
 class RemoveSpecialRuleEffect(UnitEffect):
+   __slots__ = ("_specialRule", )
+   
    def __init__(self, specialRule=None):
       super(RemoveSpecialRuleEffect, self).__init__()
       self._specialRule = specialRule
@@ -140,6 +190,8 @@ class RemoveSpecialRuleEffect(UnitEffect):
 # setting it or by adding to it.
 #===============================================================================
 class ModifyStatEffect(UnitEffect):
+   __slots__ = ("_stat", "_modifier", "_modifierType")
+   
    def __init__(self, stat, modifier=0, modifierType=MOD_SET):
       super(ModifyStatEffect, self).__init__()
       
@@ -153,3 +205,43 @@ class ModifyStatEffect(UnitEffect):
    def Modifier(self): return self._modifier
    def ModType(self): return self._modifierType
    def Stat(self): return self._stat
+
+
+#===============================================================================
+# EffectIndex
+#   Effects of an option or magic item, bucketed by kind when the option or
+#   item is created: Set and Add modifiers by stat, granted and removed
+#   special rules. Resolving a unit's profile then only folds these buckets.
+#===============================================================================
+class EffectIndex(object):
+   __slots__ = ("setModifiers", "addModifiers", "grantedRules", "removedRules", "grantedSet", "removedMask")
+
+   def __init__(self, effects=None):
+      self.setModifiers = {} # stat => value
+      self.addModifiers = {} # stat => sum of all Add modifiers
+      self.grantedRules = []
+      self.removedRules = []
+
+      for e in (effects if effects is not None else []):
+         if type(e) == ModifyStatEffect:
+            if e.ModType() == MOD_SET:
+               if e.Stat() in self.setModifiers:
+                  print "Warning: Multiple 'Set' modifiers for %s!" % e.Stat().Name()
+               self.setModifiers[e.Stat()] = e.Modifier()
+            elif e.ModType() == MOD_ADD:
+               self.addModifiers[e.Stat()] = self.addModifiers.get(e.Stat(), 0) + e.Modifier()
+         elif type(e) == GrantSpecialRuleEffect:
+            self.grantedRules.append(e.SpecialRule())
+         elif type(e) == RemoveSpecialRuleEffect:
+            self.removedRules.append(e.SpecialRule())
+      self.grantedRules = tuple(self.grantedRules)
+      self.removedRules = tuple(self.removedRules)
+      registry = DefaultRegistry()
+      self.grantedSet = registry.RuleSetFromStrings(self.grantedRules) # RuleSet of the granted rules
+      self.removedMask = 0 # bitset of the removed rules
+      for rule in self.removedRules:
+         rule = registry.Parse(rule)[0]
+         if rule is not None: self.removedMask |= 1 << rule.Bit()
+
+   def IsEmpty(self):
+      return not (self.setModifiers or self.addModifiers or self.grantedRules or self.removedRules)
@@ -92,14 +92,15 @@ class ArmyListReader(object):
                   except KeyError:
                      warnings.append("Item %s for unit %s not found. Unit will have no item." % (itemName, profileName))
                
-               optDict = { opt.Name():opt for opt in profile.ListOptions()}
+               optDict = {} # name => options, several if the profile lists an option twice
+               for opt in profile.ListOptions(): optDict.setdefault(opt.Name(), []).append(opt)
                chosenOptions = []
                for o in optionNames:
-                  try: opt = optDict[o]
-                  except KeyError:
+                  opts = [opt for opt in optDict.get(o, []) if opt not in chosenOptions]
+                  if not opts:
                      warnings.append("Option %s for unit %s unknown. Option omitted." % (o, profileName))
                      continue
-                  chosenOptions.append(opt)
+                  chosenOptions.append(opts[0])
                                  
                unit = UnitInstance(profile, det, unitCustomName, chosenOptions, item)
                det.AddUnit(unit)
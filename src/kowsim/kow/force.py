@@ -3,13 +3,24 @@
 # kow/force.py
 #===============================================================================
 import codecs
+import hashlib
 #from unit import UnitProfile
+from unit import ResolvedProfile
 from unittype import *
 
+CHECK_POINTS_TOTALS = False # debugging: compare the running points totals with a full recomputation on every access
+
+_HASH_MOD = 1 << 160 # content hashes of units and detachments are summed up as 160 bit integers
+
+def _Digest(*fields):
+   return hashlib.sha1("\x00".join([f.encode("utf-8") if isinstance(f, unicode) else f for f in fields])).hexdigest()
+
 #===============================================================================
 # ArmyList
 #   Specific army list for a KoW army, may contain several KowForces (one primary
 #   and up to multiple allied forces).
+#   The points total and content hash are kept up to date by the detachments,
+#   which report every change of their own total and hash.
 #===============================================================================
 class ArmyList(object):
    def __init__(self, name, points):
@@ -17,29 +28,62 @@ class ArmyList(object):
 
       self._detachments = []
       self._pointsLimit = points
+      self._pointsTotal = 0
+      self._detachmentsHash = 0 # sum of the detachments' content hashes
+      self._contentHash = None
    
    # getters/setters
+   def ContentHash(self):
+      """ SHA1 hex digest of the points limit and the content of all detachments, independent of their order
+      and of custom names. Equal for lists which field the same army. """
+      if self._contentHash is None:
+         self._contentHash = _Digest("ArmyList", "%d" % self._pointsLimit, "%x" % self._detachmentsHash)
+      return self._contentHash
    def CustomName(self): return self._customName
    def NumDetachments(self): return len(self._detachments)
    def ListDetachments(self): return self._detachments
    def PointsLimit(self): return self._pointsLimit
    def PointsTotal(self):
-      s = 0
-      for det in self._detachments: s += det.PointsTotal()
-      return s
+      if CHECK_POINTS_TOTALS: self.CheckPointsTotal()
+      return self._pointsTotal
    def SetCustomName(self, name): self._customName = name
-   def SetPointsLimit(self, pts): self._pointsLimit = pts
+   def SetPointsLimit(self, pts):
+      self._pointsLimit = pts
+      self._contentHash = None
    
    # routines
    def AddDetachment(self, detachment):
       self._detachments.append(detachment)
+      detachment.SetArmyList(self)
+      self.DetachmentChanged(detachment.PointsTotal(), None, detachment.ContentHash())
       
+   def CheckPointsTotal(self):
+      """ Compare the running points totals of the list and its detachments with a full recomputation.
+      Raises AssertionError if they differ. """
+      s = 0
+      for det in self._detachments: s += det.CheckPointsTotal()
+      if s != self._pointsTotal:
+         raise AssertionError("Points total of army list %s is %d, but should be %d." % (self._customName, self._pointsTotal, s))
+      return s
+   
    def RemoveDetachment(self, detachment):
       self._detachments.remove(detachment)
+      detachment.SetArmyList(None)
+      self.DetachmentChanged(-detachment.PointsTotal(), detachment.ContentHash(), None)
+   
+   def DetachmentChanged(self, pointsDelta, oldHash, newHash):
+      """ Called by a detachment whose points total or content hash changed. """
+      self._pointsTotal += pointsDelta
+      if oldHash is not None: self._detachmentsHash -= int(oldHash, 16)
+      if newHash is not None: self._detachmentsHash += int(newHash, 16)
+      self._detachmentsHash %= _HASH_MOD
+      self._contentHash = None
    
 
 #===============================================================================
 # KowUnitGroup
+#   All size options (e.g. Regiment, Horde) of one unit. Frozen by its
+#   KowForceChoices once all size options have been added.
 #===============================================================================
 class KowUnitGroup(object):
    def __init__(self, name, default):
@@ -57,68 +101,66 @@ class KowUnitGroup(object):
    def ProfileForSize(self, size): return self._optionsByName[size]
       
    def AddSizeOption(self, opt):
+      if isinstance(self._sizeOptions, tuple):
+         raise TypeError("Unit group %s is frozen." % self._name)
       if len(self._sizeOptions)==0:
          self._defaultOption = opt
       self._sizeOptions.append(opt)
       self._optionsByName[opt.SizeType().Name()] = opt
+      
+   def Freeze(self):
+      self._sizeOptions = tuple(self._sizeOptions)
 
 
 #===============================================================================
 # KowForceChoices
 #   e.g. Elves, Dwarves, a single KoW army force with all of its unit choices.
 #   This is static data, to generate a specific army list with some incorporated
-#   units, use Detachment instead
+#   units, use Detachment instead.
+#   All lookup indexes are built once when the force is created (i.e. when
+#   ForceListCsvParser parses the force list) and are read-only afterwards.
 #===============================================================================
 class KowForceChoices(object):
    def __init__(self, name, alignment, units=None):
       self._customName = name
       self._alignment = alignment
-      self._units = units if units is not None else []
-      self._groups = []
-      self._groupsByName = {}
-      self._groupsByType = {}
+      self._units = tuple(units) if units is not None else ()
+      self._BuildIndexes()
    
-   def Alignment(self): return self._alignment
-   def AlignmentName(self): return self._alignment.Name()
-   def GroupUnits(self):
+   def _BuildIndexes(self):
       """ Group units by their type (e.g. Sea Guard) which might have multiple size options
-         (e.g. Regiment, Horde). """
-      self._groups = []
+         (e.g. Regiment, Horde) and index the groups by name, display name and unit type. """
+      groups = []
       self._groupsByName = {}
-      
+      self._profilesByNameAndSize = {}
       for u in self._units:
-         if u.name not in self._groupsByName.keys():
-            grp = KowUnitGroup(u.name, u) # add group with default
-            self._groups.append(grp)
-            self._groupsByName[grp.Name()] = grp 
+         grp = self._groupsByName.get(u.Name())
+         if grp is None:
+            grp = self._groupsByName[u.Name()] = KowUnitGroup(u.Name(), u) # add group with default
+            groups.append(grp)
          else:
-            grp = self._groupsByName[u.name]
             grp.AddSizeOption(u)
-            
-   def GroupTypes(self):
-      if len(self._groups)==0:
-         self.GroupUnits()
+         self._profilesByNameAndSize[(u.Name(), u.SizeType().Name())] = u
       
+      for g in groups: g.Freeze()
+      self._groups = tuple(groups)
+      self._groupsByDisplayName = { g.DisplayName():g for g in groups }
       self._groupsByType = { ut:[] for ut in ALL_UNITTYPES }
-      for g in self._groups:
+      for g in groups:
          self._groupsByType[g.Default().UnitType()].append(g)
+      for ut in self._groupsByType: self._groupsByType[ut] = tuple(self._groupsByType[ut])
    
-   def GroupByName(self, name):
-      if len(self._groups)==0: self.GroupUnits()
-      return self._groupsByName[name]
-   def ListGroups(self):
-      if len(self._groups)==0: self.GroupUnits()
-      return self._groups
-   def ListTypes(self):
-      if len(self._groupsByType)==0: self.GroupTypes()
-      return self._groupsByType.keys()
-   
+   def Alignment(self): return self._alignment
+   def AlignmentName(self): return self._alignment.Name()
+   def GroupByDisplayName(self, dispname): return self._groupsByDisplayName[dispname]
+   def GroupByName(self, name): return self._groupsByName[name]
+   def ListGroups(self): return self._groups
+   def ListTypes(self): return self._groupsByType.keys()
    def ListUnits(self): return self._units   
-   def ListUnitsForType(self, utype):
-      if len(self._groupsByType)==0: self.GroupTypes()
-      return self._groupsByType[utype]
+   def ListUnitsForType(self, utype): return self._groupsByType[utype]
    def Name(self): return self._customName
    def NumUnits(self): return len(self._units)
+   def ProfileFor(self, name, size): return self._profilesByNameAndSize[(name, size)]
 
 
 #===============================================================================
@@ -126,6 +168,9 @@ class KowForceChoices(object):
 #   A specific single KoW detachment such as an Elf detachment in a ArmyList.
 #   May contain anything from 0 to 100 units chosen from the associated
 #   KowForceChoices representing the army (e.g. Elves).
+#   Keeps the points cost and content hash of each of its units, which report
+#   changes of their options, item or profile, to maintain its points total
+#   and content hash.
 #===============================================================================
 class Detachment(object):
    def __init__(self, choices, customName=None, units=None, isPrimary=False):
@@ -134,29 +179,81 @@ class Detachment(object):
          self._customName = "%s detachment" % choices.Name()
       else: self._customName = customName
       
-      self._units = units if units is not None else []
+      self._units = []
+      self._unitState = {} # unit => (points cost, content hash) included in the totals, units hash by identity
+      self._pointsTotal = 0
+      self._unitsHash = 0 # sum of the units' content hashes
+      self._contentHash = None
+      self._armyList = None
       self._isPrimary = isPrimary
+      if units is not None:
+         for u in units: self.AddUnit(u)
       
    def AddUnit(self, unit):
       self._units.append(unit)
+      self._IncludeUnit(unit)
       return len(self._units)-1 # return index of new unit
+   def ArmyList(self): return self._armyList
+   def CheckPointsTotal(self):
+      """ Compare the running points total with a full recomputation. Raises AssertionError if they differ. """
+      s = 0
+      for u in self._units: s += ResolvedProfile(u).pointsCost
+      if s != self._pointsTotal:
+         raise AssertionError("Points total of detachment %s is %d, but should be %d." % (self._customName, self._pointsTotal, s))
+      return s
    def Choices(self): return self._choices
+   def ContentHash(self):
+      """ SHA1 hex digest of force, primary flag and units, independent of the unit order and of custom names. """
+      if self._contentHash is None:
+         self._contentHash = _Digest("Detachment", self._choices.Name(), "%d" % self._isPrimary, "%x" % self._unitsHash)
+      return self._contentHash
    def CustomName(self): return self._customName
    def IsPrimary(self): return self._isPrimary
    def ListUnits(self): return self._units
    def NumUnits(self): return len(self._units)
    def PointsTotal(self):
-      s = 0
-      for u in self._units: s += u.PointsCost()
-      return s
+      if CHECK_POINTS_TOTALS: self.CheckPointsTotal()
+      return self._pointsTotal
    
    def RemoveUnit(self, unit):
       self._units.remove(unit)
+      self._ExcludeUnit(unit)
 
    def ReplaceUnit(self, index, newUnit):
       if index>=len(self._units): raise IndexError("Can't replace unit %d, only have %d units!" % (index, len(self._units)))
       else:
+         self._ExcludeUnit(self._units[index])
          self._units[index] = newUnit
+         self._IncludeUnit(newUnit)
          
+   def SetArmyList(self, armyList): self._armyList = armyList
    def SetCustomName(self, name): self._customName = name
+   def SetPrimary(self, isPrimary):
+      if isPrimary != self._isPrimary:
+         self._Update(0, 0, isPrimary)
    def Unit(self, index): return self._units[index]
+   
+   def UnitChanged(self, unit):
+      """ Called by a unit whose points cost or content may have changed. Ignored for units not (or no longer)
+      part of the detachment, e.g. a duplicate which is set up before it is added. """
+      old = self._unitState.get(unit)
+      if old is None: return
+      new = self._unitState[unit] = (unit.PointsCost(), int(unit.ContentHash(), 16))
+      self._Update(new[0] - old[0], new[1] - old[1])
+   
+   def _Update(self, pointsDelta, hashDelta, isPrimary=None):
+      oldHash = self.ContentHash()
+      self._pointsTotal += pointsDelta
+      self._unitsHash = (self._unitsHash + hashDelta) % _HASH_MOD
+      if isPrimary is not None: self._isPrimary = isPrimary
+      self._contentHash = None
+      if self._armyList is not None: self._armyList.DetachmentChanged(pointsDelta, oldHash, self.ContentHash())
+   
+   def _ExcludeUnit(self, unit):
+      points, h = self._unitState.pop(unit)
+      self._Update(-points, -h)
+   
+   def _IncludeUnit(self, unit):
+      unit.SetDetachment(self)
+      points, h = self._unitState[unit] = (unit.PointsCost(), int(unit.ContentHash(), 16))
+      self._Update(points, h)
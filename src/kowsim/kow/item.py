@@ -2,21 +2,26 @@
 
 # kow/items.py
 #===============================================================================
+from effect import InternEffect, EffectIndex
 
 
 #===============================================================================
 # Item
-#   Represents a magic item in Kow with a name (e.g. Brew of Strength) and
-#   an associated points cost (e.g. 30).
+#   Represents a magic item in Kow with a name (e.g. Brew of Strength), an
+#   associated points cost (e.g. 30) and the effects it has on its unit.
 #===============================================================================
 class Item(object):
+   __slots__ = ("_name", "_pointsCost", "_description", "_effects", "_effectIndex")
 
-   def __init__(self, name, points, description=""):
+   def __init__(self, name, points, description="", effects=None):
       self._name = name
       self._pointsCost = points
       self._description = description
+      self._effects = effects if effects is not None else []
+      self._effectIndex = EffectIndex(self._effects)
 
    def Description(self): return self._description   
+   def EffectIndex(self): return self._effectIndex
    def Name(self): return self._name
    def PointsCost(self): return self._pointsCost
    def StringWithPoints(self): return "%s (%dp)" % (self._name, self._pointsCost)
@@ -30,8 +35,30 @@ class Item(object):
       
       name = cols[0]
       description = cols[1]
-      effect = cols[2]
       points = int(cols[3])
       if name != name.strip():
          print "WARNING: Item name '%s' not stripped!" % name
-      return Item(name.strip(), points, description)
\ No newline at end of file
+      
+      effects = []
+      for e in Item.SplitEffectsString(cols[2]):
+         effect = InternEffect(e)
+         if effect is not None: effects.append(effect)
+      return Item(name.strip(), points, description, effects)
+   
+   @staticmethod
+   def SplitEffectsString(s):
+      """ Split an effects column such as 'Grant(Fly), Set(Speed,10)' into single effects. Effects are
+      separated by commas or '|' outside of parentheses. """
+      effects = []
+      depth = 0
+      cur = ""
+      for c in s:
+         if c in ",|" and depth == 0:
+            effects.append(cur)
+            cur = ""
+            continue
+         if c == "(": depth += 1
+         elif c == ")": depth -= 1
+         cur += c
+      effects.append(cur)
+      return [e.strip() for e in effects if len(e.strip()) > 0]
\ No newline at end of file
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# kow/matchup.py
+#===============================================================================
+#   Matchup matrix: expected damage, waver and rout odds of every unit
+#   profile attacking every other. Results are cached on disk by the content
+#   of both profiles, so after editing the force lists only the matchups of
+#   changed profiles are computed again.
+#===============================================================================
+import cPickle
+import csv
+import hashlib
+import multiprocessing
+import os
+
+from kowsim.kow.combat import AnalyzeCombat, SimulateCombat
+from kowsim.kow.specialrule import DefaultRegistry
+
+MODEL_VERSION = 1 # increase when the combat model changes, invalidates all cached results
+
+
+#===============================================================================
+# CombatProfile
+#   Picklable snapshot of the parts of a UnitProfile which matter in combat.
+#===============================================================================
+class CombatProfile(object):
+   def __init__(self, profile, label=None):
+      self.label = label if label is not None else "%s (%s)" % (profile.Name(), profile.SizeType().Name())
+      self._stats = (profile.At(), profile.Me(), profile.Ra(), profile.De(), profile.Ne())
+      self._specialRules = tuple(profile.ListSpecialRules())
+      self._hash = None
+
+   def __repr__(self):
+      return "CombatProfile(%s)" % self.label
+
+   def At(self): return self._stats[0]
+   def Me(self): return self._stats[1]
+   def Ra(self): return self._stats[2]
+   def De(self): return self._stats[3]
+   def Ne(self): return self._stats[4]
+   def ListSpecialRules(self): return self._specialRules
+   def RuleSet(self): return DefaultRegistry().RuleSetFromStrings(self._specialRules) # not pickled, bits differ between processes
+
+   def Hash(self):
+      """ SHA1 of the combat relevant content, independent of the profile's name. """
+      if self._hash is None:
+         content = repr((MODEL_VERSION, self._stats, sorted(self._specialRules)))
+         self._hash = hashlib.sha1(content).hexdigest()
+      return self._hash
+
+
+#===============================================================================
+# MatchupCache
+#   Results by (attacker hash, defender hash, scenario), pickled to a file.
+#   Entries of profiles which no longer exist are pruned, see Prune.
+#===============================================================================
+class MatchupCache(object):
+   def __init__(self, filename=None):
+      self._filename = filename
+      self._entries = {}
+      self._modified = False
+
+      if filename is not None and os.path.exists(filename):
+         try:
+            with open(filename, "rb") as f:
+               self._entries = cPickle.load(f)
+         except Exception: # unreadable or outdated cache, start from scratch
+            self._entries = {}
+
+   def __len__(self): return len(self._entries)
+
+   def Get(self, key): return self._entries.get(key)
+
+   def Prune(self, hashes):
+      """ Drop the results of all matchups with a profile whose hash is not in *hashes*, e.g. after the
+      profile was edited. """
+      stale = [key for key in self._entries if key[0] not in hashes or key[1] not in hashes]
+      for key in stale: del self._entries[key]
+      if len(stale) > 0: self._modified = True
+
+   def Put(self, key, value):
+      self._entries[key] = value
+      self._modified = True
+
+   def Save(self):
+      if self._filename is None or not self._modified: return
+      with open(self._filename, "wb") as f:
+         cPickle.dump(self._entries, f, cPickle.HIGHEST_PROTOCOL)
+      self._modified = False
+
+
+#===============================================================================
+# MatchupMatrix
+#===============================================================================
+class MatchupMatrix(object):
+   def __init__(self, profiles, rows):
+      self.profiles = profiles # CombatProfiles, both attackers (rows) and defenders (columns)
+      self._rows = rows # self._rows[attacker][defender] = (expected damage, waver odds, rout odds)
+
+   def Get(self, attacker, defender):
+      """ Return (expected damage, waver odds, rout odds) for the profiles with the given indices. """
+      return self._rows[attacker][defender]
+
+   def WriteCsv(self, f):
+      writer = csv.writer(f)
+      writer.writerow(["Attacker", "Defender", "Expected damage", "Waver", "Rout"])
+      for atk, row in zip(self.profiles, self._rows):
+         for dfd, (dmg, waver, rout) in zip(self.profiles, row):
+            writer.writerow([atk.label, dfd.label, "%.3f" % dmg, "%.4f" % waver, "%.4f" % rout])
+
+
+#===============================================================================
+# Computation
+#===============================================================================
+def _ComputeRow(args):
+   """ Compute the matchups of one attacker against a list of defenders. Runs in a worker process. """
+   attacker, defenders, ranged, charging, trials = args
+   row = []
+   for defender in defenders:
+      if trials:
+         seed = int(attacker.Hash()[:8] + defender.Hash()[:8], 16) # reproducible per matchup
+         res = SimulateCombat(attacker, defender, trials, ranged, charging, processes=1, seed=seed)
+      else:
+         res = AnalyzeCombat(attacker, defender, ranged, charging)
+      row.append((res.ExpectedDamage(), res.WaverProbability(), res.RoutProbability()))
+   return row
+
+def ProfilesFromForces(forceChoices):
+   """ Return CombatProfiles for all unit profiles of the given KowForceChoices. """
+   return [CombatProfile(u, "%s: %s (%s)" % (fc.Name(), u.Name(), u.SizeType().Name()))
+           for fc in forceChoices for u in fc.ListUnits()]
+
+def ComputeMatchups(profiles, ranged=False, charging=True, cache=None, processes=None, trials=None):
+   """ Compute the MatchupMatrix of all *profiles* (CombatProfiles) attacking each other.
+
+   Matchups are computed exactly, or by Monte Carlo with *trials* trials each if given. Matchups
+   found in *cache* (MatchupCache) are reused, the others are spread across a pool of *processes*
+   worker processes (None: one per CPU, 1: no pool), one task per attacker, and added to the cache.
+   Cached matchups of profiles other than *profiles* are dropped.
+   """
+   scenario = (ranged, charging, trials)
+   rows = [[None] * len(profiles) for p in profiles]
+
+   tasks = []
+   missing = []
+   for i, atk in enumerate(profiles):
+      missingCols = []
+      for j, dfd in enumerate(profiles):
+         res = cache.Get((atk.Hash(), dfd.Hash(), scenario)) if cache is not None else None
+         if res is None: missingCols.append(j)
+         else: rows[i][j] = res
+      if len(missingCols) > 0:
+         tasks.append((atk, [profiles[j] for j in missingCols], ranged, charging, trials))
+         missing.append((i, missingCols))
+
+   if processes == 1 or len(tasks) <= 1:
+      computed = map(_ComputeRow, tasks)
+   else:
+      pool = multiprocessing.Pool(processes)
+      try: computed = pool.map(_ComputeRow, tasks)
+      finally:
+         pool.close()
+         pool.join()
+
+   for (i, cols), row in zip(missing, computed):
+      for j, res in zip(cols, row):
+         rows[i][j] = res
+         if cache is not None: cache.Put((profiles[i].Hash(), profiles[j].Hash(), scenario), res)
+   if cache is not None:
+      cache.Prune(set([p.Hash() for p in profiles]))
+      cache.Save()
+
+   return MatchupMatrix(profiles, rows)
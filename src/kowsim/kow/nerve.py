@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# kow/nerve.py
+#===============================================================================
+#   Precomputed nerve tests: 2D6 plus damage plus modifiers against a unit's
+#   waver and rout values. A double 1 (insane courage) always passes.
+#===============================================================================
+
+NERVE_STEADY = 0
+NERVE_WAVER = 1
+NERVE_ROUT = 2
+
+NerveOutcomeNames = ("Steady", "Wavering", "Routed")
+
+_2D6_COUNTS = (0, 0, 1, 2, 3, 4, 5, 6, 5, 4, 3, 2, 1) # ways to roll each sum with 2D6, out of 36
+
+
+def ParseNerveString(s):
+   """ Parse a nerve value such as '14/16' or '-/15' into (waver, rout). Waver is 0 for units
+   which do not waver. Raises ValueError for invalid strings. """
+   parts = s.replace(" ", "").split("/")
+   if len(parts) != 2 or not parts[1].isdigit() or not (parts[0].isdigit() or parts[0] == "-"):
+      raise ValueError("Invalid nerve value '%s', expected e.g. '14/16' or '-/15'." % s)
+   waver = int(parts[0]) if parts[0] != "-" else 0
+   return (waver, int(parts[1]))
+
+
+#===============================================================================
+# NerveTable
+#   Outcome of every 2D6 result and steady/waver/rout probabilities for every
+#   offset (damage plus modifiers) of a single nerve value. Offsets below or
+#   above the range where the outcome can still change are clamped, so the
+#   tables stay small.
+#===============================================================================
+class NerveTable(object):
+   def __init__(self, waver, rout):
+      self.waver = waver # 0 if the unit doesn't waver
+      self.rout = rout
+      self._minOffset = (waver if waver > 0 else rout) - 13 # at or below: always steady
+      self._maxOffset = rout - 3 # at or above: always routs, unless insane courage
+
+      self._outcomes = [] # self._outcomes[offset - minOffset][sum of 2D6]
+      self._probs = [] # (steady, waver, rout) per offset
+      self._inspiredProbs = [] # same, but routs are rerolled once
+      for offset in range(self._minOffset, self._maxOffset+1):
+         outcomes = [NERVE_STEADY] * 13
+         counts = [0, 0, 0]
+         for diceSum in range(2, 13):
+            outcomes[diceSum] = self._Resolve(diceSum, offset)
+            counts[outcomes[diceSum]] += _2D6_COUNTS[diceSum]
+         self._outcomes.append(outcomes)
+         pSteady, pWaver, pRout = [c / 36. for c in counts]
+         self._probs.append((pSteady, pWaver, pRout))
+         self._inspiredProbs.append((pSteady + pRout*pSteady, pWaver + pRout*pWaver, pRout*pRout))
+
+   def __repr__(self):
+      return "NerveTable(%s/%d)" % (str(self.waver) if self.waver > 0 else "-", self.rout)
+
+   def _Index(self, offset):
+      return min(max(offset, self._minOffset), self._maxOffset) - self._minOffset
+
+   def _Resolve(self, diceSum, offset):
+      if diceSum == 2: return NERVE_STEADY # insane courage
+      total = diceSum + offset
+      if total >= self.rout: return NERVE_ROUT
+      if self.waver > 0 and total >= self.waver: return NERVE_WAVER
+      return NERVE_STEADY
+
+   def Outcome(self, diceSum, offset):
+      """ Return the outcome of a nerve test where the dice show *diceSum* and the unit has
+      taken damage plus modifiers of *offset*. """
+      return self._outcomes[self._Index(offset)][diceSum]
+
+   def Probabilities(self, offset, inspiring=False):
+      """ Return the probabilities (steady, waver, rout) of a nerve test at *offset*. With
+      *inspiring*, a rout result is rerolled once. """
+      if inspiring: return self._inspiredProbs[self._Index(offset)]
+      return self._probs[self._Index(offset)]
+
+   def Test(self, damage, stream, modifier=0, inspiring=False):
+      """ Roll a nerve test with *stream* (rng.RandomStream) and return its outcome along with
+      the rolled dice as a list of (die1, die2) tuples, two tuples if a rout was rerolled. """
+      offset = damage + modifier
+      rolls = [(stream.Die(6), stream.Die(6))]
+      outcome = self.Outcome(sum(rolls[0]), offset)
+      if outcome == NERVE_ROUT and inspiring:
+         rolls.append((stream.Die(6), stream.Die(6)))
+         outcome = self.Outcome(sum(rolls[1]), offset)
+      return outcome, rolls
+
+
+_tables = {}
+
+def NerveTableFor(waver, rout):
+   """ Return the (shared) NerveTable for the nerve value *waver*/*rout*. """
+   try: return _tables[(waver, rout)]
+   except KeyError:
+      table = _tables[(waver, rout)] = NerveTable(waver, rout)
+      return table
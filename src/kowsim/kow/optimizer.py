@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+# kow/optimizer.py
+#===============================================================================
+#   Points-limit army optimizer: finds the legal army lists with the highest
+#   value of an objective (e.g. total attacks) for a primary force and optional
+#   allied forces. Branch-and-bound search over the number of units taken of
+#   each unit profile, pruned by points, unit limits and the slots of
+#   NumberOfNonRegimentsOkRule. Lists found this way are checked with all
+#   validation rules, and those with critical messages are skipped. Options and
+#   magic items are not chosen.
+#===============================================================================
+import heapq
+import time
+
+import kowsim.kow.unittype as ut
+import kowsim.kow.sizetype as st
+from kowsim.kow.alignment import AL_GOOD, AL_EVIL
+from kowsim.kow.force import ArmyList, Detachment
+from kowsim.kow.unit import UnitInstance
+from kowsim.kow.validation import ArmyListValidator, ALL_VALIDATIONRULES, CokSpecialUnitsMaxThreeTimesRule
+
+
+#===============================================================================
+# Objectives
+#   Value of a single unit profile, the value of an army list is the sum over
+#   all of its units.
+#===============================================================================
+_UNIT_STRENGTH = { st.ST_TRP: 1, st.ST_REG: 2, st.ST_HRD: 3, st.ST_LEG: 4 }
+
+def Attacks(profile): return profile.At()
+
+def UnitStrength(profile):
+   """ 1 for troops, 2 for regiments, 3 for hordes, 4 for legions and 1 for monsters. Heroes and war engines have none. """
+   if profile.UnitType() == ut.UT_MON: return 1
+   if profile.UnitType() in (ut.UT_HERO, ut.UT_WENG): return 0
+   return _UNIT_STRENGTH.get(profile.SizeType(), 0)
+
+def Hordes(profile):
+   return 1 if profile.SizeType() in (st.ST_HRD, st.ST_LEG) else 0
+
+OBJECTIVES = { "attacks": Attacks, "unitstrength": UnitStrength, "hordes": Hordes }
+
+
+#===============================================================================
+# Slots
+#   Role of a unit in NumberOfNonRegimentsOkRule: regiments and hordes provide
+#   slots, troops, heroes, war engines and monsters use them.
+#===============================================================================
+_SLOT_NONE, _SLOT_REGIMENT, _SLOT_HORDE, _SLOT_TROOP, _SLOT_HERO, _SLOT_WENG, _SLOT_MONSTER = range(7)
+_LINE_UNITTYPES = (ut.UT_INF, ut.UT_LINF, ut.UT_CAV, ut.UT_LCAV)
+
+def _SlotKind(profile):
+   utype = profile.UnitType()
+   if utype == ut.UT_HERO: return _SLOT_HERO
+   if utype == ut.UT_WENG: return _SLOT_WENG
+   if utype == ut.UT_MON: return _SLOT_MONSTER
+   if utype in _LINE_UNITTYPES:
+      if profile.SizeType() == st.ST_REG and not profile.irregular: return _SLOT_REGIMENT
+      if profile.SizeType() in (st.ST_HRD, st.ST_LEG) and not profile.irregular: return _SLOT_HORDE
+      if profile.SizeType() == st.ST_TRP: return _SLOT_TROOP
+   return _SLOT_NONE
+
+
+class _Choice(object):
+   """ A unit profile which may be taken any number of times by one detachment. """
+   __slots__ = ("det", "order", "profile", "points", "value", "slot", "limits")
+
+   def __init__(self, det, order, profile, value, limits):
+      self.det = det # index of the detachment
+      self.order = order # index of the profile in its force list
+      self.profile = profile
+      self.points = profile.PointsCost()
+      self.value = value
+      self.slot = _SlotKind(profile)
+      self.limits = limits # indices of the shared unit limits, e.g. of a unique unit
+
+   def Density(self): return self.value / float(self.points)
+
+
+class _TimeUp(Exception):
+   pass
+
+
+#===============================================================================
+# OptimizerResult
+#===============================================================================
+class OptimizerResult(object):
+   def __init__(self, lists, complete, numNodes, elapsed, numRejected=0):
+      self.lists = lists # [(value, ArmyList)], best first
+      self.complete = complete # False if the time budget ran out, the lists are the best ones found until then
+      self.numNodes = numNodes
+      self.elapsed = elapsed
+      self.numRejected = numRejected # lists within the bounds of the search which failed validation
+
+   def __repr__(self):
+      best = self.lists[0][0] if len(self.lists) > 0 else None
+      return "OptimizerResult(%d lists, best %s, %s, %d nodes in %.1fs)" % (len(self.lists), best,
+            "optimal" if self.complete else "incomplete", self.numNodes, self.elapsed)
+
+
+#===============================================================================
+# ArmyOptimizer
+#===============================================================================
+class ArmyOptimizer(object):
+   def __init__(self, primary, pointsLimit, objective=Attacks, allies=(), rules=ALL_VALIDATIONRULES):
+      """ Optimizer for army lists of *pointsLimit* points with a primary detachment of *primary* and one
+      allied detachment of each of *allies* (KowForceChoices). *objective* returns the value of a unit
+      profile. The lists have to pass all validation *rules* without critical messages. """
+      for ally in allies:
+         if set((primary.Alignment(), ally.Alignment())) == set((AL_GOOD, AL_EVIL)):
+            raise ValueError("%s can't be allied with %s." % (ally.Name(), primary.Name()))
+
+      self._forces = [primary] + list(allies)
+      self._pointsLimit = pointsLimit
+      self._rules = rules
+      self._limits = [] # maximum count per shared limit
+      self._used = []
+
+      limitIndex = {}
+      def Limit(key, maxCount):
+         if key not in limitIndex:
+            limitIndex[key] = len(self._limits)
+            self._limits.append(maxCount)
+         return limitIndex[key]
+
+      cokLimits = any(isinstance(r, CokSpecialUnitsMaxThreeTimesRule) for r in rules)
+      choices = []
+      for d, force in enumerate(self._forces):
+         detChoices = []
+         for order, profile in enumerate(force.ListUnits()):
+            if profile.PointsCost() <= 0: continue
+            limits = []
+            if profile.unique: limits.append(Limit(("unique", profile.Name()), 1))
+            if cokLimits and _SlotKind(profile) in (_SLOT_HERO, _SLOT_WENG, _SLOT_MONSTER):
+               limits.append(Limit((d, profile.Name()), 3 if d == 0 else 1))
+            detChoices.append(_Choice(d, order, profile, objective(profile), limits))
+
+         # units without value are only useful to provide slots for valuable ones
+         needSlots = any(ch.value > 0 and ch.slot >= _SLOT_TROOP for ch in detChoices)
+         choices.extend([ch for ch in detChoices if ch.value > 0 or (needSlots and ch.slot in (_SLOT_REGIMENT, _SLOT_HORDE))])
+
+      # all slot providers first, so the slots are known when the slot users are chosen
+      choices.sort(key=lambda ch: (ch.slot >= _SLOT_TROOP, -ch.Density()))
+      self._choices = choices
+      self._byDensity = [sorted([j for j in range(i, len(choices)) if choices[j].value > 0], key=lambda j: -choices[j].Density())
+                         for i in range(len(choices) + 1)]
+
+   def Solve(self, topN=1, timeBudget=None):
+      """ Search the *topN* best lists, for at most *timeBudget* seconds if given. Returns an OptimizerResult. """
+      start = time.time()
+      self._deadline = start + timeBudget if timeBudget is not None else None
+      self._topN = topN
+      self._best = [] # heap of (value, sequence number, ArmyList)
+      self._numNodes = 0
+      self._numRejected = 0
+      self._used = [0] * len(self._limits)
+      self._slots = [[0] * 7 for f in self._forces]
+      self._counts = [0] * len(self._choices)
+
+      complete = True
+      try: self._Search(0, self._pointsLimit, 0)
+      except _TimeUp: complete = False
+
+      lists = []
+      for rank, (value, seq, armylist) in enumerate(sorted(self._best, key=lambda b: (-b[0], b[1]))):
+         armylist.SetCustomName("Optimized list %d" % (rank + 1))
+         lists.append((value, armylist))
+      return OptimizerResult(lists, complete, self._numNodes, time.time() - start, self._numRejected)
+
+   def _BuildArmyList(self, counts):
+      armylist = ArmyList("Optimized list", self._pointsLimit)
+      dets = [Detachment(force, isPrimary=(d == 0)) for d, force in enumerate(self._forces)]
+      for det in dets: armylist.AddDetachment(det)
+      for ch, n in sorted(zip(self._choices, counts), key=lambda c: (c[0].det, c[0].order)):
+         for k in range(n):
+            dets[ch.det].AddUnit(UnitInstance(ch.profile, dets[ch.det]))
+      return armylist
+
+   def _Bound(self, i, pointsLeft):
+      """ Upper bound for the value of the choices from *i* on: fractional knapsack over their unit limits. """
+      bound = 0.
+      for j in self._byDensity[i]:
+         ch = self._choices[j]
+         pts = pointsLeft
+         for k in ch.limits: pts = min(pts, (self._limits[k] - self._used[k]) * ch.points)
+         if pts <= 0: continue
+         bound += pts * ch.Density()
+         pointsLeft -= pts
+         if pointsLeft <= 0: break
+      return bound
+
+   def _Cap(self, ch, pointsLeft):
+      """ Maximum number of units of choice *ch* which can still be added. """
+      n = pointsLeft // ch.points
+      for k in ch.limits: n = min(n, self._limits[k] - self._used[k])
+      if ch.slot >= _SLOT_TROOP:
+         c = self._slots[ch.det]
+         nReg, nHrd = c[_SLOT_REGIMENT], c[_SLOT_HORDE]
+         if ch.slot == _SLOT_TROOP:
+            n = min(n, 2*nReg + 4*nHrd - c[_SLOT_TROOP])
+         else: # hordes allow one of each kind, regiments one of any kind
+            excess = sum([max(c[s] - nHrd, 0) for s in (_SLOT_HERO, _SLOT_WENG, _SLOT_MONSTER)])
+            n = min(n, nReg - excess + max(c[ch.slot] - nHrd, 0) + nHrd - c[ch.slot])
+      return max(n, 0)
+
+   def _Record(self, value):
+      """ Keep the current list if it is among the best ones so far and passes the validation rules. The search
+      only models points, unit limits and slots, so rules beyond those (e.g. of plugins) can reject a list. """
+      if len(self._best) == self._topN and value <= self._best[0][0]: return
+      armylist = self._BuildArmyList(self._counts)
+      if any(msg.IsCritical() for msg in ArmyListValidator(armylist, self._rules).Check()):
+         self._numRejected += 1
+         return
+      entry = (value, self._numNodes, armylist)
+      if len(self._best) < self._topN: heapq.heappush(self._best, entry)
+      else: heapq.heapreplace(self._best, entry)
+
+   def _Search(self, i, pointsLeft, value):
+      self._numNodes += 1
+      if self._deadline is not None and self._numNodes & 1023 == 0 and time.time() > self._deadline:
+         raise _TimeUp()
+      if i == len(self._choices):
+         self._Record(value)
+         return
+      if len(self._best) == self._topN and value + self._Bound(i, pointsLeft) <= self._best[0][0] + 1e-9:
+         return
+
+      ch = self._choices[i]
+      counts = range(self._Cap(ch, pointsLeft), -1, -1) if ch.value > 0 else range(self._Cap(ch, pointsLeft) + 1)
+      for n in counts:
+         self._Add(ch, n)
+         self._counts[i] = n
+         self._Search(i + 1, pointsLeft - n*ch.points, value + n*ch.value)
+         self._Add(ch, -n)
+      self._counts[i] = 0
+
+   def _Add(self, ch, n):
+      for k in ch.limits: self._used[k] += n
+      self._slots[ch.det][ch.slot] += n
+
+
+def OptimizeArmy(primary, pointsLimit, objective=Attacks, allies=(), rules=ALL_VALIDATIONRULES, topN=1, timeBudget=None):
+   """ Return an OptimizerResult with the *topN* best army lists, see ArmyOptimizer. """
+   return ArmyOptimizer(primary, pointsLimit, objective, allies, rules).Solve(topN, timeBudget)
@@ -2,23 +2,178 @@
 
 # kow/specialrule.py
 #===============================================================================
+import re
+
 class GenericSpecialRule(object):
    """ A special rule in the KoW sense such as Elite or Crushing Strength (1).
     Special rules can be identified by their (unique) name, they can have a description,
     and they might have a parameter, such as Random Attacks (D6), and might be cumulative,
     such as Piercing(2). """
-   def __init__(self, name, desc, param=None, cumulative=False):
+   def __init__(self, name, desc, param=None, cumulative=False, bit=None):
       self._customName = name
       self._description = desc
       self._param = param
       self._isCumulative = cumulative
-     
-      
+      self._bit = bit # index in RuleSet bitsets, assigned by the SpecialRuleRegistry
+
+
    def __repr__(self):
       return self._customName
-      
+
+   def Bit(self):
+      return self._bit
+
    def Name(self):
       return self._customName
-   
+
    def Description(self):
-      return self._desc
+      return self._description
+
+   def IsCumulative(self):
+      return self._isCumulative
+
+
+#===============================================================================
+# RuleSet
+#   Special rules of a unit as a bitset over the rules of a registry plus the
+#   parameters of the rules which have one, e.g. 2 for Crushing Strength (2).
+#   Immutable; bits are only meaningful within one process.
+#===============================================================================
+class RuleSet(object):
+   __slots__ = ("mask", "params", "_registry")
+
+   def __init__(self, registry, mask=0, params=None):
+      self._registry = registry
+      self.mask = mask
+      self.params = params if params is not None else {} # bit => parameter (int, or string such as 'D6')
+
+   def __contains__(self, name): return self.HasRule(name)
+   def __eq__(self, other): return isinstance(other, RuleSet) and self.mask == other.mask and self.params == other.params
+   def __ne__(self, other): return not self.__eq__(other)
+   def __repr__(self): return "RuleSet(%s)" % ", ".join(self.Names())
+
+   def HasAll(self, mask): return self.mask & mask == mask
+
+   def HasRule(self, name):
+      rule = self._registry.Find(name)
+      return rule is not None and (self.mask >> rule.Bit()) & 1 == 1
+
+   def Names(self):
+      """ Rule names with their parameters, e.g. ['Elite', 'Crushing Strength (2)'], in registry order. """
+      names = []
+      mask, bit = self.mask, 0
+      while mask:
+         if mask & 1:
+            name = self._registry.RuleForBit(bit).Name()
+            names.append("%s (%s)" % (name, self.params[bit]) if bit in self.params else name)
+         mask >>= 1
+         bit += 1
+      return names
+
+   def Param(self, name, default=None):
+      rule = self._registry.Find(name)
+      if rule is None: return default
+      return self.params.get(rule.Bit(), default)
+
+   def Union(self, other):
+      if other.mask == 0: return self
+      params = dict(self.params)
+      for bit, param in other.params.iteritems():
+         if bit in params and isinstance(param, int) and isinstance(params[bit], int) and self._registry.RuleForBit(bit).IsCumulative():
+            params[bit] += param
+         else: params[bit] = param
+      return RuleSet(self._registry, self.mask | other.mask, params)
+
+   def Value(self, name):
+      """ Numeric parameter of the rule *name*, 0 if the unit doesn't have the rule or its parameter isn't a number. """
+      param = self.Param(name, 0)
+      return param if isinstance(param, int) else 0
+
+   def Without(self, mask):
+      if self.mask & mask == 0: return self
+      return RuleSet(self._registry, self.mask & ~mask, dict([(b, p) for b, p in self.params.iteritems() if not (mask >> b) & 1]))
+
+
+#===============================================================================
+# SpecialRuleRegistry
+#   Interns special rules by name. Rule strings from the force lists such as
+#   'CS(2)' or 'Crushing Strength (2)' are parsed once into the shared rule and
+#   its parameter.
+#===============================================================================
+_RULE_RE = re.compile(r"^\s*(.*?)\s*(?:\(\s*([^)]*?)\s*\))?\+?\s*$")
+
+RULE_ALIASES = { "CS": "Crushing Strength", "TC": "Thunderous Charge" }
+CUMULATIVE_RULES = ("Crushing Strength", "Thunderous Charge", "Piercing")
+
+class SpecialRuleRegistry(object):
+   def __init__(self, aliases=RULE_ALIASES, cumulative=CUMULATIVE_RULES):
+      self._aliases = aliases
+      self._cumulative = frozenset(cumulative)
+      self._rules = [] # by bit
+      self._rulesByName = {}
+      self._parsed = {} # rule string => (rule, param)
+      self._ruleSets = {} # tuple of rule strings => RuleSet
+      self.empty = RuleSet(self)
+
+   def __len__(self): return len(self._rules)
+
+   def Find(self, name):
+      """ Return the rule *name* (or one of its aliases, parameters are ignored) if it has been registered, None otherwise. """
+      rule = self._rulesByName.get(name)
+      if rule is None: rule = self._rulesByName.get(self._Canonical(_RULE_RE.match(name).group(1)))
+      return rule
+
+   def ListRules(self): return self._rules
+
+   def Mask(self, names):
+      """ Bitset of the rules *names*, or None if any of them isn't registered. """
+      mask = 0
+      for name in names:
+         rule = self.Find(name)
+         if rule is None: return None
+         mask |= 1 << rule.Bit()
+      return mask
+
+   def Parse(self, s):
+      """ Return (rule, parameter) for a rule string such as 'CS(2)', registering the rule if necessary. The parameter
+      is an int if it is a number, None if there is none. Returns (None, None) for empty strings. """
+      try: return self._parsed[s]
+      except KeyError:
+         m = _RULE_RE.match(s)
+         name, param = self._Canonical(m.group(1)), m.group(2)
+         if param is not None and param.isdigit(): param = int(param)
+         res = self._parsed[s] = (self.Rule(name), param) if name else (None, None)
+         return res
+
+   def Rule(self, name):
+      """ Return the interned rule called *name* (without parameter), registering it if necessary. """
+      try: return self._rulesByName[name]
+      except KeyError:
+         rule = self._rulesByName[name] = GenericSpecialRule(name, "", cumulative=name in self._cumulative, bit=len(self._rules))
+         self._rules.append(rule)
+         return rule
+
+   def RuleForBit(self, bit): return self._rules[bit]
+
+   def RuleSetFromStrings(self, strings):
+      """ Return the (shared) RuleSet of a list of rule strings, e.g. a profile's special rules. """
+      key = tuple(strings)
+      try: return self._ruleSets[key]
+      except KeyError:
+         ruleSet = self.empty
+         for s in key:
+            rule, param = self.Parse(s)
+            if rule is None: continue
+            ruleSet = ruleSet.Union(RuleSet(self, 1 << rule.Bit(), { rule.Bit(): param } if param is not None else None))
+         self._ruleSets[key] = ruleSet
+         return ruleSet
+
+   def _Canonical(self, name):
+      return self._aliases.get(name, name)
+
+
+_defaultRegistry = SpecialRuleRegistry()
+
+def DefaultRegistry():
+   """ Registry shared by all force lists, items and units of the process. """
+   return _defaultRegistry
@@ -41,6 +41,8 @@ ST_NERVE = KowStat("Nerve", "Ne")
 
 ALL_STATS = (ST_SPEED, ST_MELEE, ST_RANGED, ST_DEFENSE, ST_ATTACKS, ST_NERVE)
 
+MAX_DEFENSE = 6 # no modifier improves the Defense beyond 6+
+
 def FindStat(name):
    """ Find one of the pre-created stat objects by its name.
    
@@ -2,27 +2,36 @@
 
 # kow/unit.py
 #===============================================================================
+import hashlib
+
 import unittype as ut
 import sizetype as st
 
 from ..util.core import Size
 from modifiers import MOD_ADD, MOD_SET
-from effect import UnitEffect, ModifyStatEffect
+from effect import InternEffect, EffectIndex
+from specialrule import DefaultRegistry
 import stats
-from kowsim.kow.effect import GrantSpecialRuleEffect, RemoveSpecialRuleEffect
 
 #===============================================================================
 # KowUnitOption
 #   Option for a specific unit, e.g. to take two-handed weapons instead of
 #   weapon and shield. May be associated with a points cost as well as a list
 #   of effects (e.g. increasing one profile value but lowering another one in turn).
+#   Options are immutable and shared between all profiles listing the same
+#   option string, see InternOption. An option string listed twice for one
+#   profile (e.g. two mounts) gives two distinct options.
 #===============================================================================
 class KowUnitOption(object):
+   __slots__ = ("_name", "_pointsCost", "_effects", "_effectIndex")
+   
    def __init__(self, name, pointsCost=0, effects=None, isActive=False):
       self._name = name
       self._pointsCost = pointsCost
       self._effects = effects if effects is not None else []
+      self._effectIndex = EffectIndex(self._effects)
       
+   def EffectIndex(self): return self._effectIndex
    def Name(self): return self._name
    def PointsCost(self): return self._pointsCost
       
@@ -40,12 +49,31 @@ class KowUnitOption(object):
          s += " (%dp)" % self._pointsCost
       return s
 
+_optionPool = {} # (name, points cost, effect strings, occurrence) => KowUnitOption
+
+def InternOption(name, pointsCost=0, effectStrs=(), occurrence=0):
+   """ Return the shared KowUnitOption for the given name, points cost and effect strings. *occurrence*
+   counts earlier identical entries in the same option list, which get an option of their own. """
+   key = (name.strip(), pointsCost, tuple([e.strip() for e in effectStrs]), occurrence)
+   try: return _optionPool[key]
+   except KeyError:
+      effects = []
+      for e in key[2]:
+         effect = InternEffect(e)
+         if effect is not None: effects.append(effect)
+      opt = _optionPool[key] = KowUnitOption(key[0], pointsCost, effects)
+      return opt
+
+
 #===============================================================================
 # UnitProfile
 #   Unit profile as given in an army list entry, e.g. Sea Guarde Horde, along
 #   with its statistics.
 #===============================================================================
 class UnitProfile(object):
+   __slots__ = ("_name", "_speed", "_melee", "_ranged", "_defense", "_attacks", "_nerveWaver", "_nerveBreak", "_pointsCost",
+                "_unitType", "_sizeType", "_baseSize", "_specialRules", "_item", "_options", "irregular", "unique", "_ruleSet")
+   
    def __init__(self, *args):
       self._name = args[0] if len(args)>0 else "Unknown unit"
       self._speed = args[1] if len(args)>1 else 5
@@ -64,6 +92,7 @@ class UnitProfile(object):
       self._options = args[14] if len(args)>14 else []
       self.irregular = args[15] if len(args)>15 else False
       self.unique = args[16] if len(args)>16 else False
+      self._ruleSet = None
             
    def __repr__(self):
       return "UnitProfile(%s)" % self._name
@@ -87,6 +116,11 @@ class UnitProfile(object):
    def ListOptions(self): return self._options
    def ListSpecialRules(self): return self._specialRules
    def PointsCost(self): return self._pointsCost
+   def RuleSet(self):
+      """ Special rules as a RuleSet (bitset and parameters) of the default registry. """
+      if self._ruleSet is None: self._ruleSet = DefaultRegistry().RuleSetFromStrings(self._specialRules)
+      return self._ruleSet
+   def HasRule(self, name): return self.RuleSet().HasRule(name)
    def Ra(self): return self._ranged
    def RaStr(self): return "%d+" % self.Ra() if self.Ra()>0 else "-"
    def SizeType(self): return self._sizeType
@@ -212,6 +246,7 @@ class UnitProfile(object):
       # e.g. " Lightning Bolt(5)|+45;Fireball (10)|+10;Wind Blast (5)|+30;Bane Chant(2)|+15;Sabre-toothed Pussycat|+10;Mount|+15|Set(Speed,9) "
       options = s.split(';')
       optList = []
+      occurrences = {} # option string => number of earlier entries
       for o in options:
          params = o.split('|')
          optName = params[0]
@@ -224,16 +259,68 @@ class UnitProfile(object):
          if len(params)>2: effectStrs = params[2:]
          else: effectStrs = []
          
-         effects = []
-         for e in effectStrs:
-            effect = UnitEffect.ParseFromString(e)
-            if effect is not None: effects.append(effect)
-         
-         optObject = KowUnitOption(optName, optPointsCost, effects)
-         optList.append(optObject)
+         key = (optName.strip(), optPointsCost, tuple([e.strip() for e in effectStrs]))
+         occurrence = occurrences[key] = occurrences.get(key, -1) + 1
+         optList.append(InternOption(optName, optPointsCost, effectStrs, occurrence))
       return optList
    
 
+#===============================================================================
+# ResolvedProfile
+#   Final stats, special rules and points cost of a UnitInstance with all its
+#   chosen options and its magic item applied. Folds the EffectIndex of each
+#   option and of the item.
+#===============================================================================
+class ResolvedProfile(object):
+   __slots__ = ("specialRules", "ruleSet", "pointsCost", "stats", "sp", "me", "ra", "de", "at", "modifiedStats")
+   
+   def __init__(self, unit):
+      profile = unit._profile
+      base = { stats.ST_SPEED: profile._speed, stats.ST_MELEE: profile._melee, stats.ST_RANGED: profile._ranged,
+               stats.ST_DEFENSE: profile._defense, stats.ST_ATTACKS: profile._attacks }
+      setModifiers = {}
+      addModifiers = dict.fromkeys(base, 0)
+      
+      specialRules = list(profile._specialRules)
+      self.ruleSet = profile.RuleSet()
+      self.pointsCost = profile.PointsCost()
+      
+      indices = [o.EffectIndex() for o in unit._chosenOptions]
+      for o in unit._chosenOptions:
+         self.pointsCost += o.PointsCost()
+      if unit._chosenItem is not None:
+         self.pointsCost += unit._chosenItem.PointsCost()
+         indices.append(unit._chosenItem.EffectIndex())
+      
+      for idx in indices:
+         for stat, val in idx.setModifiers.iteritems():
+            if stat not in base: continue # nerve modifiers not yet supported
+            if stat in setModifiers:
+               print "Warning: Multiple 'Set' modifiers for %s!" % stat.Name()
+            setModifiers[stat] = val
+         for stat, val in idx.addModifiers.iteritems():
+            if stat in base: addModifiers[stat] += val
+         specialRules.extend(idx.grantedRules)
+         self.ruleSet = self.ruleSet.Union(idx.grantedSet).Without(idx.removedMask)
+         for rule in idx.removedRules:
+            if rule in specialRules:
+               specialRules.remove(rule)
+            else:
+               print "Warning: Unit %s has RemoveSpecialRuleEffect(%s), but it does not have that special rule!" % (profile.Name(), rule)
+      
+      self.specialRules = tuple(specialRules) # shared by all callers until the unit changes
+      self.stats = {}
+      for stat, val in base.iteritems():
+         self.stats[stat] = setModifiers.get(stat, val) + addModifiers[stat]
+      self.stats[stats.ST_DEFENSE] = min(self.stats[stats.ST_DEFENSE], stats.MAX_DEFENSE) # e.g. Ensorcelled Armour on De 6+
+      self.sp = self.stats[stats.ST_SPEED]
+      self.me = self.stats[stats.ST_MELEE]
+      self.ra = self.stats[stats.ST_RANGED]
+      self.de = self.stats[stats.ST_DEFENSE]
+      self.at = self.stats[stats.ST_ATTACKS]
+      self.modifiedStats = frozenset([stat for stat in base if self.stats[stat] != base[stat]])
+
+
 #===============================================================================
 # UnitInstance
 #   Instance of a specific unit someone has included into their army list.
@@ -244,18 +331,22 @@ class UnitProfile(object):
 #   originates from (e.g. Shield Guard Horde).
 #===============================================================================
 class UnitInstance(object):
+   __slots__ = ("_profile", "_detachment", "_customName", "_chosenOptions", "_chosenItem", "_resolved", "_contentHash")
+   
    def __init__(self, profile, detachment, customName=None, chosenOptions=None, chosenItem=None):
       self._profile = profile
       self._detachment = detachment
       self._customName = customName
       self._chosenOptions = chosenOptions if chosenOptions is not None else []
       self._chosenItem = chosenItem
+      self._resolved = None # ResolvedProfile, computed on demand and reset whenever options, item or profile change
+      self._contentHash = None # same for ContentHash()
       
    def __repr__(self):
       return "UnitInstance(%s)" % self.Name()
       
    # Getters
-   def At(self): return self._StatWithModifiers(stats.ST_ATTACKS)
+   def At(self): return self.Resolved().at
    def AtStr(self): return "%d" % self.At() if self.At()>0 else "-"
    def CanHaveItem(self): return self._profile.CanHaveItem()
    def ChooseOption(self, opt):
@@ -263,54 +354,63 @@ class UnitInstance(object):
          raise ValueError("Unit %s cannot choose option %s." % (self.Name(), opt.Name()))
       elif opt in self._chosenOptions:
          raise ValueError("Unit %s already has option %s." % (self.Name(), opt.Name()))
-      else: self._chosenOptions.append(opt)
+      else:
+         self._chosenOptions.append(opt)
+         self._Changed()
          
-   def ClearChosenOptions(self): self._chosenOptions = []
+   def ClearChosenOptions(self):
+      self._chosenOptions = []
+      self._Changed()
+   def ContentHash(self):
+      """ SHA1 hex digest of profile, size, item and chosen options (in canonical order). Ignores the custom name. """
+      if self._contentHash is None:
+         fields = [self._profile.Name(), self.SizeType().Name(), self.ItemName()] + sorted([o.Name() for o in self._chosenOptions])
+         self._contentHash = hashlib.sha1("\x00".join([f.encode("utf-8") if isinstance(f, unicode) else f for f in fields])).hexdigest()
+      return self._contentHash
    def CustomName(self): return self._customName if self._customName is not None else ""
-   def De(self): return self._StatWithModifiers(stats.ST_DEFENSE)
+   def De(self): return self.Resolved().de
    def DeStr(self): return "%d+" % self.De()
    def Detachment(self): return self._detachment
+   def HasRule(self, name): return self.Resolved().ruleSet.HasRule(name)
    def DisplayName(self): return self._profile.DisplayName()
    def Item(self): return self._chosenItem
    @property
    def irregular(self):
       return self._profile.irregular
    def ListChosenOptions(self): return self._chosenOptions
-   def ListSpecialRules(self):
-      specRules = []
-      specRules.extend(self._profile._specialRules)
-      for o in self._chosenOptions:
-         for e in o._effects:
-            if type(e) == GrantSpecialRuleEffect:
-               specRules.append(e.SpecialRule())
-            elif type(e) == RemoveSpecialRuleEffect:
-               if e.SpecialRule() in specRules:
-                  specRules.remove(e.SpecialRule())
-               else:
-                  print "Warning: Unit %s has RemoveSpecialRuleEffect(%s), but it does not have that special rule!" % (self.Name(), e.SpecialRule())
-      return specRules
+   def ListSpecialRules(self): return list(self.Resolved().specialRules)
    
-   def Me(self): return self._StatWithModifiers(stats.ST_MELEE)
+   def Me(self): return self.Resolved().me
    def MeStr(self): return "%d+" % self.Me() if self.Me()>0 else "-"
    def Name(self): return self._profile.Name()
    def Ne(self): return (self._profile._nerveWaver, self._profile._nerveBreak)
    def NeStr(self): return "%s/%d" % (str(self._profile._nerveWaver) if self._profile._nerveWaver != 0 else "-", self._profile._nerveBreak)
    def Profile(self): return self._profile
-   def Ra(self): self._StatWithModifiers(stats.ST_RANGED)
+   def Ra(self): return self.Resolved().ra
    def RaStr(self): return "%d+" % self.Ra() if self.Ra()>0 else "-"
+   def RuleSet(self): return self.Resolved().ruleSet
+   def Resolved(self):
+      """ Return the ResolvedProfile with the unit's final stats, special rules and points cost. """
+      if self._resolved is None:
+         self._resolved = ResolvedProfile(self)
+      return self._resolved
    def SetProfile(self, profile):
       self._profile = profile
+      self._Changed()
       self.Validate()
       
    def SizeType(self): return self._profile.SizeType()
-   def Sp(self): return self._StatWithModifiers(stats.ST_SPEED)
+   def Sp(self): return self.Resolved().sp
    @property
    def unique(self):
       return self._profile.unique
    def UnitType(self): return self._profile.UnitType()
    
    # Setters
-   def SetItem(self, item): self._chosenItem = item
+   def SetDetachment(self, detachment): self._detachment = detachment
+   def SetItem(self, item):
+      self._chosenItem = item
+      self._Changed()
    
    def HasPointsCostModifier(self):
       if self.Item() is not None and self.Item().PointsCost() > 0:
@@ -321,12 +421,9 @@ class UnitInstance(object):
       return False
    
    def HasStatModifier(self, stat):
-      if stat == stats.ST_SPEED: return (self._profile._speed != self._StatWithModifiers(stats.ST_SPEED))
-      elif stat == stats.ST_MELEE: return (self._profile._melee != self._StatWithModifiers(stats.ST_MELEE))
-      elif stat == stats.ST_RANGED: return (self._profile._ranged != self._StatWithModifiers(stats.ST_RANGED))
-      elif stat == stats.ST_DEFENSE: return (self._profile._defense != self._StatWithModifiers(stats.ST_DEFENSE))
-      elif stat == stats.ST_ATTACKS: return (self._profile._attacks != self._StatWithModifiers(stats.ST_ATTACKS))
-      else: raise ValueError("Unknown stat: %s" % stat)
+      if stat not in (stats.ST_SPEED, stats.ST_MELEE, stats.ST_RANGED, stats.ST_DEFENSE, stats.ST_ATTACKS):
+         raise ValueError("Unknown stat: %s" % stat)
+      return stat in self.Resolved().modifiedStats
    
    def ItemCost(self):
       if self._chosenItem: return self._chosenItem.PointsCost()
@@ -336,13 +433,7 @@ class UnitInstance(object):
       if self._chosenItem: return self._chosenItem.Name()
       else: return ""
       
-   def PointsCost(self):
-      pc = self._profile.PointsCost()
-      if self.Item():
-         pc += self.Item().PointsCost()
-      for o in self._chosenOptions:
-         pc += o.PointsCost()
-      return pc
+   def PointsCost(self): return self.Resolved().pointsCost
    
    def Validate(self):
       if self.Item() is not None and (not self._profile.CanHaveItem()):
@@ -351,58 +442,16 @@ class UnitInstance(object):
          if opt not in self._profile.ListOptions():
             raise ValueError("Unit %s has chosen option %s which should not be available." % (self.Name(), opt.Name()))
    
+   def _Changed(self):
+      """ Reset the resolved profile and content hash and let the detachment update its totals. """
+      self._resolved = None
+      self._contentHash = None
+      if self._detachment is not None:
+         self._detachment.UnitChanged(self)
+   
    def _StatWithModifiers(self, stat):
       """ Return the unit's current effective stat (KowStat instance) with all its modifiers from options or magic items. """
-      setModifiers = []
-      addModifiers = []
-      
-      if stat == stats.ST_SPEED:
-         val = self._profile._speed
-         for o in self._chosenOptions:
-            for e in o._effects:
-               if type(e) == ModifyStatEffect and e.Stat()==stats.ST_SPEED:
-                  if e.ModType()==MOD_ADD: addModifiers.append(e)
-                  elif e.ModType()==MOD_SET: setModifiers.append(e)   
-      elif stat == stats.ST_MELEE:
-         val = self._profile._melee
-         for o in self._chosenOptions:
-            for e in o._effects:
-               if type(e) == ModifyStatEffect and e.Stat()==stats.ST_MELEE:
-                  if e.ModType()==MOD_ADD: addModifiers.append(e)
-                  elif e.ModType()==MOD_SET: setModifiers.append(e)
-      elif stat == stats.ST_RANGED:
-         val = self._profile._ranged
-         for o in self._chosenOptions:
-            for e in o._effects:
-               if type(e) == ModifyStatEffect and e.Stat()==stats.ST_RANGED:
-                  if e.ModType()==MOD_ADD: addModifiers.append(e)
-                  elif e.ModType()==MOD_SET: setModifiers.append(e)
-      elif stat == stats.ST_DEFENSE:
-         val = self._profile._defense
-         for o in self._chosenOptions:
-            for e in o._effects:
-               if type(e) == ModifyStatEffect and e.Stat()==stats.ST_DEFENSE:
-                  if e.ModType()==MOD_ADD: addModifiers.append(e)
-                  elif e.ModType()==MOD_SET: setModifiers.append(e)
-      elif stat == stats.ST_ATTACKS:
-         val = self._profile._attacks
-         for o in self._chosenOptions:
-            for e in o._effects:
-               if type(e) == ModifyStatEffect and e.Stat()==stats.ST_ATTACKS:
-                  if e.ModType()==MOD_ADD: addModifiers.append(e)
-                  elif e.ModType()==MOD_SET: setModifiers.append(e)
-      elif stat == stats.ST_NERVE:
+      if stat == stats.ST_NERVE:
          raise ValueError("Nerve modifiers not yet supported!")
-         return 0
-      else:
-         raise ValueError("Unknown stat: %s" % stat)
-      
-      if len(setModifiers)>1:
-         print "Warning: Multiple 'Set' modifiers for %s!" % stat.Name()
-         
-      if len(setModifiers)>0:
-         val = setModifiers[-1].Modifier()
-      
-      for a in addModifiers: val += a.Modifier()
-      return val
-   
\ No newline at end of file
+      try: return self.Resolved().stats[stat]
+      except KeyError: raise ValueError("Unknown stat: %s" % stat)
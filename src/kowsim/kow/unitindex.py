@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# kow/unitindex.py
+#===============================================================================
+#   Columnar index of all unit profiles of a set of forces for catalog-wide
+#   queries such as "De>=5 and At>=20 and points<=150 in Good forces, sorted by
+#   points per attack". Every stat is stored as one column (numpy arrays if
+#   numpy is available, array.array otherwise) and the special rules of each
+#   profile as its RuleSet bitset, so filters are evaluated per column instead
+#   of per profile.
+#===============================================================================
+from array import array
+import operator
+
+from kowsim.kow.alignment import ALL_ALIGNMENTS
+from kowsim.kow.sizetype import ALL_SIZETYPES
+from kowsim.kow.specialrule import DefaultRegistry
+from kowsim.kow.unittype import ALL_UNITTYPES
+
+try:
+   import numpy
+except ImportError: # numpy is optional, the pure Python backend below is used without it
+   numpy = None
+
+
+COLUMNS = ("sp", "me", "ra", "de", "at", "waver", "rout", "points", "unittype", "sizetype", "alignment", "force")
+
+_OPERATORS = { "<": operator.lt, "<=": operator.le, "==": operator.eq, "!=": operator.ne, ">=": operator.ge, ">": operator.gt }
+
+
+#===============================================================================
+# Column helpers
+#   Masks are numpy bool arrays or lists of bools, depending on the backend.
+#===============================================================================
+def _Column(values, isFloat=False):
+   if numpy is not None: return numpy.array(values, dtype=numpy.float64 if isFloat else numpy.int32)
+   return array('d' if isFloat else 'i', values)
+
+def _Compare(column, op, value):
+   if numpy is not None: return op(column, value)
+   return [op(x, value) for x in column]
+
+def _IsIn(column, values):
+   if numpy is not None: return numpy.in1d(column, list(values))
+   values = set(values)
+   return [x in values for x in column]
+
+def _And(mask, other):
+   if mask is None: return other
+   if numpy is not None: return mask & other
+   return [a and b for a, b in zip(mask, other)]
+
+def _Ratio(num, den):
+   """ num/den per row, infinity where den is 0. """
+   if numpy is not None:
+      with numpy.errstate(divide="ignore", invalid="ignore"):
+         res = num.astype(numpy.float64) / den
+      res[den == 0] = numpy.inf
+      return res
+   return array('d', [n / float(d) if d != 0 else float("inf") for n, d in zip(num, den)])
+
+
+class _RuleBitsets(object):
+   """ Special rules of each row as bitsets: a (rows x words) uint64 array with numpy, a list of Python longs otherwise. """
+   def __init__(self, masks, numBits):
+      if numpy is not None:
+         numWords = max((numBits + 63) // 64, 1)
+         self._words = numpy.zeros((len(masks), numWords), dtype=numpy.uint64)
+         for row, mask in enumerate(masks):
+            for w in range(numWords):
+               self._words[row, w] = (mask >> (64*w)) & 0xFFFFFFFFFFFFFFFF
+      else: self._masks = masks
+
+   def HasAll(self, mask):
+      if numpy is not None:
+         res = numpy.ones(self._words.shape[0], dtype=bool)
+         for w in range(self._words.shape[1]):
+            m = numpy.uint64((mask >> (64*w)) & 0xFFFFFFFFFFFFFFFF)
+            if m: res &= (self._words[:, w] & m) == m
+         return res
+      return [(x & mask) == mask for x in self._masks]
+
+
+#===============================================================================
+# UnitIndex
+#===============================================================================
+class UnitIndex(object):
+   DerivedMetrics = { "pointsperattack": ("points", "at"), "pointspernerve": ("points", "rout") }
+
+   def __init__(self, forceChoices):
+      self._forces = list(forceChoices)
+      self._profiles = []
+      self._usedRules = 0 # union of all profiles' rule bitsets
+
+      values = dict([(c, []) for c in COLUMNS])
+      masks = []
+      for f, fc in enumerate(self._forces):
+         alignment = ALL_ALIGNMENTS.index(fc.Alignment()) if fc.Alignment() in ALL_ALIGNMENTS else -1
+         for p in fc.ListUnits():
+            waver, rout = p.Ne()
+            for col, val in zip(COLUMNS, (p.Sp(), p.Me(), p.Ra(), p.De(), p.At(), waver or 0, rout, p.PointsCost(),
+                                          ALL_UNITTYPES.index(p.UnitType()), ALL_SIZETYPES.index(p.SizeType()), alignment, f)):
+               values[col].append(val)
+            masks.append(p.RuleSet().mask)
+            self._usedRules |= masks[-1]
+            self._profiles.append(p)
+
+      self._columns = dict([(c, _Column(values[c], c == "sp")) for c in COLUMNS]) # speed may be fractional
+      self._rules = _RuleBitsets(masks, self._usedRules.bit_length())
+
+   def Column(self, name):
+      """ Return the column *name*, one of COLUMNS or DerivedMetrics. """
+      try: return self._columns[name]
+      except KeyError:
+         if name not in UnitIndex.DerivedMetrics: raise ValueError("Unknown column: %s" % name)
+         num, den = UnitIndex.DerivedMetrics[name]
+         col = self._columns[name] = _Ratio(self._columns[num], self._columns[den])
+         return col
+
+   def ForceOfRow(self, row): return self._forces[self._columns["force"][row]]
+   def ListRuleNames(self): return sorted([r.Name() for r in DefaultRegistry().ListRules() if (self._usedRules >> r.Bit()) & 1])
+   def NumRows(self): return len(self._profiles)
+   def Profile(self, row): return self._profiles[row]
+   def Query(self): return UnitQuery(self)
+
+   def RuleMask(self, names):
+      """ Bitset of the special rules *names*, or None if any of them isn't used by any profile. """
+      mask = DefaultRegistry().Mask(names)
+      if mask is None or self._usedRules & mask != mask: return None
+      return mask
+
+
+#===============================================================================
+# UnitQuery
+#   Conditions are combined with 'and', e.g.
+#     index.Query().Where("de", ">=", 5).Where("at", ">=", 20).Alignments(AL_GOOD).OrderBy("pointsperattack")
+#===============================================================================
+class UnitQuery(object):
+   def __init__(self, index):
+      self._index = index
+      self._mask = None # None: all rows
+      self._orderBy = None
+      self._descending = False
+
+   def Alignments(self, *alignments):
+      return self._Filter(_IsIn(self._index.Column("alignment"), [ALL_ALIGNMENTS.index(a) for a in alignments]))
+
+   def Forces(self, *forceChoices):
+      rows = [i for i, fc in enumerate(self._index._forces) if fc in forceChoices]
+      return self._Filter(_IsIn(self._index.Column("force"), rows))
+
+   def HasRules(self, *names):
+      """ Keep profiles with all of the special rules *names* (without parameters, e.g. 'Crushing Strength'). """
+      mask = self._index.RuleMask(names)
+      if mask is None: return self._Filter(_Compare(self._index.Column("force"), operator.lt, 0)) # nothing matches
+      return self._Filter(self._index._rules.HasAll(mask))
+
+   def OrderBy(self, column, descending=False):
+      self._orderBy = column
+      self._descending = descending
+      return self
+
+   def SizeTypes(self, *sizeTypes):
+      return self._Filter(_IsIn(self._index.Column("sizetype"), [ALL_SIZETYPES.index(s) for s in sizeTypes]))
+
+   def UnitTypes(self, *unitTypes):
+      return self._Filter(_IsIn(self._index.Column("unittype"), [ALL_UNITTYPES.index(u) for u in unitTypes]))
+
+   def Where(self, column, op, value):
+      """ Keep profiles whose *column* compares to *value* by *op* ('<', '<=', '==', '!=', '>=', '>'). """
+      if op not in _OPERATORS: raise ValueError("Unknown operator: %s" % op)
+      return self._Filter(_Compare(self._index.Column(column), _OPERATORS[op], value))
+
+   def _Filter(self, mask):
+      self._mask = _And(self._mask, mask)
+      return self
+
+   def Count(self): return len(self.Rows())
+
+   def Profiles(self): return [self._index.Profile(r) for r in self.Rows()]
+
+   def Rows(self):
+      """ Indices of the matching rows, sorted if OrderBy was given (ties keep the index order). """
+      if numpy is not None:
+         rows = numpy.arange(self._index.NumRows()) if self._mask is None else numpy.flatnonzero(self._mask)
+         if self._orderBy is not None:
+            keys = self._index.Column(self._orderBy)[rows]
+            rows = rows[numpy.argsort(-keys if self._descending else keys, kind="mergesort")]
+         return rows.tolist()
+      rows = range(self._index.NumRows()) if self._mask is None else [i for i, m in enumerate(self._mask) if m]
+      if self._orderBy is not None:
+         keys = self._index.Column(self._orderBy)
+         rows.sort(key=(lambda r: -keys[r]) if self._descending else keys.__getitem__)
+      return rows
@@ -2,13 +2,29 @@
 
 # kow/validation.py
 #===============================================================================
+import imp
+import os
+import sys
+from collections import deque
+from timeit import default_timer
+
 from kowsim.kow.alignment import AL_GOOD, AL_EVIL
 import kowsim.kow.unittype as ut
 import kowsim.kow.sizetype as st
 from _collections import defaultdict
 
 
-""" When you add a new validation rule, don't forget to add an instance of it to ALL_VALIDATIONRULES way down in this file! """
+""" When you add a new validation rule, don't forget to add an instance of it to ALL_VALIDATIONRULES way down in this file!
+Rules of tournament packs can also be added as plugins, see ValidationRuleRegistry.LoadPlugins. """
+
+# What the result of a validation rule depends on, see ValidationRule.dependsOn
+DEP_POINTS     = 0x01 # points costs of units and the points limit
+DEP_UNITS      = 0x02 # unit profiles and sizes in the detachments
+DEP_ITEMS      = 0x04 # magic items
+DEP_PRIMARY    = 0x08 # primary flags of the detachments
+DEP_FORCES     = 0x10 # number of detachments and their forces (alignments)
+DEP_NAMES      = 0x20 # custom names used in messages
+DEP_ALL        = 0x3f
 
 #===============================================================================
 # ValidationMessage
@@ -22,64 +38,236 @@ class ValidationMessage(object):
       self._shortDesc = shortdesc
       self._longDesc = longdesc
       self._msgType = msgtype
+      
+   def __eq__(self, other):
+      return isinstance(other, ValidationMessage) and (self._msgType, self._shortDesc, self._longDesc) == (other._msgType, other._shortDesc, other._longDesc)
+   def __ne__(self, other): return not self.__eq__(other)
+   def __hash__(self): return hash((self._msgType, self._shortDesc, self._longDesc))
+   
+   def IsCritical(self): return self._msgType == ValidationMessage.VM_CRITICAL
+   def LongDesc(self): return self._longDesc
+   def MsgType(self): return self._msgType
+   def ShortDesc(self): return self._shortDesc
+
+
+#===============================================================================
+# DetachmentFacts
+#   What the validation rules need to know about a detachment, collected in a
+#   single pass over its units.
+#===============================================================================
+class DetachmentFacts(object):
+   def __init__(self, det):
+      self.detachment = det
+      self.name = det.CustomName()
+      self.isPrimary = det.IsPrimary()
+      self.alignment = det.Choices().Alignment()
+      
+      self.nHeroes = self.nWarengs = self.nMonsters = 0
+      self.nTroops = self.nRegiments = self.nHordes = 0 # regiments and hordes/legions only if not irregular
+      self.numItems = 0
+      self.itemCounts = defaultdict(int) # item name => number of occurrences
+      self.uniqueUnitCounts = defaultdict(int) # name of unique unit => number of occurrences
+      self.specialUnitCounts = defaultdict(int) # name of hero, war engine or monster => number of occurrences
+      
+      for unit in det.ListUnits():
+         unitType = unit.UnitType()
+         if unitType in (ut.UT_HERO, ut.UT_WENG, ut.UT_MON):
+            if unitType == ut.UT_HERO: self.nHeroes += 1
+            elif unitType == ut.UT_WENG: self.nWarengs += 1
+            else: self.nMonsters += 1
+            self.specialUnitCounts[unit.Name()] += 1
+         elif unitType in (ut.UT_INF, ut.UT_LINF, ut.UT_CAV, ut.UT_LCAV):
+            sizeType = unit.SizeType()
+            if sizeType == st.ST_REG and not unit.irregular:
+               self.nRegiments += 1
+            elif sizeType in (st.ST_HRD, st.ST_LEG) and not unit.irregular:
+               self.nHordes += 1
+            elif sizeType == st.ST_TRP:
+               self.nTroops += 1
+         
+         if unit.unique: self.uniqueUnitCounts[unit.Name()] += 1
+         if unit.Item() is not None:
+            self.numItems += 1
+            self.itemCounts[unit.Item().Name()] += 1
+
+
+#===============================================================================
+# ArmyFacts
+#   Facts of all detachments of an army list plus the army-wide totals.
+#===============================================================================
+class ArmyFacts(object):
+   def __init__(self, armylist, detachmentFacts=None):
+      """ *detachmentFacts* are the facts of the army list's detachments in order, collected if None. """
+      self.armyList = armylist
+      self.pointsLimit = armylist.PointsLimit()
+      self.pointsTotal = armylist.PointsTotal()
+      self.detachments = detachmentFacts if detachmentFacts is not None else [DetachmentFacts(det) for det in armylist.ListDetachments()]
+      self.numPrimary = sum([1 for df in self.detachments if df.isPrimary])
+      
+      self.itemCounts = defaultdict(int)
+      self.uniqueUnitCounts = defaultdict(int)
+      for df in self.detachments:
+         for name, n in df.itemCounts.iteritems(): self.itemCounts[name] += n
+         for name, n in df.uniqueUnitCounts.iteritems(): self.uniqueUnitCounts[name] += n
+
+
+def ValidationKey(armylist, rules):
+   """ Key for the validation messages of an army list: its content hash, the detachment names (which appear in
+   messages and, in order, also determine the order of the messages) and the *rules*. """
+   return (armylist.ContentHash(), tuple([det.CustomName() for det in armylist.ListDetachments()]), tuple(rules))
 
 
 #===============================================================================
 # ArmyListValidator
+#   Keeps the messages of each rule (of each rule and detachment for rules
+#   which check detachments separately) until they are invalidated, so after a
+#   change only the affected rules are run again. The rules read the facts
+#   collected in one pass over the units, which are kept per detachment, too.
+#   With a *cache* (LruCache), the messages of previously validated army
+#   contents, e.g. after undo, are returned without running any rule.
+#   The evaluation time of each rule is recorded in *timings* (RuleTimings,
+#   by default those of the default registry).
 #===============================================================================
 class ArmyListValidator(object):
-   def __init__(self, armylist, rules):
+   def __init__(self, armylist, rules, cache=None, timings=None):
       self._armyList = armylist
       self._rules = rules
+      self._cache = cache
+      self._timings = timings if timings is not None else DefaultRegistry().Timings()
+      self._messages = {} # rule => messages
+      self._detachmentMessages = {} # (rule, detachment) => messages
+      self._detachmentFacts = {} # detachment => DetachmentFacts
       
+   def Cache(self): return self._cache
+   
    def Check(self):
+      """ Return the messages of all rules. Don't modify the returned list, it may be cached. """
+      cacheKey = None
+      if self._cache is not None:
+         cacheKey = ValidationKey(self._armyList, self._rules)
+         msgs = self._cache.Get(cacheKey)
+         if msgs is not None: return msgs
+      
       msgs = []
+      facts = None
+      numPerDetachment = 0
       for rule in self._rules:
-         msgs.extend( rule.Check(self._armyList) )
+         if rule.perDetachment:
+            numPerDetachment += 1
+            for det in self._armyList.ListDetachments():
+               key = (rule, det)
+               if key not in self._detachmentMessages:
+                  if facts is None: facts = self.Facts()
+                  self._detachmentMessages[key] = self._Run(rule, rule.CheckDetachment, self._detachmentFacts[det])
+               msgs.extend(self._detachmentMessages[key])
+         else:
+            if rule not in self._messages:
+               if facts is None: facts = self.Facts()
+               self._messages[rule] = self._Run(rule, rule.Check, facts)
+            msgs.extend(self._messages[rule])
+      
+      if len(self._detachmentMessages) > numPerDetachment * self._armyList.NumDetachments(): # forget removed detachments
+         dets = set(self._armyList.ListDetachments())
+         self._detachmentMessages = dict([(k, m) for k, m in self._detachmentMessages.iteritems() if k[1] in dets and k[0] in self._rules])
+      if cacheKey is not None: self._cache.Put(cacheKey, msgs)
+      return msgs
+   
+   def _Run(self, rule, check, facts):
+      start = default_timer()
+      msgs = check(facts)
+      self._timings.Record(rule.Name(), default_timer() - start)
       return msgs
+   
+   def Facts(self):
+      """ ArmyFacts of the army list, collecting only the facts of detachments which changed since the last call. """
+      detFacts = []
+      for det in self._armyList.ListDetachments():
+         df = self._detachmentFacts.get(det)
+         if df is None: df = DetachmentFacts(det)
+         detFacts.append(df)
+      self._detachmentFacts = dict([(df.detachment, df) for df in detFacts])
+      return ArmyFacts(self._armyList, detFacts)
+   
+   def Invalidate(self, changes=DEP_ALL, detachments=None):
+      """ Forget the messages of all rules depending on *changes* (DEP_* flags). For rules checking detachments
+      separately, only the messages of *detachments* are forgotten (None: of all detachments). """
+      if changes & ~DEP_POINTS: # points are taken from the army list, not from the detachment facts
+         if detachments is None: self._detachmentFacts = {}
+         else:
+            for det in detachments: self._detachmentFacts.pop(det, None)
+      
+      for rule in self._rules:
+         if rule.dependsOn & changes == 0: continue
+         if not rule.perDetachment:
+            self._messages.pop(rule, None)
+         elif detachments is None:
+            for key in [k for k in self._detachmentMessages if k[0] is rule]: del self._detachmentMessages[key]
+         else:
+            for det in detachments: self._detachmentMessages.pop((rule, det), None)
+   
+   def Rules(self): return self._rules
+   
+   def SetRules(self, rules):
+      if rules != self._rules:
+         self._rules = rules
+         self._messages = dict([(r, m) for r, m in self._messages.iteritems() if r in rules])
 
 
 #===============================================================================
 # ValidationRule (abstract)
+#   Subclasses declare what their result depends on (DEP_* flags) and either
+#   implement Check for the whole army or, if perDetachment is set,
+#   CheckDetachment, which is then called for each detachment separately.
+#   Both get the facts collected by the validator instead of the army list.
 #===============================================================================
 class ValidationRule(object):
+   dependsOn = DEP_ALL
+   perDetachment = False
+   
    def __init__(self, name):
       self._name = name
       
-   def Check(self, obj):
+   def Check(self, facts):
+      """ Return the ValidationMessages for the ArmyFacts *facts*. """
+      if not self.perDetachment: raise NotImplementedError()
+      msgs = []
+      for df in facts.detachments:
+         msgs.extend(self.CheckDetachment(df))
+      return msgs
+   
+   def CheckDetachment(self, facts):
+      """ Return the ValidationMessages for the DetachmentFacts *facts*. """
       raise NotImplementedError()
-      
+   
+   def Name(self): return self._name
+
 
-#===============================================================================
-# PointsLimitFulfilledRule
-#===============================================================================
 class PointsLimitFulfilledRule(ValidationRule):
+   dependsOn = DEP_POINTS
+   
    def __init__(self):
       ValidationRule.__init__(self, "PointsLimitFulfilled")
    
-   def Check(self, obj):
+   def Check(self, facts):
       msgs = []
-      limit = obj.PointsLimit()
-      total = obj.PointsTotal()
+      limit = facts.pointsLimit
+      total = facts.pointsTotal
       if total > limit: msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Points limit exceeded (%d/%d pts)" % (total, limit),
             "The army list has a limit of %d points, but you fielded troops for a total of %d points (%d too many)." % (limit, total, total-limit)))
       elif total < limit: msgs.append(ValidationMessage(ValidationMessage.VM_INFO, "%d leftover points." % (limit-total),
             "You have fielded troops for %d points, but the army list allows %d points. You can field another %d points worth of troops." % (total, limit, limit-total)))
       return msgs
-      
 
-#===============================================================================
-# NumberOfPrimaryDetachmentsOkRule
-#===============================================================================
+
 class NumberOfPrimaryDetachmentsOkRule(ValidationRule):
+   dependsOn = DEP_PRIMARY | DEP_FORCES
+   
    def __init__(self):
       ValidationRule.__init__(self, "NumberOfPrimaryDetachmentsOk")
    
-   def Check(self, obj):
+   def Check(self, facts):
       msgs = []
-      numPrimary = 0
-      for det in obj.ListDetachments():
-         if det.IsPrimary(): numPrimary+=1
+      numPrimary = facts.numPrimary
       if numPrimary == 0: msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "No primary detachment",
             "Each army list must have exactly one primary detachment. Click the checkbox in one of your detachments to make it primary."))
       elif numPrimary > 1: msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Multiple (%d) primary detachments" % numPrimary,
@@ -89,92 +277,63 @@ class NumberOfPrimaryDetachmentsOkRule(ValidationRule):
    
 class NumberOfNonRegimentsOkRule(ValidationRule):
    """ Checks if the allowed number of Monsters, War engines and Heroes is not exceeded. """ 
+   dependsOn = DEP_UNITS | DEP_NAMES
+   perDetachment = True
+   
    def __init__(self):
       ValidationRule.__init__(self, "NumberOfNonRegimentsOk")
    
-   def Check(self, obj):
+   def CheckDetachment(self, facts):
       msgs = []
-      for det in obj.ListDetachments():
-         nHeroes = 0
-         nWarengs = 0
-         nMonsters = 0
-         
-         nTroops = 0
-         nRegiments = 0
-         nHordes = 0
-
-         for unit in det.ListUnits(): # count unit type occasions
-            if unit.UnitType() == ut.UT_HERO:
-               nHeroes += 1
-            elif unit.UnitType() == ut.UT_WENG:
-               nWarengs += 1
-            elif unit.UnitType() == ut.UT_MON:
-               nMonsters += 1
-            elif unit.UnitType() in (ut.UT_INF, ut.UT_LINF, ut.UT_CAV, ut.UT_LCAV):
-               if unit.SizeType() == st.ST_REG and not unit.irregular:
-                  nRegiments += 1
-               elif unit.SizeType() in (st.ST_HRD, st.ST_LEG) and not unit.irregular:
-                  nHordes += 1
-               elif unit.SizeType() == st.ST_TRP:
-                  nTroops += 1
-                  
-         # hordes allow one of each
-         excessiveHeroSlotsUsed = max(nHeroes - nHordes, 0)
-         excessiveWengSlotsUsed = max(nWarengs - nHordes, 0)
-         excessiveMonsterSlotsUsed = max(nMonsters - nHordes, 0)
-         
-         # regiments allow any one (1) slot each
-         if excessiveHeroSlotsUsed+excessiveMonsterSlotsUsed+excessiveWengSlotsUsed > nRegiments:
-            msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "%s: More Heroes/War engines/Monsters than allowed." % det.CustomName(),
-                  "For each non-irregular horde/legion in a detachment there may be 1 Hero, 1 War engine, AND 1 Monster; plus 1 Hero, War engine, OR Monster for each regiment.\n" +
-                  "You may include %d Heroes, War engines, and Monsters plus another %d of any kind." % (nHordes, nRegiments)))
-         
-         # regiments allow 2 troops each, while hordes/legions allow 4
-         if nTroops > 2*nRegiments + 4*nHordes:
-            msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "%s: Too many troops fielded, need more regiments or hordes." % det.CustomName(),
-                  "The number of troops (%d) in the detachment must not exceed %d.\n(Two per regiment plus four per horde or legion)." % (nTroops, 2*nRegiments + 4*nHordes)))          
+      nRegiments, nHordes, nTroops = facts.nRegiments, facts.nHordes, facts.nTroops
+      
+      # hordes allow one of each
+      excessiveHeroSlotsUsed = max(facts.nHeroes - nHordes, 0)
+      excessiveWengSlotsUsed = max(facts.nWarengs - nHordes, 0)
+      excessiveMonsterSlotsUsed = max(facts.nMonsters - nHordes, 0)
+      
+      # regiments allow any one (1) slot each
+      if excessiveHeroSlotsUsed+excessiveMonsterSlotsUsed+excessiveWengSlotsUsed > nRegiments:
+         msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "%s: More Heroes/War engines/Monsters than allowed." % facts.name,
+               "For each non-irregular horde/legion in a detachment there may be 1 Hero, 1 War engine, AND 1 Monster; plus 1 Hero, War engine, OR Monster for each regiment.\n" +
+               "You may include %d Heroes, War engines, and Monsters plus another %d of any kind." % (nHordes, nRegiments)))
+      
+      # regiments allow 2 troops each, while hordes/legions allow 4
+      if nTroops > 2*nRegiments + 4*nHordes:
+         msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "%s: Too many troops fielded, need more regiments or hordes." % facts.name,
+               "The number of troops (%d) in the detachment must not exceed %d.\n(Two per regiment plus four per horde or legion)." % (nTroops, 2*nRegiments + 4*nHordes)))          
       
       return msgs
-               
-
-#===============================================================================
-# AlliedAlignmentsOkRule
-#===============================================================================
+   
+   
 class AlliedAlignmentsOkRule(ValidationRule):
+   dependsOn = DEP_PRIMARY | DEP_FORCES
+   
    def __init__(self):
       ValidationRule.__init__(self, "AlliedAlignmentsOk")
    
-   def Check(self, obj):
+   def Check(self, facts):
       msgs = []
-      failed = False
-      for det in obj.ListDetachments():
-         if failed: break
-         if not det.IsPrimary(): continue # only check for primary detachments
-         for alliedDet in obj.ListDetachments():
-            if det is alliedDet: continue
-            if (det.Choices().Alignment()==AL_GOOD and alliedDet.Choices().Alignment()==AL_EVIL) or \
-                        (det.Choices().Alignment()==AL_EVIL and alliedDet.Choices().Alignment()==AL_GOOD):
-               msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Good and Evil forces can't be allies.",
-                  "Your army list contains both good and evil forces, allied with each other - this is not allowed."))
-               failed = True
-               break
+      for df in facts.detachments:
+         if not df.isPrimary: continue # only check for primary detachments
+         opposed = { AL_GOOD: AL_EVIL, AL_EVIL: AL_GOOD }.get(df.alignment)
+         if opposed is not None and any([allied.alignment == opposed for allied in facts.detachments if allied is not df]):
+            msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Good and Evil forces can't be allies.",
+               "Your army list contains both good and evil forces, allied with each other - this is not allowed."))
+            break
       return msgs
    
 
 class MagicArtefactsAreUniqueRule(ValidationRule):
    """ Check if each magic artefact is used only once in the army. """
+   dependsOn = DEP_ITEMS
+   
    def __init__(self):
       ValidationRule.__init__(self, "MagicArtefactsAreUnique")
    
-   def Check(self, obj):
+   def Check(self, facts):
       msgs = []
-      itemmap = defaultdict(int) # {str:int} map with ItemName=>number of occurrences entries
-      for det in obj.ListDetachments():
-         for unit in det.ListUnits():
-            if unit.Item() is not None:
-               itemmap[unit.Item().Name()] += 1
-      
-      for itemName, occs in itemmap.iteritems():
+      for itemName, occs in facts.itemCounts.iteritems():
          if occs > 1:
             msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Item '%s' used more than once. (%d times)" % (itemName, occs),
                                           "Each magic artefact may only be used once in an army list, but %s is present %d times." % (itemName, occs)))
@@ -184,18 +343,14 @@ class MagicArtefactsAreUniqueRule(ValidationRule):
 class UniqueUnitsAreUniqueRule(ValidationRule):
    """ Check if units flagged as unique actually are unique in the army, regardless of their detachment.
    (E.g. The Green Lady might occur in both Elves and Forces of Nature detachments.) """
+   dependsOn = DEP_UNITS
+   
    def __init__(self):
       ValidationRule.__init__(self, "UniqueUnitsAreUnique")
       
-   def Check(self, obj):
+   def Check(self, facts):
       msgs = []
-      uniqmap = defaultdict(int) # {str:int} map with UnitName=>number of occurrences entries
-      for det in obj.ListDetachments():
-         for unit in det.ListUnits():
-            if unit.unique:
-               uniqmap[unit.Name()] += 1
-               
-      for unitName, occs in uniqmap.iteritems():
+      for unitName, occs in facts.uniqueUnitCounts.iteritems():
          if occs > 1:
             msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Unique unit '%s' included more than once." % (unitName),
                                           "A unique unit may only occur once in the whole army list, but %s is present %d times." % (unitName, occs)))
@@ -205,21 +360,19 @@ class UniqueUnitsAreUniqueRule(ValidationRule):
 class CokSpecialUnitsMaxThreeTimesRule(ValidationRule):
    """ Check if units flagged as unique actually are unique in the army, regardless of their detachment.
    (E.g. The Green Lady might occur in both Elves and Forces of Nature detachments.) """
+   dependsOn = DEP_UNITS | DEP_PRIMARY
+   perDetachment = True
+   
    def __init__(self):
       ValidationRule.__init__(self, "COK_SpecialUnitsMaxThreeTimes")
       
-   def Check(self, obj):
+   def CheckDetachment(self, facts):
       msgs = []
-      for det in obj.ListDetachments():
-         maxn = 3 if det.IsPrimary() else 1
-         unitMap = defaultdict(int)
-         for unit in det.ListUnits():
-            if unit.UnitType() in (ut.UT_HERO, ut.UT_WENG, ut.UT_MON):
-               unitMap[unit.Name()] += 1
-         for unitName, occs in unitMap.iteritems():
-            if occs > maxn:
-               msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Unit %s chosen too often: Only %d allowed, but you fielded %d." % (unitName, maxn, occs),
-                                            "In a primary detachment, each Hero, War Engine, or Monster may only appear up to three times. In an allied detachment, only one occurrence is allowed."))
+      maxn = 3 if facts.isPrimary else 1
+      for unitName, occs in facts.specialUnitCounts.iteritems():
+         if occs > maxn:
+            msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Unit %s chosen too often: Only %d allowed, but you fielded %d." % (unitName, maxn, occs),
+                                         "In a primary detachment, each Hero, War Engine, or Monster may only appear up to three times. In an allied detachment, only one occurrence is allowed."))
       
       return msgs
 
@@ -227,22 +380,153 @@ class CokSpecialUnitsMaxThreeTimesRule(ValidationRule):
 class CokNoMagicItemsForAlliesRule(ValidationRule):
    """ Check if units flagged as unique actually are unique in the army, regardless of their detachment.
    (E.g. The Green Lady might occur in both Elves and Forces of Nature detachments.) """
+   dependsOn = DEP_ITEMS | DEP_PRIMARY | DEP_NAMES
+   perDetachment = True
+   
    def __init__(self):
       ValidationRule.__init__(self, "COK_NoMagicItemsForAllies")
       
-   def Check(self, obj):
+   def CheckDetachment(self, facts):
       msgs = []
-      for det in obj.ListDetachments():
-         if not det.IsPrimary():
-            for unit in det.ListUnits():
-               if unit.Item() is not None:
-                  msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Allies may not be given magic artifacts (detachment %s)" % (det.CustomName()),
-                                            "The detachment '%s' has at least one magic artifact, but as an allied detachment it may not have any."))
-                  break
+      if not facts.isPrimary and facts.numItems > 0:
+         msgs.append(ValidationMessage(ValidationMessage.VM_CRITICAL, "Allies may not be given magic artifacts (detachment %s)" % (facts.name),
+                                       "The detachment '%s' has at least one magic artifact, but as an allied detachment it may not have any."))
       
       return msgs
 
 ALL_VALIDATIONRULES = (PointsLimitFulfilledRule(), NumberOfPrimaryDetachmentsOkRule(), AlliedAlignmentsOkRule(),
                        NumberOfNonRegimentsOkRule(), MagicArtefactsAreUniqueRule(), UniqueUnitsAreUniqueRule())
 
-COK_ADDITIONALRULES = (CokSpecialUnitsMaxThreeTimesRule(), CokNoMagicItemsForAlliesRule())
\ No newline at end of file
+COK_ADDITIONALRULES = (CokSpecialUnitsMaxThreeTimesRule(), CokNoMagicItemsForAlliesRule())
+
+
+#===============================================================================
+# RuleTimings
+#   Number of calls and evaluation times of validation rules by rule name.
+#   Keeps the most recent *maxSamples* times of each rule for percentiles.
+#===============================================================================
+class RuleTimings(object):
+   def __init__(self, maxSamples=1000):
+      self._maxSamples = maxSamples
+      self._calls = defaultdict(int)
+      self._totals = defaultdict(float)
+      self._samples = {} # rule name => deque of recent times
+
+   def Calls(self, name): return self._calls.get(name, 0)
+
+   def Clear(self):
+      self._calls.clear()
+      self._totals.clear()
+      self._samples.clear()
+
+   def ListRuleNames(self):
+      """ Names of all rules with recorded calls, the one with the highest total time first. """
+      return sorted(self._calls, key=lambda n: -self._totals[n])
+
+   def Percentile(self, name, p):
+      """ Time below which *p* percent of the recent calls of rule *name* took (nearest rank), 0 if there are none. """
+      samples = sorted(self._samples.get(name, ()))
+      if len(samples) == 0: return 0.
+      return samples[max(int(round(p / 100. * len(samples))) - 1, 0)]
+
+   def Record(self, name, seconds):
+      self._calls[name] += 1
+      self._totals[name] += seconds
+      try: self._samples[name].append(seconds)
+      except KeyError: self._samples[name] = deque([seconds], self._maxSamples)
+
+   def Report(self):
+      """ List of (rule name, calls, total, mean, median, 95th percentile) with times in seconds, the rule with
+      the highest total time first. """
+      return [(n, self._calls[n], self._totals[n], self._totals[n] / self._calls[n], self.Percentile(n, 50), self.Percentile(n, 95))
+              for n in self.ListRuleNames()]
+
+   def TotalTime(self, name): return self._totals.get(name, 0.)
+
+
+#===============================================================================
+# ValidationRuleRegistry
+#   Validation rules by name and named sets of them, e.g. the standard rules
+#   and those of a tournament. Rule sets can be used with some of their rules
+#   disabled, e.g. with the --disable option of validate.py.
+#===============================================================================
+RS_STANDARD = "standard"
+RS_COK = "cok" # Clash of Kings tournament rules
+
+class ValidationRuleRegistry(object):
+   def __init__(self):
+      self._rules = [] # in order of registration, which is the order of their messages
+      self._rulesByName = {}
+      self._sets = {} # set name => names of rules
+      self._plugins = set() # absolute paths of the plugins loaded
+      self._timings = RuleTimings()
+
+   def _Copy(self):
+      """ Registry with the same rules and sets, to register into without changing this one. """
+      registry = ValidationRuleRegistry()
+      registry._rules = list(self._rules)
+      registry._rulesByName = dict(self._rulesByName)
+      registry._sets = dict([(name, set(names)) for name, names in self._sets.iteritems()])
+      return registry
+
+   def DefineSet(self, name, ruleNames):
+      """ Define the rule set *name* with the rules *ruleNames*, which may also contain names of other sets. """
+      names = set()
+      for n in ruleNames:
+         if n in self._sets: names.update(self._sets[n])
+         elif n in self._rulesByName: names.add(n)
+         else: raise KeyError("Unknown validation rule or rule set %s." % n)
+      self._sets[name] = names
+
+   def ListRules(self): return self._rules
+   def ListSetNames(self): return sorted(self._sets)
+
+   def LoadPlugins(self, directory):
+      """ Load the rule plugins (.py files) in *directory*. Each has to define a function RegisterRules(registry)
+      which registers its rules and sets. A plugin raising an exception adds none of its rules and sets, plugins
+      loaded before are skipped. Returns the names of the plugins loaded. """
+      loaded = []
+      if not os.path.isdir(directory): return loaded
+      for fn in sorted(os.listdir(directory)):
+         name, ext = os.path.splitext(fn)
+         path = os.path.abspath(os.path.join(directory, fn))
+         if ext != ".py" or fn.startswith(".") or path in self._plugins: continue
+         try:
+            module = imp.load_source("kowsim_validationplugin_%s" % name, path)
+            staged = self._Copy()
+            module.RegisterRules(staged)
+         except Exception as e:
+            sys.stderr.write("Error while loading validation rules %s: %s\n" % (fn, e))
+         else:
+            self._rules, self._rulesByName, self._sets = staged._rules, staged._rulesByName, staged._sets
+            self._plugins.add(path)
+            loaded.append(name)
+      return loaded
+
+   def Register(self, rule, sets=()):
+      """ Register *rule* and add it to the rule *sets* (names), which are created if necessary. """
+      if rule.Name() in self._rulesByName: raise ValueError("Validation rule %s registered twice." % rule.Name())
+      self._rules.append(rule)
+      self._rulesByName[rule.Name()] = rule
+      for s in sets:
+         self._sets.setdefault(s, set()).add(rule.Name())
+
+   def Rule(self, name): return self._rulesByName[name]
+
+   def Rules(self, setName=RS_STANDARD, disabled=()):
+      """ Tuple of the rules in set *setName* except those named in *disabled*. """
+      names = self._sets[setName]
+      return tuple([r for r in self._rules if r.Name() in names and r.Name() not in disabled])
+
+   def Timings(self):
+      """ RuleTimings of all validators which don't record their own. """
+      return self._timings
+
+
+_defaultRegistry = ValidationRuleRegistry()
+for rule in ALL_VALIDATIONRULES: _defaultRegistry.Register(rule, (RS_STANDARD, RS_COK))
+for rule in COK_ADDITIONALRULES: _defaultRegistry.Register(rule, (RS_COK, ))
+
+def DefaultRegistry():
+   """ Registry of the built-in rules plus those of the plugins loaded. """
+   return _defaultRegistry
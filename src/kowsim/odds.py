@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# odds.py
+#===============================================================================
+#   Exact probabilities for roll commands such as '20 4+ 4+r', i.e. chains of
+#   individual rolls where only the passed dice of one stage are rolled again
+#   in the next stage.
+#===============================================================================
+from util.cache import LruCache
+
+
+#===============================================================================
+# RollDistribution
+#   Probability mass function of the number of successes of a roll.
+#===============================================================================
+class RollDistribution(object):
+   def __init__(self, pmf):
+      self._pmf = tuple(pmf)
+
+      # tails[k] holds P(X >= k)
+      tails = [0.] * (len(self._pmf)+1)
+      for k in range(len(self._pmf)-1, -1, -1):
+         tails[k] = tails[k+1] + self._pmf[k]
+      self._tails = tuple(tails)
+
+   def __repr__(self):
+      return "RollDistribution(%d dice, E=%.2f)" % (self.MaxSuccesses(), self.Expected())
+
+   def AtLeast(self, k):
+      """ Probability to roll at least *k* successes. """
+      if k <= 0: return 1.
+      elif k >= len(self._tails): return 0.
+      return self._tails[k]
+
+   def AtMost(self, k):
+      """ Probability to roll at most *k* successes. """
+      return 1. - self.AtLeast(k+1)
+
+   def Expected(self):
+      return sum(k*p for k, p in enumerate(self._pmf))
+
+   def MaxSuccesses(self): return len(self._pmf)-1
+   def Pmf(self): return self._pmf
+
+   def Probability(self, k):
+      """ Probability to roll exactly *k* successes. """
+      if k < 0 or k >= len(self._pmf): return 0.
+      return self._pmf[k]
+
+   def Tails(self):
+      """ Return the tuple of P(X >= k) for k = 0 ... MaxSuccesses(). """
+      return self._tails[:-1]
+
+
+#===============================================================================
+# Helpers
+#===============================================================================
+def PassChance(sides, threshold, reroll=False):
+   """ Chance of a single die with *sides* sides to roll *threshold* or more, possibly rerolling a failure. """
+   p = float(sides - threshold + 1) / sides
+   p = min(max(p, 0.), 1.)
+   if reroll:
+      p += (1.-p) * p
+   return p
+
+def BinomialPmf(n, p):
+   """ Return the probability mass function of a binomial distribution B(n, p) as a list. """
+   if p <= 0.: return [1.] + [0.]*n
+   elif p >= 1.: return [0.]*n + [1.]
+
+   # start at the mode and walk outwards, so (1-p)**n can't underflow for large n, then normalize
+   pmf = [0.] * (n+1)
+   mode = min(int((n+1) * p), n)
+   pmf[mode] = 1.
+   ratio = p / (1.-p)
+   for k in range(mode, n):
+      pmf[k+1] = pmf[k] * (n-k) / (k+1) * ratio
+   for k in range(mode, 0, -1):
+      pmf[k-1] = pmf[k] * k / (n-k+1) / ratio
+   total = sum(pmf)
+   return [x / total for x in pmf]
+
+
+#===============================================================================
+# DistributionForChain
+#===============================================================================
+_chainCache = LruCache(1024) # (numDice, stages) => RollDistribution
+MaxChainDice = 100000 # the distribution holds one probability per possible number of successes
+
+def DistributionForChain(numDice, stages):
+   """ Return the exact RollDistribution of final successes for a roll of *numDice* dice
+   passing through the given chain of stages.
+
+   :param stages: sequence of (sides, threshold, reroll) tuples, one per individual roll
+
+   Every stage is a binomial trial on the dice which passed the previous stage. As the
+   passed dice of a binomial are binomial again, the whole chain is B(numDice, p1*p2*...),
+   where each pi already includes the improved chance of a reroll.
+
+   Raises ValueError for more than MaxChainDice dice.
+   """
+   if numDice > MaxChainDice:
+      raise ValueError("Can't compute the odds of more than %d dice (%d given)." % (MaxChainDice, numDice))
+   key = (numDice, tuple(stages))
+   dist = _chainCache.Get(key)
+   if dist is not None: return dist
+
+   p = 1.
+   for sides, threshold, reroll in key[1]:
+      p *= PassChance(sides, threshold, reroll)
+
+   dist = RollDistribution(BinomialPmf(numDice, p))
+   _chainCache.Put(key, dist)
+   return dist
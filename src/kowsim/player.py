@@ -2,6 +2,7 @@ from PySide import QtGui, QtCore
 from PySide.QtCore import Qt
 
 class Player:
-   def __init__(self, name="Player 1", color=QtGui.QColor(34,134,219)):
+   def __init__(self, name="Player 1", color=QtGui.QColor(34,134,219), rng=None):
       self.name = name
-      self.color = color
\ No newline at end of file
+      self.color = color
+      self.rng = rng # rng.RandomStream used for this player's dice
\ No newline at end of file
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# rng.py
+#===============================================================================
+import hashlib
+import random
+from array import array
+
+try:
+   import numpy
+except ImportError: # numpy is optional, streams fall back to random.Random
+   numpy = None
+
+
+#===============================================================================
+# RandomStream
+#   Seeded source of dice results, e.g. one per game, player or simulation
+#   worker. A stream is identified by its master seed and a path of keys, so
+#   it can be split into independent substreams (Spawn/Split) which do not
+#   correlate with their parent or their siblings.
+#   Every die consumes exactly one uniform draw, thus the position of a roll
+#   within the stream (number of dice drawn before it) together with the
+#   stream's seed and path is enough to regenerate its results later on.
+#   Replays have to use the same backend (numpy or random.Random) as the
+#   original rolls.
+#===============================================================================
+class RandomStream(object):
+   def __init__(self, seed=None, path=()):
+      if seed is None: seed = random.SystemRandom().getrandbits(64)
+      self._seed = seed
+      self._path = tuple(path)
+      self._position = 0
+      self._gen = self._NewGenerator()
+
+   def __repr__(self):
+      return "RandomStream(%d, %s, position %d)" % (self._seed, "/".join([str(k) for k in self._path]), self._position)
+
+   def __getstate__(self):
+      return (self._seed, self._path, self._position)
+
+   def __setstate__(self, state):
+      self._seed, self._path, position = state
+      self._position = 0
+      self._gen = self._NewGenerator()
+      self._Skip(position)
+
+   def _DerivedSeed(self):
+      """ Hash master seed and path into a 128 bit seed for this stream. """
+      key = "%d|%s" % (self._seed, "|".join([str(k) for k in self._path]))
+      return int(hashlib.sha1(key).hexdigest()[:32], 16)
+
+   def _NewGenerator(self):
+      seed = self._DerivedSeed()
+      if numpy is not None:
+         return numpy.random.RandomState([(seed >> (32*i)) & 0xffffffff for i in range(4)])
+      return random.Random(seed)
+
+   def _Uniform(self, n):
+      self._position += n
+      if numpy is not None:
+         return self._gen.random_sample(n)
+      rnd = self._gen.random
+      return [rnd() for i in xrange(n)]
+
+   def _Skip(self, n):
+      while n > 0:
+         k = min(n, 1000000)
+         self._Uniform(k)
+         n -= k
+
+   # accessors
+   def Path(self): return self._path
+   def Position(self): return self._position
+   def Seed(self): return self._seed
+   def Token(self):
+      """ Return (seed, path, position), enough to recreate this stream at its current position. """
+      return (self._seed, self._path, self._position)
+
+   # drawing
+   def Die(self, sides):
+      """ Roll a single die with *sides* sides. """
+      return int(self._Uniform(1)[0] * sides) + 1
+
+   def Dice(self, sides, numDice):
+      """ Roll *numDice* dice with *sides* sides and return the faces as a compact array. """
+      u = self._Uniform(numDice)
+      if numpy is not None:
+         return (u * sides).astype(numpy.uint16 if sides <= 0xffff else numpy.uint32) + 1
+      return array('H' if sides <= 0xffff else 'L', [int(x * sides) + 1 for x in u])
+
+   # replay
+   def Replay(self, position, sides, numDice):
+      """ Regenerate the faces of *numDice* dice with *sides* sides which were rolled at *position*
+      of this stream. Does not change the position of this stream. """
+      stream = RandomStream(self._seed, self._path)
+      stream._Skip(position)
+      return stream.Dice(sides, numDice)
+
+   def Restart(self):
+      """ Rewind the stream to its beginning. """
+      self._position = 0
+      self._gen = self._NewGenerator()
+
+   # splitting
+   def Spawn(self, key):
+      """ Return the independent substream identified by *key* (e.g. a player name or worker index). """
+      return RandomStream(self._seed, self._path + (key, ))
+
+   def Split(self, n):
+      """ Return *n* independent substreams, e.g. one per process pool worker. """
+      return [self.Spawn(i) for i in range(n)]
+
+   @staticmethod
+   def FromToken(token):
+      seed, path, position = token
+      stream = RandomStream(seed, path)
+      stream._Skip(position)
+      return stream
+
+
+#===============================================================================
+# default stream
+#   Used by all dice rolls which do not get a stream of their own.
+#===============================================================================
+_defaultStream = RandomStream()
+
+def DefaultStream(): return _defaultStream
+
+def SetDefaultStream(stream):
+   global _defaultStream
+   _defaultStream = stream
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# rollevents.py
+#===============================================================================
+#   Structured events for every roll done by dice.RollHandler. Events are kept
+#   in a bounded ring buffer and passed on to any number of subscribers (chat
+#   history, log files, statistics). Formatting is left to the subscribers, so
+#   without subscribers rolling does no formatting or I/O at all.
+#===============================================================================
+import codecs
+import time
+from collections import deque, defaultdict
+
+from odds import PassChance
+
+
+#===============================================================================
+# RollEvent
+#   One stage of a roll command, e.g. the '4+r' part of '20 4+ 4+r'.
+#   For plain rolls without a score to pass, stage and threshold are None.
+#===============================================================================
+class RollEvent(object):
+   __slots__ = ("command", "source", "stage", "numDice", "threshold", "reroll", "faces", "positions", "successes", "timestamp")
+
+   def __init__(self, command, source, stage, numDice, threshold, reroll, faces, positions, successes):
+      self.command = command # normalized command string
+      self.source = source # e.g. the name of the rolling player, may be None
+      self.stage = stage # index of the individual roll within the command
+      self.numDice = numDice
+      self.threshold = threshold
+      self.reroll = reroll
+      self.faces = faces # list of FaceHistograms, the first roll and a potential reroll
+      self.positions = positions # stream positions of the histograms in *faces*
+      self.successes = successes
+      self.timestamp = time.time()
+
+   def __repr__(self):
+      return "RollEvent(%s, stage %s, %d successes)" % (self.command, self.stage, self.successes)
+
+   def Sides(self): return self.faces[0].sides
+
+   def ToString(self):
+      if self.threshold is None:
+         return "Rolling %d dice: %s" % (self.numDice, self.faces[0].ToString())
+      s = "Rolling %d dice on a %d+: %s" % (self.numDice, self.threshold, self.faces[0].ToString())
+      if len(self.faces) > 1:
+         s += ", rerolling %d: %s" % (self.faces[1].Total(), self.faces[1].ToString())
+      return s + " (%d successes)" % self.successes
+
+
+#===============================================================================
+# RollEventBus
+#===============================================================================
+class RollEventBus(object):
+   def __init__(self, capacity=0):
+      """ Keep the last *capacity* events for History(). A bus without history and subscribers is inactive. """
+      self._history = deque(maxlen=capacity)
+      self._subscribers = []
+      self.active = capacity > 0 # publishers may skip building events for inactive busses
+
+   def _UpdateActive(self):
+      self.active = self._history.maxlen > 0 or len(self._subscribers) > 0
+
+   def History(self):
+      """ Return the most recent events, oldest first. """
+      return list(self._history)
+
+   def Publish(self, event):
+      if self._history.maxlen: self._history.append(event)
+      for subscriber in self._subscribers:
+         subscriber(event)
+
+   def Subscribe(self, subscriber):
+      """ Register a callable which is called with every published RollEvent. """
+      if subscriber not in self._subscribers:
+         self._subscribers.append(subscriber)
+      self._UpdateActive()
+
+   def Unsubscribe(self, subscriber):
+      self._subscribers.remove(subscriber)
+      self._UpdateActive()
+
+
+_defaultBus = RollEventBus()
+
+def DefaultBus(): return _defaultBus
+
+
+#===============================================================================
+# RollFileLogger
+#   Subscriber appending one line per event to a log file.
+#===============================================================================
+class RollFileLogger(object):
+   def __init__(self, filename):
+      self._file = codecs.open(filename, 'a', encoding='UTF-8')
+
+   def __call__(self, event):
+      self._file.write("%s\t%s\t%s\t%s\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event.timestamp)),
+                                            event.source or "-", event.command, event.ToString()))
+      self._file.flush()
+
+   def Close(self):
+      self._file.close()
+
+
+#===============================================================================
+# RollStatistics
+#   Subscriber keeping running statistics per source (player): how often each
+#   face came up, and the luck, i.e. successes rolled minus successes expected.
+#===============================================================================
+class RollStatistics(object):
+   def __init__(self):
+      self._faceCounts = defaultdict(dict) # source => { sides => [count per face] }
+      self._successes = defaultdict(int)
+      self._expected = defaultdict(float)
+
+   def __call__(self, event):
+      sides = event.Sides()
+      counts = self._faceCounts[event.source].get(sides)
+      if counts is None:
+         counts = self._faceCounts[event.source][sides] = [0] * (sides+1)
+      for hist in event.faces:
+         for face in range(1, sides+1):
+            counts[face] += hist.counts[face]
+
+      if event.threshold is not None:
+         self._successes[event.source] += event.successes
+         self._expected[event.source] += event.numDice * PassChance(sides, event.threshold, event.reroll)
+
+   def ExpectedSuccesses(self, source=None): return self._expected[source]
+
+   def FaceFrequencies(self, source=None, sides=6):
+      """ Return the relative frequency of each face (index 0 unused) rolled by *source*. """
+      counts = self._faceCounts[source].get(sides, [0] * (sides+1))
+      total = float(sum(counts))
+      return [c / total if total > 0 else 0. for c in counts]
+
+   def Luck(self, source=None):
+      """ Successes rolled minus successes expected. Positive values mean better than average rolls. """
+      return self._successes[source] - self._expected[source]
+
+   def ListSources(self): return self._faceCounts.keys()
+   def Successes(self, source=None): return self._successes[source]
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+# rollservice.py
+#===============================================================================
+#   Dice authority for several clients sharing one machine. The service
+#   accepts roll commands over a local TCP or Unix socket, one JSON object per
+#   line, and answers with the structured results of the roll:
+#
+#     > {"id": 1, "session": "table1/Player 1", "command": "20 4+ 4+r"}
+#     < {"id": 1, "session": "table1/Player 1", "command": "20 4+ 4+r",
+#        "stream": [seed, path, position], "stages": [{"stage": 0, ...}, ...]}
+#
+#   Every session rolls with its own substream of the service's seeded master
+#   stream. Requests of all connections are put into one queue and rolled by a
+#   single worker in batches, so rolls are never interleaved and the replies
+#   for a connection go out with a single write per batch. Invalid commands
+#   and rolls of too many dice are rejected before they are queued, with an
+#   "error" entry in the reply.
+#===============================================================================
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+
+from dice import CompileRoll, RollHandler, FaceHistogram
+from rng import RandomStream
+from rollevents import RollEvent, RollEventBus, DefaultBus
+
+
+def ParseAddress(s):
+   """ Parse 'host:port' into a TCP address tuple. Anything else is taken as the path of a Unix socket. """
+   host, sep, port = s.rpartition(":")
+   if sep and port.isdigit():
+      return (host or "127.0.0.1", int(port))
+   return s
+
+def _EventToDict(event):
+   return { "stage": event.stage, "numDice": event.numDice, "threshold": event.threshold, "reroll": event.reroll,
+            "sides": event.Sides(), "faces": [list(hist.counts[1:]) for hist in event.faces],
+            "positions": event.positions, "successes": event.successes }
+
+def EventsFromResult(result, source=None):
+   """ Convert the stages of a roll result received from the service back to RollEvents. """
+   events = []
+   for st in result["stages"]:
+      faces = []
+      for counts in st["faces"]:
+         hist = FaceHistogram(st["sides"])
+         for face, n in enumerate(counts):
+            hist.counts[face+1] = n
+         faces.append(hist)
+      events.append(RollEvent(result["command"], source, st["stage"], st["numDice"], st["threshold"], st["reroll"],
+                              faces, st["positions"], st["successes"]))
+   return events
+
+
+#===============================================================================
+# RollService
+#===============================================================================
+class _ThreadingTCPServer(SocketServer.ThreadingTCPServer):
+   allow_reuse_address = True
+   daemon_threads = True
+
+if hasattr(SocketServer, "ThreadingUnixStreamServer"):
+   class _ThreadingUnixServer(SocketServer.ThreadingUnixStreamServer):
+      daemon_threads = True
+else: _ThreadingUnixServer = None
+
+
+class _RollRequestHandler(SocketServer.StreamRequestHandler):
+   """ One per connection. Reads requests and queues them, the replies are sent by the service's worker. """
+   def setup(self):
+      SocketServer.StreamRequestHandler.setup(self)
+      self._cond = threading.Condition()
+      self._pending = 0
+      self.defaultSession = "%s" % (self.client_address, ) if self.client_address else "connection %d" % id(self)
+
+   def handle(self):
+      service = self.server.service
+      while True:
+         line = self.rfile.readline()
+         if not line: break
+         line = line.strip()
+         if not line: continue
+
+         try:
+            request = json.loads(line)
+            if not isinstance(request, dict): raise ValueError()
+         except ValueError:
+            self._Write(json.dumps({ "error": "Invalid request, expected a JSON object." }) + "\n")
+            continue
+         request.setdefault("session", self.defaultSession)
+         plan, error = service._Compile(request)
+
+         # rejected requests are queued as well, so the replies keep the order of the requests
+         with self._cond: self._pending += 1
+         service._queue.put((self, request, plan, error))
+
+      # wait for the worker before closing the connection
+      with self._cond:
+         while self._pending > 0: self._cond.wait()
+
+   def _Write(self, data):
+      try:
+         self.wfile.write(data)
+         self.wfile.flush()
+      except socket.error: pass # client is gone
+
+   def SendReplies(self, replies):
+      data = "".join([json.dumps(r) + "\n" for r in replies])
+      with self._cond:
+         self._Write(data)
+         self._pending -= len(replies)
+         self._cond.notify_all()
+
+
+class RollService(object):
+   def __init__(self, address=("127.0.0.1", 0), seed=None, maxBatchSize=256, maxDice=100000):
+      self.rng = RandomStream(seed) # master stream, each session rolls with a substream of it
+      self.eventBus = RollEventBus() # all rolls done by the service, e.g. to attach a RollFileLogger
+      self.eventBus.Subscribe(self._CollectEvent)
+      self.maxBatchSize = maxBatchSize
+      self.maxDice = maxDice # per roll, larger rolls would block the worker and with it all sessions
+      self.numRequests = 0
+      self.numBatches = 0
+
+      self._streams = {}
+      self._queue = Queue.Queue()
+      self._collected = None
+
+      if isinstance(address, basestring):
+         if _ThreadingUnixServer is None: raise ValueError("Unix sockets are not supported on this platform.")
+         self.server = _ThreadingUnixServer(address, _RollRequestHandler)
+      else:
+         self.server = _ThreadingTCPServer(address, _RollRequestHandler)
+      self.server.service = self
+      self.address = self.server.server_address
+
+      self._worker = threading.Thread(target=self._Work, name="RollService worker")
+      self._worker.daemon = True
+      self._serverThread = None
+
+   def _CollectEvent(self, event):
+      self._collected.append(event)
+
+   def _Compile(self, request):
+      """ Return (RollPlan, None) for a request, or (None, error message) if it is invalid or too large to be
+      rolled. Runs in the thread of the connection, before the request is queued for the worker. """
+      command, session = request.get("command"), request["session"]
+      if not isinstance(command, basestring) or not isinstance(session, basestring):
+         return None, "Roll command and session have to be strings."
+      try: plan = CompileRoll(command)
+      except ValueError as e: return None, str(e)
+      if plan.numDice > self.maxDice:
+         return None, "Rolls of more than %d dice are not supported (%d given)." % (self.maxDice, plan.numDice)
+      return plan, None
+
+   def _Execute(self, request, plan, error):
+      session = request["session"]
+      reply = { "id": request.get("id"), "session": session }
+      if error is not None:
+         reply["error"] = error
+         return reply
+      try:
+         stream = self.StreamForSession(session)
+         handler = RollHandler(plan, stream, source=session, eventBus=self.eventBus)
+         self._collected = []
+         handler.Roll()
+      except Exception as e: # anything uncaught would stop the worker and leave all clients waiting
+         reply["error"] = str(e) if isinstance(e, ValueError) else "%s: %s" % (type(e).__name__, e)
+         return reply
+
+      reply["command"] = plan.commandString
+      reply["stream"] = [stream.Seed(), list(stream.Path()), handler.streamPosition]
+      reply["stages"] = [_EventToDict(ev) for ev in self._collected]
+      return reply
+
+   def _Work(self):
+      while True:
+         item = self._queue.get()
+         if item is None: return
+         batch = [item]
+         while len(batch) < self.maxBatchSize:
+            try: item = self._queue.get_nowait()
+            except Queue.Empty: break
+            if item is None:
+               self._queue.put(None) # stop after this batch
+               break
+            batch.append(item)
+         self._ProcessBatch(batch)
+
+   def _ProcessBatch(self, batch):
+      replies = {} # connection => replies in order of their requests
+      for conn, request, plan, error in batch:
+         replies.setdefault(conn, []).append(self._Execute(request, plan, error))
+      for conn, connReplies in replies.iteritems():
+         conn.SendReplies(connReplies)
+      self.numRequests += len(batch)
+      self.numBatches += 1
+
+   def StreamForSession(self, session):
+      try: return self._streams[session]
+      except KeyError:
+         key = session.encode("utf-8") if isinstance(session, unicode) else session
+         stream = self._streams[session] = self.rng.Spawn(key)
+         return stream
+
+   def ServeForever(self):
+      self._worker.start()
+      self.server.serve_forever()
+
+   def Start(self):
+      """ Serve in background threads. Returns the service. """
+      self._worker.start()
+      self._serverThread = threading.Thread(target=self.server.serve_forever, name="RollService server")
+      self._serverThread.daemon = True
+      self._serverThread.start()
+      return self
+
+   def Shutdown(self):
+      if self._serverThread is not None: self.server.shutdown()
+      self.server.server_close()
+      if isinstance(self.address, basestring) and os.path.exists(self.address):
+         os.remove(self.address) # Unix socket file
+      self._queue.put(None)
+      if self._worker.is_alive(): self._worker.join()
+
+
+#===============================================================================
+# RollClient
+#   Blocking client for a RollService. Not thread-safe, use one per thread.
+#===============================================================================
+class RollClient(object):
+   def __init__(self, address, session=None, timeout=None):
+      family = socket.AF_UNIX if isinstance(address, basestring) else socket.AF_INET
+      self.session = session # default session for the rolls of this client
+      self._sock = socket.socket(family, socket.SOCK_STREAM)
+      self._sock.settimeout(timeout)
+      self._sock.connect(address)
+      self._file = self._sock.makefile("rb")
+      self._nextId = 1
+
+   def _Request(self, command, session):
+      request = { "id": self._nextId, "command": command }
+      if session is not None or self.session is not None:
+         request["session"] = session if session is not None else self.session
+      self._nextId += 1
+      return json.dumps(request) + "\n"
+
+   def _Reply(self):
+      line = self._file.readline()
+      if not line: raise socket.error("Connection closed by the roll service.")
+      return json.loads(line)
+
+   def Close(self):
+      self._file.close()
+      self._sock.close()
+
+   def Roll(self, command, session=None):
+      """ Roll *command* on the service and return its reply. Raises ValueError for invalid commands. """
+      self._sock.sendall(self._Request(command, session))
+      reply = self._Reply()
+      if "error" in reply: raise ValueError(reply["error"])
+      return reply
+
+   def RollMany(self, commands, session=None):
+      """ Send several roll commands at once and return their replies (pipelined, so they can be batched
+      by the service). Replies of invalid commands contain an 'error' entry. """
+      self._sock.sendall("".join([self._Request(cmd, session) for cmd in commands]))
+      return [self._Reply() for cmd in commands]
+
+   def RollAndPublish(self, command, session=None, bus=None):
+      """ Roll *command* and publish the results as RollEvents to *bus* (the default bus if None), just
+      like RollHandler.Roll does for local rolls. """
+      reply = self.Roll(command, session)
+      if bus is None: bus = DefaultBus()
+      if bus.active:
+         for event in EventsFromResult(reply, reply["session"]):
+            bus.Publish(event)
+      return reply
+
+
+#===============================================================================
+# Benchmark
+#===============================================================================
+def Benchmark(numSessions=50, rollsPerSession=200, command="20 4+ 4+r", pipelineDepth=10, address=None):
+   """ Roll *command* *rollsPerSession* times for each of *numSessions* concurrent sessions, each on
+   its own connection and thread, and return (rolls per second, average batch size). A local service
+   is started unless the *address* of a running one is given. """
+   service = RollService(seed=0).Start() if address is None else None
+   if service is not None: address = service.address
+
+   clients = [RollClient(address, "bench%d" % i) for i in range(numSessions)]
+   def Run(client):
+      done = 0
+      while done < rollsPerSession:
+         n = min(pipelineDepth, rollsPerSession - done)
+         client.RollMany([command] * n)
+         done += n
+
+   threads = [threading.Thread(target=Run, args=(c, )) for c in clients]
+   start = time.time()
+   for t in threads: t.start()
+   for t in threads: t.join()
+   elapsed = time.time() - start
+
+   for c in clients: c.Close()
+   avgBatch = 0.
+   if service is not None:
+      avgBatch = service.numRequests / float(max(service.numBatches, 1))
+      service.Shutdown()
+   return numSessions * rollsPerSession / elapsed, avgBatch
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# test/test_dice.py
+#===============================================================================
+import unittest
+from kowsim.dice import RollHandler, IndividualRoll, D6, CountAtLeast, FacesToList, CompileRoll, FaceHistogram
+from kowsim.odds import DistributionForChain
+from kowsim.rng import RandomStream
+from kowsim.rollevents import RollEventBus, RollStatistics
+from kowsim.rollservice import RollService, RollClient, EventsFromResult
+from kowsim.kow.combat import AnalyzeCombat, SimulateCombat
+from kowsim.kow.unit import UnitProfile
+from kowsim.kow.nerve import NerveTableFor, ParseNerveString, NERVE_STEADY, NERVE_WAVER, NERVE_ROUT
+
+
+#===============================================================================
+
+class RollManyTestCase(unittest.TestCase):
+   """ Test if a batch of dice only contains valid faces. """
+   def runTest(self):
+      faces = FacesToList(D6.RollMany(1000))
+      self.assertEqual(len(faces), 1000)
+      self.assertTrue(all(1 <= f <= 6 for f in faces))
+      self.assertEqual(CountAtLeast([1, 4, 6, 3, 4], 4), 3)
+
+
+class RerollTestCase(unittest.TestCase):
+   """ Test if a rerollable stage only rerolls the failed dice. """
+   def runTest(self):
+      roll = IndividualRoll(D6, 4, reroll=True)
+      passed, results = roll.Execute(30)
+      self.assertEqual(len(results), 2)
+      self.assertEqual(results[0].Total(), 30)
+      self.assertEqual(results[1].Total(), results[0].CountBelow(4))
+      self.assertEqual(passed, results[0].CountAtLeast(4) + results[1].CountAtLeast(4))
+
+
+class RollTrialsTestCase(unittest.TestCase):
+   """ Test if batched trials of a roll chain stay within their bounds. """
+   def runTest(self):
+      successes = RollHandler("20 4+ 4+r").RollTrials(500)
+      self.assertEqual(len(successes), 500)
+      self.assertTrue(all(0 <= s <= 20 for s in successes))
+
+
+class ChainOddsTestCase(unittest.TestCase):
+   """ Test the exact odds of a roll chain against hand-computed values. """
+   def runTest(self):
+      dist = RollHandler("20 4+ 4+r").Odds()
+      self.assertAlmostEqual(sum(dist.Pmf()), 1.)
+      self.assertAlmostEqual(dist.Expected(), 20 * 0.5 * 0.75)
+      self.assertAlmostEqual(dist.AtLeast(20), (0.5 * 0.75)**20)
+      self.assertAlmostEqual(dist.AtLeast(0), 1.)
+      self.assertIs(DistributionForChain(20, [(6, 4, False), (6, 4, True)]), dist) # cached
+      
+      dist = RollHandler("500 2+").Odds() # (1-p)**n underflows
+      self.assertAlmostEqual(sum(dist.Pmf()), 1.)
+      self.assertAlmostEqual(dist.Expected(), 500 * 5 / 6.)
+      self.assertRaises(ValueError, RollHandler("100000000 4+").Odds)
+
+
+class StreamReplayTestCase(unittest.TestCase):
+   """ Test if seeded streams are reproducible and rolls can be regenerated from their stream position. """
+   def runTest(self):
+      stream = RandomStream(42)
+      rh = RollHandler("10 4+r", stream)
+      rh.Roll()
+      idvRoll = rh.individualRolls[0]
+      for hist, pos in zip(idvRoll.results, idvRoll.positions):
+         self.assertEqual(FaceHistogram.FromFaces(6, stream.Replay(pos, 6, hist.Total())), hist)
+      
+      other = RandomStream(42)
+      self.assertEqual(FaceHistogram.FromFaces(6, other.Dice(6, 10)), idvRoll.results[0])
+      self.assertNotEqual(FacesToList(other.Spawn(0).Dice(6, 50)), FacesToList(other.Spawn(1).Dice(6, 50)))
+      
+      rh = RollHandler("30d300 100+", RandomStream(7)) # faces above 255 must not overflow
+      rh.Roll()
+      self.assertTrue(all(1 <= f <= 300 for f in FacesToList(RandomStream(7).Dice(300, 30))))
+      self.assertEqual(rh.allResults[0][1][0].Total(), 30)
+      self.assertTrue(all(1 <= f <= 100000 for f in FacesToList(RandomStream(7).Dice(100000, 50))))
+      self.assertEqual(max(FacesToList(RandomStream(7).Dice(100000, 50))), max(FacesToList(RandomStream(7).Replay(0, 100000, 50))))
+
+
+class FaceHistogramTestCase(unittest.TestCase):
+   """ Test if large rolls are kept as a fixed size histogram. """
+   def runTest(self):
+      hist = D6.RollHistogram(200000, chunkSize=1000)
+      self.assertEqual(len(hist.counts), 7)
+      self.assertEqual(hist.Total(), 200000)
+      self.assertEqual(hist.CountAtLeast(4) + hist.CountBelow(4), 200000)
+      self.assertEqual(FaceHistogram.FromFaces(6, [3, 1, 6, 1]).ToString(), "1,1,3,6")
+
+
+class CompileRollTestCase(unittest.TestCase):
+   """ Test if roll commands are compiled once and shared between handlers. """
+   def runTest(self):
+      plan = CompileRoll("12D8  5+ 3+R")
+      self.assertIs(CompileRoll("12d8 5+ 3+r"), plan)
+      self.assertEqual((plan.numDice, plan.sides), (12, 8))
+      self.assertEqual([(st.threshold, st.reroll) for st in plan.stages], [(5, False), (3, True)])
+      
+      rh = RollHandler(plan)
+      self.assertEqual(rh.die.sides, 8)
+      self.assertEqual([idv.threshold for idv in rh.individualRolls], [5, 3])
+      self.assertRaises(ValueError, CompileRoll, "12 4+ x")
+      self.assertRaises(ValueError, CompileRoll, "12 r")
+      self.assertRaises(ValueError, CompileRoll, "1d0 4+")
+      self.assertRaises(ValueError, CompileRoll, "1d50000000")
+      
+      from kowsim import dice
+      for sides in range(700, 1000): RollHandler("1d%d" % sides)
+      self.assertEqual(len(dice._diceBySides), 8) # only the standard dice are kept for good
+      self.assertEqual(len(dice._otherDice), dice._otherDice.MaxSize())
+      self.assertIs(RollHandler("2d20").die, dice.D20)
+
+
+class RollEventTestCase(unittest.TestCase):
+   """ Test if rolls publish one event per stage to the bus and its subscribers. """
+   def runTest(self):
+      bus = RollEventBus(capacity=2)
+      stats = RollStatistics()
+      bus.Subscribe(stats)
+      for i in range(3):
+         RollHandler("10 1+ 4+r", RandomStream(i), source="p1", eventBus=bus).Roll()
+      
+      events = bus.History()
+      self.assertEqual(len(events), 2) # bounded
+      self.assertEqual([ev.stage for ev in events], [0, 1])
+      self.assertEqual((events[0].numDice, events[0].successes), (10, 10))
+      self.assertEqual(len(events[1].faces), 2)
+      self.assertAlmostEqual(stats.ExpectedSuccesses("p1"), 3 * (10 + 10 * 0.75))
+      self.assertAlmostEqual(sum(stats.FaceFrequencies("p1")), 1.)
+      
+      quiet = RollEventBus() # no history by default
+      self.assertFalse(quiet.active)
+      quiet.Subscribe(stats)
+      self.assertTrue(quiet.active)
+      quiet.Unsubscribe(stats)
+      self.assertFalse(quiet.active)
+
+
+class NerveTableTestCase(unittest.TestCase):
+   """ Test nerve test lookups, including insane courage and clamped offsets. """
+   def runTest(self):
+      table = NerveTableFor(*ParseNerveString("14/16"))
+      self.assertEqual(table.Outcome(7, 6), NERVE_STEADY)
+      self.assertEqual(table.Outcome(8, 6), NERVE_WAVER)
+      self.assertEqual(table.Outcome(10, 6), NERVE_ROUT)
+      self.assertEqual(table.Outcome(2, 50), NERVE_STEADY) # insane courage
+      self.assertEqual(table.Probabilities(50), (1/36., 0., 35/36.))
+      self.assertEqual(table.Probabilities(-50), (1., 0., 0.))
+      pRout = table.Probabilities(6)[2]
+      self.assertAlmostEqual(table.Probabilities(6, inspiring=True)[2], pRout**2)
+      self.assertEqual(NerveTableFor(0, 15).Outcome(12, 2), NERVE_STEADY) # doesn't waver
+      self.assertRaises(ValueError, ParseNerveString, "14")
+
+
+class AnalyzeCombatTestCase(unittest.TestCase):
+   """ Test exact combat odds against hand-computed values. """
+   def runTest(self):
+      attacker = UnitProfile("Attacker", 5, 4, 0, 4, 12)
+      defender = UnitProfile("Defender", 5, 4, 0, 5, 10, 0, 15)
+      res = AnalyzeCombat(attacker, defender)
+      self.assertAlmostEqual(sum(res.DamageProbabilities()), 1.)
+      self.assertAlmostEqual(res.ExpectedDamage(), 12 * 0.5 * (2/6.))
+      self.assertEqual(res.WaverProbability(), 0.)
+      pRout = 0.
+      for dmg, p in enumerate(res.damageHistogram):
+         pRout += p * sum(1 for d1 in range(1, 7) for d2 in range(1, 7) if d1 + d2 > 2 and d1 + d2 + dmg >= 15) / 36.
+      self.assertAlmostEqual(res.RoutProbability(), pRout)
+
+
+class SimulateCombatTestCase(unittest.TestCase):
+   """ Test if simulated attacks match the exact odds and don't depend on the chunking of the trials. """
+   def runTest(self):
+      attacker = UnitProfile("Attacker", 5, 4, 0, 4, 12, 0, 0, 100, None, None, None, ["Elite"])
+      defender = UnitProfile("Defender", 5, 4, 0, 5, 10, 10, 12)
+      exact = AnalyzeCombat(attacker, defender)
+      sim = SimulateCombat(attacker, defender, 20000, processes=1, chunkSize=2000, seed=11)
+      self.assertEqual(sim.NumTrials(), 20000)
+      self.assertAlmostEqual(sim.ExpectedHits(), exact.ExpectedHits(), delta=0.05)
+      self.assertAlmostEqual(sim.ExpectedDamage(), exact.ExpectedDamage(), delta=0.05)
+      self.assertAlmostEqual(sim.WaverProbability(), exact.WaverProbability(), delta=0.02)
+      self.assertAlmostEqual(sim.RoutProbability(), exact.RoutProbability(), delta=0.02)
+      
+      other = SimulateCombat(attacker, defender, 20000, processes=2, chunkSize=7000, seed=11)
+      self.assertEqual((other.damageHistogram, other.numHits, other.numWaver, other.numRout),
+                       (sim.damageHistogram, sim.numHits, sim.numWaver, sim.numRout))
+      self.assertNotEqual(SimulateCombat(attacker, defender, 20000, processes=1, seed=12).damageHistogram, sim.damageHistogram)
+
+
+class RollServiceTestCase(unittest.TestCase):
+   """ Test if the roll service rolls with per-session seeded streams. """
+   def runTest(self):
+      service = RollService(seed=7).Start()
+      try:
+         client = RollClient(service.address, "p1")
+         replies = client.RollMany(["10 4+r", "3 x", "1d0", "10 4+r"])
+         self.assertTrue("error" in replies[1] and "error" in replies[2])
+         self.assertTrue("error" not in client.Roll("2 4+")) # the worker survived
+         oversized = client.RollMany(["100000000 4+", "1d50000000", "%d 4+" % (service.maxDice + 1), "2 4+"])
+         self.assertEqual(["error" in r for r in oversized], [True, True, True, False])
+         self.assertEqual([r["id"] for r in oversized], sorted([r["id"] for r in oversized]))
+         client.Close()
+      finally: service.Shutdown()
+      
+      # same rolls as a local handler with the session's substream
+      local = RollHandler("10 4+r", RandomStream(7).Spawn("p1"), eventBus=RollEventBus(capacity=0))
+      for reply in (replies[0], replies[3]):
+         local.Roll()
+         self.assertEqual(reply["stream"][2], local.streamPosition)
+         self.assertEqual(EventsFromResult(reply)[0].faces, local.individualRolls[0].results)
+
+
+if __name__=='__main__':
+   unittest.main()
@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+
+# test/test_kow.py
+#===============================================================================
+import unittest
+from kowsim.kow.unit import UnitProfile
+from kowsim.kow.item import Item
+from kowsim.kow.force import ArmyList, Detachment, KowForceChoices
+from kowsim.kow import stats
+from kowsim.kow import sizetype as st
+from kowsim.kow import unittype as ut
+
+
+#===============================================================================
+
+class ResolvedProfileTestCase(unittest.TestCase):
+   """ Test if option effects are applied to the resolved profile and invalidated on changes. """
+   def runTest(self):
+      opts = UnitProfile.ParseOptionsString("Mount|15|Set(Speed,9)|Grant(Nimble);Two-handed weapons|0|Add(Defense,-1)|Grant(CS(1))|Remove(Shield)")
+      profile = UnitProfile("Test", 5, 4, 0, 5, 10, 12, 14, 100, None, None, None, ["Shield"], None, opts)
+      unit = profile.CreateInstance(None)
+      self.assertIs(unit.Resolved(), unit.Resolved())
+      self.assertEqual((unit.Sp(), unit.De(), unit.PointsCost()), (5, 5, 100))
+      
+      unit.ChooseOption(opts[0])
+      unit.ChooseOption(opts[1])
+      self.assertEqual((unit.Sp(), unit.De(), unit.PointsCost()), (9, 4, 115))
+      self.assertEqual(unit.ListSpecialRules(), ["Nimble", "CS(1)"])
+      unit.ListSpecialRules().append("Fly") # callers get a copy, the cached profile stays intact
+      self.assertEqual(unit.ListSpecialRules(), ["Nimble", "CS(1)"])
+      self.assertTrue(unit.HasStatModifier(stats.ST_DEFENSE))
+      self.assertFalse(unit.HasStatModifier(stats.ST_MELEE))
+      
+      unit.ClearChosenOptions()
+      self.assertEqual((unit.Sp(), unit.De(), unit.ListSpecialRules()), (5, 5, ["Shield"]))
+      
+      item = Item.FromCsv(["Brew of Strength", "", "Add(Attacks,5)|Grant(Elite)", "30"])
+      self.assertEqual(item.EffectIndex().addModifiers, {stats.ST_ATTACKS: 5})
+      unit.SetItem(item)
+      self.assertEqual((unit.At(), unit.PointsCost(), unit.ListSpecialRules()), (15, 130, ["Shield", "Elite"]))
+
+
+class SpecialRuleTestCase(unittest.TestCase):
+   """ Test interned special rules and the rule sets of units with options and items. """
+   def runTest(self):
+      from kowsim.kow.specialrule import DefaultRegistry
+      registry = DefaultRegistry()
+      self.assertIs(registry.Parse("CS(2)")[0], registry.Parse("Crushing Strength (1)")[0])
+      self.assertEqual(registry.Parse("Regeneration (5+)")[1], "5+")
+      
+      opts = UnitProfile.ParseOptionsString("Great weapons|10|Grant(CS(1))|Remove(Shield)")
+      profile = UnitProfile("Test", 5, 4, 0, 5, 10, 12, 14, 100, ut.UT_INF, st.ST_REG, None, ["Shield", "Crushing Strength (1)", "Elite"], None, opts)
+      unit = profile.CreateInstance(None)
+      self.assertTrue(unit.HasRule("Shield") and unit.HasRule("CS"))
+      self.assertEqual(unit.RuleSet().Value("Crushing Strength"), 1)
+      
+      unit.ChooseOption(opts[0])
+      self.assertFalse(unit.HasRule("Shield"))
+      self.assertEqual(unit.RuleSet().Value("CS"), 2)
+      self.assertEqual(sorted(unit.RuleSet().Names()), ["Crushing Strength (2)", "Elite"])
+      self.assertEqual(sorted(profile.RuleSet().Names()), ["Crushing Strength (1)", "Elite", "Shield"])
+      
+      unit.SetItem(Item.FromCsv(["Boots", "", "Grant(Nimble)", "15"]))
+      self.assertTrue("Nimble" in unit.RuleSet())
+      self.assertFalse(unit.HasRule("Fly"))
+      self.assertEqual(unit.RuleSet().Value("Fly"), 0)
+
+
+class ItemEffectsTestCase(unittest.TestCase):
+   """ Test the resolved stats and rules of a hero with each magic item of the bundled items.csv. """
+   def runTest(self):
+      import os
+      from kowsim.armybuilder.parsers import ItemCsvParser
+      from kowsim.kow.effect import InternEffect
+      
+      # item => (changed stats (Sp, De), parameters of the added rules), items not listed don't change the profile
+      expected = { "Dwarven Ale": ({}, {"Headstrong": None}),
+                   "Brew of Haste": ({"Sp": 6}, {}),
+                   "Pipes of Terror": ({}, {"Brutal": None}),
+                   "Inspiring Talisman": ({}, {"Inspiring": None}),
+                   u"Maccwar\u2019s Potion of the Caterpillar": ({}, {"Pathfinder": None}),
+                   "Blessing of the Gods": ({}, {"Elite": None}),
+                   "Chant of Hate": ({}, {"Vicious": None}),
+                   "Brew of Strength": ({}, {"Crushing Strength": 2}), # increases the hero's CS (1)
+                   "Diadem of Dragon-kind": ({}, {"Breath Attack": 10}),
+                   "Healing Charm": ({}, {"Heal": 3}),
+                   "Heart-seeking Chant": ({}, {"Piercing": 1}),
+                   "The Boomstick": ({}, {"Lightning Bolt": 3}),
+                   "Boots of the Seven Leagues": ({}, {"Vanguard": None}),
+                   "Ensorcelled Armour": ({"De": 6}, {}),
+                   "Medallion of Life": ({}, {"Regeneration": "5+"}),
+                   u"Orcsbain\u2019s Amulet of Thorns": ({}, {"Phalanx": None}),
+                   "The Fog": ({}, {"Stealthy": None}),
+                   "Wine of Elvenkind": ({}, {"Nimble": None}),
+                   "Wings of Honeymaze": ({"Sp": 10}, {"Fly": None}) }
+      
+      pars = ItemCsvParser()
+      pars.ReadLinesFromFile(os.path.join(os.path.dirname(__file__), "..", "..", "..", "data", "kow", "items", "items.csv"))
+      items = pars.Parse()
+      self.assertTrue(set(expected) <= set([i.Name() for i in items]))
+      
+      hero = UnitProfile("Hero", 5, 3, 0, 5, 5, 0, 14, 100, ut.UT_HERO, st.ST_IND, None, ["Crushing Strength (1)", "Individual"])
+      for item in items:
+         unit = hero.CreateInstance(None)
+         unit.SetItem(item)
+         changes, rules = expected.get(item.Name(), ({}, {}))
+         self.assertEqual((unit.Sp(), unit.De()), (changes.get("Sp", 5), changes.get("De", 5)), item.Name())
+         self.assertEqual(unit.RuleSet().Value("Crushing Strength"), rules.get("Crushing Strength", 1), item.Name())
+         for name, param in rules.iteritems():
+            self.assertEqual(unit.RuleSet().Param(name), param, item.Name())
+         added = unit.RuleSet().mask & ~hero.RuleSet().mask
+         self.assertEqual(bin(added).count("1"), len(set(rules) - set(["Crushing Strength"])), item.Name()) # no junk rules
+         self.assertEqual(len(unit.ListSpecialRules()), 2 + len(rules), item.Name())
+      
+      armoured = UnitProfile("Hero", 5, 3, 0, 6, 5, 0, 14, 100, ut.UT_HERO, st.ST_IND).CreateInstance(None)
+      armoured.SetItem([i for i in items if i.Name() == "Ensorcelled Armour"][0])
+      self.assertEqual(armoured.De(), 6) # to a maximum of 6+
+      self.assertIsNone(InternEffect("Grant(Elite,Cumulative)")) # only cumulative rules
+      self.assertIsNone(InternEffect("Grant(Elite,Fly)"))
+
+
+class InternedOptionTestCase(unittest.TestCase):
+   """ Test if equal options are shared between profiles so chosen options survive a size change. """
+   def runTest(self):
+      troop = UnitProfile.ParseOptionsString("Mount|15|Set(Speed,9)|Grant(Nimble)")
+      regiment = UnitProfile.ParseOptionsString(" Mount |15| Set(Speed,9) |Grant(Nimble);Banner|10")
+      self.assertIs(troop[0], regiment[0])
+      self.assertIs(troop[0].EffectIndex(), regiment[0].EffectIndex())
+      self.assertIsNot(UnitProfile.ParseOptionsString("Mount|20|Set(Speed,9)|Grant(Nimble)")[0], troop[0])
+      
+      p1 = UnitProfile("Test", 5, 4, 0, 5, 10, 12, 14, 100, None, None, None, [], None, troop)
+      p2 = UnitProfile("Test", 5, 4, 0, 5, 20, 14, 16, 150, None, None, None, [], None, regiment)
+      unit = p1.CreateInstance(None)
+      unit.ChooseOption(troop[0])
+      unit.SetProfile(p2)
+      self.assertEqual((unit.Sp(), unit.PointsCost()), (9, 165))
+
+      # an option listed twice (The Green Lady's pussycats) gives two options, both shared between profiles
+      cats = UnitProfile.ParseOptionsString("Sabre-Toothed Pussycat|+10;Sabre-Toothed Pussycat|+10")
+      self.assertIsNot(cats[0], cats[1])
+      self.assertEqual([o.Name() for o in cats], ["Sabre-Toothed Pussycat"] * 2)
+      self.assertIs(UnitProfile.ParseOptionsString("Sabre-Toothed Pussycat|+10;Sabre-Toothed Pussycat|+10")[1], cats[1])
+      lady = UnitProfile("Test", 10, 3, 0, 6, 1, 14, 16, 250, None, None, None, [], None, cats).CreateInstance(None)
+      lady.ChooseOption(cats[0])
+      lady.ChooseOption(cats[1])
+      self.assertEqual(lady.PointsCost(), 270)
+
+
+class PointsTotalTestCase(unittest.TestCase):
+   """ Test if the running points totals follow unit, option and item changes. """
+   def runTest(self):
+      opts = UnitProfile.ParseOptionsString("Banner|10;Musician|5")
+      troop = UnitProfile("Test", 5, 4, 0, 5, 10, 12, 14, 100, ut.UT_INF, st.ST_TRP, None, [], None, opts)
+      regiment = UnitProfile("Test", 5, 4, 0, 5, 20, 14, 16, 150, ut.UT_INF, st.ST_REG, None, [], None, opts)
+      armylist = ArmyList("Test list", 2000)
+      det = Detachment(KowForceChoices("Test force", None, [troop, regiment]))
+      armylist.AddDetachment(det)
+      
+      units = [troop.CreateInstance(det), regiment.CreateInstance(det)]
+      for u in units: det.AddUnit(u)
+      self.assertEqual(armylist.PointsTotal(), 250)
+      units[0].ChooseOption(opts[0])
+      units[1].SetProfile(troop)
+      self.assertEqual(armylist.PointsTotal(), 210)
+      
+      duplicate = units[0].Profile().CreateInstance(det) # options chosen before it is added, as DuplicateUnitCmd does
+      duplicate.ChooseOption(opts[1])
+      self.assertEqual(det.PointsTotal(), 210)
+      det.ReplaceUnit(1, duplicate)
+      self.assertEqual((det.PointsTotal(), armylist.PointsTotal()), (215, 215))
+      
+      units[1].ChooseOption(opts[1]) # replaced unit doesn't count anymore
+      det.RemoveUnit(units[0])
+      self.assertEqual(armylist.CheckPointsTotal(), 105)
+      
+      # a unit dropped without RemoveUnit must not pass its state on to a new unit reusing its id
+      other = Detachment(KowForceChoices("Test force", None, [troop]))
+      other.AddUnit(troop.CreateInstance(other))
+      del other.ListUnits()[0]
+      unit = troop.CreateInstance(other)
+      unit.ChooseOption(opts[0]) # not part of the detachment yet
+      self.assertEqual(other._pointsTotal, 100)
+      armylist.RemoveDetachment(det)
+      self.assertEqual(armylist.PointsTotal(), 0)
+
+
+class ContentHashTestCase(unittest.TestCase):
+   """ Test if the incrementally maintained content hash equals the hash of a list built from scratch. """
+   def runTest(self):
+      opts = UnitProfile.ParseOptionsString("Banner|10;Musician|5")
+      troop = UnitProfile("Test", 5, 4, 0, 5, 10, 12, 14, 100, ut.UT_INF, st.ST_TRP, None, [], None, opts)
+      regiment = UnitProfile("Test", 5, 4, 0, 5, 20, 14, 16, 150, ut.UT_INF, st.ST_REG, None, [], None, opts)
+      force = KowForceChoices("Test force", None, [troop, regiment])
+      
+      def Build(name, profiles, options):
+         armylist = ArmyList(name, 2000)
+         det = Detachment(force, "%s detachment" % name, isPrimary=True)
+         armylist.AddDetachment(det)
+         for p in profiles: det.AddUnit(p.CreateInstance(det))
+         for o in options: det.Unit(0).ChooseOption(o)
+         return armylist
+      
+      a = Build("A", [troop, regiment], [opts[0], opts[1]])
+      b = Build("B", [troop, regiment], [opts[1], opts[0]])
+      self.assertEqual(a.ContentHash(), b.ContentHash())
+      
+      c = Build("C", [regiment], [])
+      c.ListDetachments()[0].AddUnit(troop.CreateInstance(None))
+      c.ListDetachments()[0].Unit(1).ChooseOption(opts[1])
+      c.ListDetachments()[0].Unit(1).ChooseOption(opts[0])
+      self.assertEqual(c.ContentHash(), a.ContentHash()) # unit order doesn't matter
+      
+      unit = a.ListDetachments()[0].Unit(1)
+      unit.SetProfile(troop)
+      self.assertNotEqual(a.ContentHash(), b.ContentHash())
+      unit.SetProfile(regiment)
+      self.assertEqual(a.ContentHash(), b.ContentHash())
+      
+      a.ListDetachments()[0].SetPrimary(False)
+      self.assertNotEqual(a.ContentHash(), b.ContentHash())
+      a.ListDetachments()[0].SetPrimary(True)
+      a.SetPointsLimit(2500)
+      self.assertNotEqual(a.ContentHash(), b.ContentHash())
+      
+      det = b.ListDetachments()[0]
+      b.RemoveDetachment(det)
+      self.assertEqual(b.ContentHash(), ArmyList("Empty", 2000).ContentHash())
+
+
+class ForceChoicesIndexTestCase(unittest.TestCase):
+   """ Test the lookup indexes of KowForceChoices. """
+   def runTest(self):
+      troop = UnitProfile("Guard", 5, 4, 0, 5, 10, 12, 14, 100, ut.UT_INF, st.ST_TRP)
+      regiment = UnitProfile("Guard", 5, 4, 0, 5, 20, 14, 16, 150, ut.UT_INF, st.ST_REG)
+      hero = UnitProfile("Champion", 5, 3, 0, 5, 5, 0, 14, 90, ut.UT_HERO, st.ST_IND, None, [], None, [], False, True)
+      force = KowForceChoices("Test force", None, [troop, regiment, hero])
+      
+      self.assertEqual([g.Name() for g in force.ListGroups()], ["Guard", "Champion"])
+      self.assertIs(force.GroupByName("Guard").Default(), troop)
+      self.assertIs(force.GroupByDisplayName("Champion [1]"), force.GroupByName("Champion"))
+      self.assertIs(force.ProfileFor("Guard", "Regiment"), regiment)
+      self.assertEqual(force.ListUnitsForType(ut.UT_HERO), (force.GroupByName("Champion"), ))
+      self.assertEqual(force.ListUnitsForType(ut.UT_CAV), ())
+      self.assertRaises(TypeError, force.GroupByName("Guard").AddSizeOption, hero)
+
+
+class ArmyOptimizerTestCase(unittest.TestCase):
+   """ Compare the optimizer with a brute force search over all legal lists of a small force. """
+   def runTest(self):
+      import itertools
+      from kowsim.kow.alignment import AL_NEUT
+      from kowsim.kow.optimizer import OptimizeArmy, Attacks
+      from kowsim.kow.validation import ArmyListValidator, ValidationMessage, ValidationRule, ALL_VALIDATIONRULES
+      
+      profiles = [UnitProfile("Spears", 5, 4, 0, 4, 10, 12, 14, 60, ut.UT_INF, st.ST_TRP),
+                  UnitProfile("Spears", 5, 4, 0, 4, 12, 14, 16, 100, ut.UT_INF, st.ST_REG),
+                  UnitProfile("Spears", 5, 4, 0, 4, 25, 20, 22, 160, ut.UT_INF, st.ST_HRD),
+                  UnitProfile("Giant", 7, 3, 0, 5, 18, 0, 19, 170, ut.UT_MON, st.ST_IND),
+                  UnitProfile("King", 5, 3, 0, 5, 7, 0, 15, 140, ut.UT_HERO, st.ST_IND, None, [], None, [], False, True)]
+      force = KowForceChoices("Test force", AL_NEUT, profiles)
+      
+      best = 0
+      for counts in itertools.product(range(6), range(6), range(4), range(3), range(2)):
+         if sum([n * p.PointsCost() for n, p in zip(counts, profiles)]) > 500: continue
+         armylist = ArmyList("Brute force", 500)
+         det = Detachment(force, isPrimary=True)
+         armylist.AddDetachment(det)
+         for n, p in zip(counts, profiles):
+            for i in range(n): det.AddUnit(p.CreateInstance(det))
+         if not any(m.IsCritical() for m in ArmyListValidator(armylist, ALL_VALIDATIONRULES).Check()):
+            best = max(best, sum([u.At() for u in det.ListUnits()]))
+      
+      res = OptimizeArmy(force, 500, Attacks, topN=3)
+      self.assertTrue(res.complete)
+      self.assertEqual(len(res.lists), 3)
+      self.assertEqual(res.lists[0][0], best)
+      self.assertEqual([v for v, al in res.lists], sorted([v for v, al in res.lists], reverse=True))
+      for value, armylist in res.lists:
+         self.assertTrue(armylist.PointsTotal() <= 500)
+         self.assertEqual(value, sum([u.At() for u in armylist.ListDetachments()[0].ListUnits()]))
+
+      # lists failing a rule the search doesn't know about are skipped
+      class NoHordesRule(ValidationRule):
+         perDetachment = True
+         def __init__(self): ValidationRule.__init__(self, "No hordes")
+         def CheckDetachment(self, facts):
+            return [ValidationMessage(ValidationMessage.VM_CRITICAL, "Horde", "")] if facts.nHordes > 0 else []
+
+      res = OptimizeArmy(force, 500, Attacks, rules=tuple(ALL_VALIDATIONRULES) + (NoHordesRule(), ), topN=3)
+      self.assertTrue(res.complete and res.numRejected > 0)
+      self.assertEqual(len(res.lists), 3)
+      self.assertTrue(res.lists[0][0] < best)
+      for value, armylist in res.lists:
+         self.assertEqual([u for u in armylist.ListDetachments()[0].ListUnits() if u.SizeType() == st.ST_HRD], [])
+
+
+class UnitIndexTestCase(unittest.TestCase):
+   """ Compare unit index queries with plain filtering of the profiles. """
+   def runTest(self):
+      from kowsim.kow.alignment import AL_GOOD, AL_EVIL
+      from kowsim.kow.unitindex import UnitIndex
+      
+      good = KowForceChoices("Good force", AL_GOOD, [
+         UnitProfile("Spears", 5, 4, 0, 4, 10, 12, 14, 60, ut.UT_INF, st.ST_TRP),
+         UnitProfile("Spears", 5, 4, 0, 5, 25, 20, 22, 160, ut.UT_INF, st.ST_HRD),
+         UnitProfile("Knights", 8, 3, 0, 5, 16, 14, 16, 200, ut.UT_CAV, st.ST_REG, None, ["Thunderous Charge (2)", "Elite"]),
+         UnitProfile("Dragon", 10, 3, 0, 6, 10, 0, 19, 300, ut.UT_MON, st.ST_IND, None, ["Fly", "Crushing Strength (3)"])])
+      evil = KowForceChoices("Evil force", AL_EVIL, [
+         UnitProfile("Brutes", 6.5, 3, 0, 5, 20, 0, 17, 140, ut.UT_LINF, st.ST_REG, None, ["Crushing Strength (1)"])])
+      index = UnitIndex([good, evil])
+      profiles = good.ListUnits() + evil.ListUnits()
+      
+      res = index.Query().Where("de", ">=", 5).Where("points", "<=", 250).OrderBy("pointsperattack").Profiles()
+      expected = sorted([p for p in profiles if p.De() >= 5 and p.PointsCost() <= 250], key=lambda p: p.PointsCost() / float(p.At()))
+      self.assertEqual(res, expected)
+      self.assertEqual(index.Query().Alignments(AL_GOOD).Where("at", ">", 10).OrderBy("at", descending=True).Profiles(),
+                       [profiles[1], profiles[2]])
+      self.assertEqual(index.Query().HasRules("Crushing Strength").Profiles(), [profiles[3], profiles[4]])
+      self.assertEqual(index.Query().HasRules("Crushing Strength", "Fly").Profiles(), [profiles[3]])
+      self.assertEqual(index.Query().HasRules("Nimble").Count(), 0)
+      self.assertEqual(index.Query().Where("sp", ">", 6).UnitTypes(ut.UT_LINF).Profiles(), [profiles[4]])
+      self.assertEqual([index.ForceOfRow(r) for r in index.Query().SizeTypes(st.ST_REG).Rows()], [good, evil])
+      self.assertRaises(ValueError, index.Query().Where, "wounds", ">", 1)
+
+
+class IncrementalValidationTestCase(unittest.TestCase):
+   """ Test if the validator re-runs only invalidated rules and still yields the messages of a full check. """
+   def runTest(self):
+      from kowsim.kow import validation as val
+      
+      class CountingRule(val.NumberOfNonRegimentsOkRule):
+         def __init__(self):
+            val.NumberOfNonRegimentsOkRule.__init__(self)
+            self.checked = []
+         def CheckDetachment(self, facts):
+            self.checked.append(facts.detachment)
+            return val.NumberOfNonRegimentsOkRule.CheckDetachment(self, facts)
+      
+      hero = UnitProfile("Captain", 5, 4, 0, 5, 3, 13, 15, 80, ut.UT_HERO, st.ST_IND)
+      regiment = UnitProfile("Guard", 5, 4, 0, 5, 10, 14, 16, 100, ut.UT_INF, st.ST_REG)
+      force = KowForceChoices("Test force", None, [hero, regiment])
+      armylist = ArmyList("Test", 200)
+      primary, ally = Detachment(force, "Primary", isPrimary=True), Detachment(force, "Ally")
+      armylist.AddDetachment(primary)
+      armylist.AddDetachment(ally)
+      for det in (primary, ally): det.AddUnit(regiment.CreateInstance(det))
+      
+      rule = CountingRule()
+      rules = (rule, val.PointsLimitFulfilledRule()) + val.COK_ADDITIONALRULES
+      validator = val.ArmyListValidator(armylist, rules)
+      self.assertEqual(validator.Check(), [])
+      self.assertEqual(validator.Check(), [])
+      self.assertEqual(rule.checked, [primary, ally])
+      
+      for i in range(2): ally.AddUnit(hero.CreateInstance(ally))
+      validator.Invalidate(val.DEP_ALL, [ally])
+      messages = [m.ShortDesc() for m in validator.Check()]
+      self.assertEqual(rule.checked, [primary, ally, ally])
+      self.assertEqual(messages, [m.ShortDesc() for m in val.ArmyListValidator(armylist, rules).Check()])
+      self.assertEqual(len(messages), 3) # points limit, too many heroes in the ally, Captain chosen twice
+      
+      numChecked = len(rule.checked)
+      validator.Invalidate(val.DEP_ITEMS)
+      validator.Check()
+      self.assertEqual(len(rule.checked), numChecked)
+      
+      facts = validator.Facts()
+      self.assertEqual((facts.detachments[1].nHeroes, facts.detachments[1].specialUnitCounts["Captain"]), (2, 2))
+      validator.Invalidate(val.DEP_UNITS, [ally])
+      self.assertIs(validator.Facts().detachments[0], facts.detachments[0]) # facts of the primary are kept
+      self.assertIsNot(validator.Facts().detachments[1], facts.detachments[1])
+      
+      armylist.RemoveDetachment(ally)
+      validator.Invalidate(val.DEP_ALL, [ally])
+      self.assertEqual([m.ShortDesc() for m in validator.Check()], ["100 leftover points."])
+
+
+class ValidationCacheTestCase(unittest.TestCase):
+   """ Test if the messages of army contents validated before are taken from the cache. """
+   def runTest(self):
+      from kowsim.kow import validation as val
+      from kowsim.util.cache import LruCache
+      
+      opts = UnitProfile.ParseOptionsString("Banner|10")
+      regiment = UnitProfile("Guard", 5, 4, 0, 5, 10, 14, 16, 100, ut.UT_INF, st.ST_REG, None, [], None, opts)
+      armylist = ArmyList("Test", 200)
+      det = Detachment(KowForceChoices("Test force", None, [regiment]), "Primary", isPrimary=True)
+      armylist.AddDetachment(det)
+      det.AddUnit(regiment.CreateInstance(det))
+      
+      cache = LruCache(8)
+      validator = val.ArmyListValidator(armylist, val.ALL_VALIDATIONRULES, cache)
+      first = validator.Check()
+      self.assertEqual([m.ShortDesc() for m in first], ["100 leftover points."])
+      
+      det.Unit(0).ChooseOption(opts[0])
+      validator.Invalidate()
+      self.assertEqual([m.ShortDesc() for m in validator.Check()], ["90 leftover points."])
+      
+      det.Unit(0).ClearChosenOptions()
+      validator.Invalidate()
+      self.assertIs(validator.Check(), first)
+      self.assertEqual((cache.hits, len(cache)), (1, 2))
+      
+      det.SetCustomName("Renamed")
+      self.assertIsNot(validator.Check(), first) # names are part of the key
+      self.assertEqual(validator.Check(), first)
+
+
+class BatchValidationTestCase(unittest.TestCase):
+   """ Test validating saved army list files without the GUI. """
+   def runTest(self):
+      import os, shutil, tempfile, StringIO
+      from kowsim.armybuilder.batchvalidation import ListArmyListFiles, ValidateArmyLists
+      from kowsim.kow.fileio import ArmyListWriter
+      
+      class DataManager(object):
+         def __init__(self, forces): self._forces = dict([(fc.Name(), fc) for fc in forces])
+         def BaseDir(self): return None
+         def ForceChoicesByName(self, name): return self._forces[name]
+         def ItemByName(self, name): raise KeyError(name)
+      
+      regiment = UnitProfile("Guard", 5, 4, 0, 5, 10, 14, 16, 100, ut.UT_INF, st.ST_REG)
+      force = KowForceChoices("Test force", None, [regiment])
+      tmpdir = tempfile.mkdtemp()
+      try:
+         for name, numUnits in (("ok", 2), ("toomany", 3)):
+            armylist = ArmyList(name, 200)
+            det = Detachment(force, "Primary", isPrimary=True)
+            armylist.AddDetachment(det)
+            for i in range(numUnits): det.AddUnit(regiment.CreateInstance(det))
+            ArmyListWriter(armylist).SaveToFile(os.path.join(tmpdir, name + ".txt"))
+         with open(os.path.join(tmpdir, "broken.lst"), "w") as f: f.write("Broken\nmany points\n")
+         open(os.path.join(tmpdir, "notes.doc"), "w").close()
+         
+         filenames = ListArmyListFiles([tmpdir])
+         self.assertEqual([os.path.basename(fn) for fn in filenames], ["broken.lst", "ok.txt", "toomany.txt"])
+         report = ValidateArmyLists(DataManager([force]), filenames, "cok", processes=1)
+      finally: shutil.rmtree(tmpdir)
+      
+      broken, ok, toomany = report.results
+      self.assertEqual((ok["valid"], ok["pointsTotal"], ok["messages"]), (True, 200, []))
+      self.assertEqual((toomany["valid"], [m["type"] for m in toomany["messages"]]), (False, ["critical"]))
+      self.assertTrue(broken["error"].startswith("IOError"))
+      self.assertEqual((report.NumValid(), report.NumInvalid(), report.NumErrors()), (1, 1, 1))
+      
+      f = StringIO.StringIO()
+      report.WriteCsv(f)
+      self.assertEqual(len(f.getvalue().splitlines()), 4) # header, one row per file
+
+
+class ValidationRuleRegistryTestCase(unittest.TestCase):
+   """ Test rule sets, rule plugins and the timing of rules. """
+   def runTest(self):
+      import os, shutil, tempfile
+      from kowsim.kow import validation as val
+      
+      registry = val.ValidationRuleRegistry()
+      for rule in val.ALL_VALIDATIONRULES: registry.Register(rule, (val.RS_STANDARD, ))
+      self.assertRaises(ValueError, registry.Register, val.ALL_VALIDATIONRULES[0])
+      
+      tmpdir = tempfile.mkdtemp()
+      try:
+         with open(os.path.join(tmpdir, "maxunits.py"), "w") as f:
+            f.write("from kowsim.kow.validation import ValidationRule, ValidationMessage, DEP_UNITS\n"
+                    "class MaxUnitsRule(ValidationRule):\n"
+                    "   dependsOn = DEP_UNITS\n"
+                    "   perDetachment = True\n"
+                    "   def __init__(self): ValidationRule.__init__(self, 'MaxUnits')\n"
+                    "   def CheckDetachment(self, facts):\n"
+                    "      n = len(facts.detachment.ListUnits())\n"
+                    "      return [ValidationMessage(ValidationMessage.VM_CRITICAL, 'Too many units', '')] if n > 1 else []\n"
+                    "def RegisterRules(registry):\n"
+                    "   registry.Register(MaxUnitsRule())\n"
+                    "   registry.DefineSet('tournament', ['standard', 'MaxUnits'])\n")
+         with open(os.path.join(tmpdir, "broken.py"), "w") as f: f.write("RegisterRules = None\n")
+         with open(os.path.join(tmpdir, "partial.py"), "w") as f:
+            f.write("from kowsim.kow.validation import PointsLimitFulfilledRule\n"
+                    "class PartialRule(PointsLimitFulfilledRule):\n"
+                    "   def __init__(self): PointsLimitFulfilledRule.__init__(self); self._name = 'Partial'\n"
+                    "def RegisterRules(registry):\n"
+                    "   registry.Register(PartialRule(), ('partial', ))\n"
+                    "   registry.DefineSet('partial2', ['unknown'])\n")
+         self.assertEqual(registry.LoadPlugins(tmpdir), ["maxunits"])
+         self.assertEqual(registry.LoadPlugins(tmpdir), []) # loaded before, no rules registered twice
+      finally: shutil.rmtree(tmpdir)
+      self.assertRaises(KeyError, registry.Rule, "Partial") # nothing left of the failing plugin
+      
+      self.assertEqual(registry.ListSetNames(), ["standard", "tournament"])
+      self.assertEqual(registry.Rules("tournament")[:-1], val.ALL_VALIDATIONRULES)
+      rules = registry.Rules("tournament", disabled=("PointsLimitFulfilled", ))
+      self.assertEqual([r.Name() for r in rules], [r.Name() for r in val.ALL_VALIDATIONRULES[1:]] + ["MaxUnits"])
+      
+      regiment = UnitProfile("Guard", 5, 4, 0, 5, 10, 14, 16, 100, ut.UT_INF, st.ST_REG)
+      armylist = ArmyList("Test", 200)
+      det = Detachment(KowForceChoices("Test force", None, [regiment]), "Primary", isPrimary=True)
+      armylist.AddDetachment(det)
+      for i in range(2): det.AddUnit(regiment.CreateInstance(det))
+      validator = val.ArmyListValidator(armylist, rules, timings=registry.Timings())
+      self.assertEqual([m.ShortDesc() for m in validator.Check()], ["Too many units"])
+      
+      timings = registry.Timings()
+      self.assertEqual(sorted(timings.ListRuleNames()), sorted([r.Name() for r in rules]))
+      self.assertEqual(timings.Calls("MaxUnits"), 1)
+      self.assertEqual(timings.Calls("PointsLimitFulfilled"), 0)
+      self.assertTrue(0 <= timings.Percentile("MaxUnits", 50) <= timings.TotalTime("MaxUnits"))
+      self.assertEqual([row[0] for row in timings.Report()], timings.ListRuleNames())
+
+
+
+class MatchupCacheTestCase(unittest.TestCase):
+   """ Test if cached matchups are reused and those of edited profiles are dropped. """
+   def runTest(self):
+      import os, shutil, tempfile
+      from kowsim.kow.matchup import CombatProfile, ComputeMatchups, MatchupCache
+      
+      spears = CombatProfile(UnitProfile("Spears", 5, 4, 0, 4, 12, 14, 16, 100, ut.UT_INF, st.ST_REG))
+      giant = CombatProfile(UnitProfile("Giant", 7, 3, 0, 5, 18, 0, 19, 170, ut.UT_MON, st.ST_IND))
+      edited = CombatProfile(UnitProfile("Giant", 7, 3, 0, 5, 20, 0, 19, 170, ut.UT_MON, st.ST_IND))
+      tmpdir = tempfile.mkdtemp()
+      try:
+         filename = os.path.join(tmpdir, "matchups.cache")
+         matrix = ComputeMatchups([spears, giant], cache=MatchupCache(filename), processes=1)
+         cache = MatchupCache(filename)
+         self.assertEqual(len(cache), 4)
+         self.assertEqual(cache.Get((giant.Hash(), spears.Hash(), (False, True, None))), matrix.Get(1, 0))
+         
+         ComputeMatchups([spears, edited], cache=cache, processes=1)
+         cache = MatchupCache(filename)
+         self.assertEqual(len(cache), 4)
+         self.assertIsNone(cache.Get((giant.Hash(), spears.Hash(), (False, True, None))))
+      finally: shutil.rmtree(tmpdir)
+
+if __name__=='__main__':
+   unittest.main()
@@ -5,6 +5,8 @@ from PySide import QtGui, QtCore
 from PySide.QtCore import Qt
 
 from dice import RollHandler
+from rollevents import DefaultBus
+from rollservice import RollClient, ParseAddress
 from battlefield import BattlefieldView, RectBaseUnit
 from constants import *
 from load_data import DataManager
@@ -547,7 +549,7 @@ class ChatWidget(QtGui.QWidget):
    _TimestampCss = 'color:#999999;'
    _ErrorCss = 'color:#a0a0a0;font-weight:bold;font-style:italic;'
    
-   _SupportedCommands = ("r", "h")
+   _SupportedCommands = ("r", "o", "s", "h")
    
    def __init__(self):
       super(ChatWidget, self).__init__()
@@ -564,6 +566,14 @@ class ChatWidget(QtGui.QWidget):
       self.setLayout(lay)
       
       self.InitConnections()
+      DefaultBus().Subscribe(self.OnRollEvent)
+      
+      # roll with a shared roll service (e.g. KOWSIM_ROLLSERVICE=127.0.0.1:5050) instead of in-process
+      self.rollClient = None
+      if os.environ.get("KOWSIM_ROLLSERVICE"):
+         try: self.rollClient = RollClient(ParseAddress(os.environ["KOWSIM_ROLLSERVICE"]))
+         except IOError as e: # socket.error, service not running
+            self.PrintError("Roll service %s unavailable (%s), rolling locally." % (os.environ["KOWSIM_ROLLSERVICE"], e))
       
    def AddHistoryItem(self, text, mode="b"):
       self.chatHistory.append("<%s>%s</%s>" % (mode, text, mode))
@@ -576,6 +586,9 @@ class ChatWidget(QtGui.QWidget):
    def InitConnections(self):
       self.textField.returnPressed.connect(self.Submit)
       
+   def OnRollEvent(self, event):
+      self.AddHistoryItem(event.ToString())
+      
    def PrintError(self, text):
       self.chatHistory.append( "<span style=\"%s\">" % ChatWidget._ErrorCss + text + "</span>")
       
@@ -603,19 +616,40 @@ class ChatWidget(QtGui.QWidget):
             try:
                rollString = commandText[1:].strip()
                self.AddChatItem("<i>%s</i>" % text)
-               rollHndlr = RollHandler()
+               player = QtGui.qApp.GameManager.GetCurrentPlayer()
+               rollHndlr = RollHandler(stream=player.rng, source=player.name)
                rollHndlr.InterpretString(rollString)
-      
-               results = rollHndlr.Roll()
+               self.AddHistoryItem(rollHndlr.RollModeToString())
+               
+               # the results are added to the history by OnRollEvent
+               if self.rollClient is not None:
+                  self.rollClient.RollAndPublish(rollHndlr.commandString, session=player.name)
+               else: rollHndlr.Roll()
+            except (ValueError, IOError) as e: # IOError: roll service unavailable
+               self.PrintError(str(e))
                
-               #if rollHndlr.numDice < 10 and len(rollHndlr.individualRolls) <= 1:
-               self.AddHistoryItem(rollHndlr.RollModeToString() + " " + rollHndlr.AllResultsToString())
+         elif command == "o": # Odds
+            try:
+               rollString = commandText[1:].strip()
+               self.AddChatItem("<i>%s</i>" % text)
+               rollHndlr = RollHandler()
+               rollHndlr.InterpretString(rollString)
+               self.AddHistoryItem(rollHndlr.RollModeToString() + " " + rollHndlr.OddsToString())
             except ValueError as e:
                self.PrintError(str(e))
                
+         elif command == "s": # Statistics
+            self.AddChatItem("<i>%s</i>" % text)
+            stats = QtGui.qApp.GameManager.rollStatistics
+            for i in range(QtGui.qApp.GameManager.NumPlayers()):
+               name = QtGui.qApp.GameManager.GetPlayer(i).name
+               freqs = stats.FaceFrequencies(name)
+               self.AddHistoryItem("%s: %d successes, %.1f expected (luck %+.1f). D6 faces: %s" % (name, stats.Successes(name),
+                                   stats.ExpectedSuccesses(name), stats.Luck(name), ", ".join(["%.1f%%" % (100.*f) for f in freqs[1:]])))
+               
          elif command == "h": # Help
             helpText = """ <u>Help</u><br> You can use this box to chat with other players or for some functionality in support of the game.<br>
-             To send a chat message, simply type in any text.\n Supported commands:<br>   - /r Roll some (virtual) dice. """
+             To send a chat message, simply type in any text.\n Supported commands:<br>   - /r Roll some (virtual) dice.<br>   - /o Show the odds of a roll without rolling.<br>   - /s Show the dice statistics of all players. """
             self.AddHistoryItem("<i>%s</i>" % helpText)
 
 #===============================================================================
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# util/cache.py
+#===============================================================================
+from collections import OrderedDict
+
+
+#===============================================================================
+# LruCache
+#   Dictionary-like cache holding at most *maxSize* entries. When full, the
+#   least recently used entry is dropped.
+#===============================================================================
+class LruCache(object):
+   def __init__(self, maxSize=128):
+      self._maxSize = maxSize
+      self._entries = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+   def __contains__(self, key): return key in self._entries
+   def __len__(self): return len(self._entries)
+
+   def Clear(self):
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+   def Get(self, key, default=None):
+      """ Return the value cached for *key* (marking it as recently used) or *default*. """
+      try: value = self._entries.pop(key)
+      except KeyError:
+         self.misses += 1
+         return default
+      self._entries[key] = value
+      self.hits += 1
+      return value
+
+   def MaxSize(self): return self._maxSize
+
+   def Put(self, key, value):
+      if key in self._entries:
+         del self._entries[key]
+      elif len(self._entries) >= self._maxSize:
+         self._entries.popitem(last=False)
+      self._entries[key] = value
@@ -28,6 +28,8 @@ def dist2d(p1, p2):
 #   integer but should support the same operations.
 #===============================================================================
 class Size(object):
+   __slots__ = ("_w", "_h")
+   
    def __init__(self, *args):
       
       if len(args) == 2:
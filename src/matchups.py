@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# matchups.py
+#===============================================================================
+#   Compute expected damage, waver and rout odds of every unit profile in all
+#   force lists attacking every other one and write them to a CSV file.
+#   Usage: python matchups.py [options] <basedir>
+#===============================================================================
+import argparse
+import time
+
+def main():
+   parser = argparse.ArgumentParser(description="Compute the unit-vs-unit matchup matrix of all force lists.")
+   parser.add_argument("basedir", help="base directory containing data/kow/forces")
+   parser.add_argument("-o", "--output", default="matchups.csv", help="CSV file to write (default: %(default)s)")
+   parser.add_argument("-c", "--cache", default="matchups.cache", help="result cache file (default: %(default)s)")
+   parser.add_argument("--ranged", action="store_true", help="shooting instead of melee attacks")
+   parser.add_argument("--no-charge", action="store_true", help="melee attacks without charge bonuses")
+   parser.add_argument("--simulate", type=int, default=0, metavar="TRIALS", help="use Monte Carlo with TRIALS trials per matchup instead of exact odds")
+   parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes (default: one per CPU)")
+   args = parser.parse_args()
+
+   from kowsim.armybuilder.catalog import Catalog
+   from kowsim.kow.matchup import ProfilesFromForces, ComputeMatchups, MatchupCache
+
+   catalog = Catalog(args.basedir)
+   catalog.LoadForceChoices()
+   profiles = ProfilesFromForces(catalog.ListForceChoices())
+   cache = MatchupCache(args.cache)
+   numCached = len(cache)
+
+   start = time.time()
+   matrix = ComputeMatchups(profiles, args.ranged, not args.no_charge, cache, args.processes, args.simulate or None)
+   print "Computed %d matchups of %d profiles in %.1fs (%d new)." % (len(profiles)**2, len(profiles), time.time() - start,
+                                                                   len(cache) - numCached)
+
+   with open(args.output, "wb") as f:
+      matrix.WriteCsv(f)
+
+if __name__=='__main__':
+   main()
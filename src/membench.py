@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# membench.py
+#===============================================================================
+#   Memory benchmark for catalog and army list objects. Loads all forces and
+#   items plus a corpus of army lists (.lst files, or randomly generated lists)
+#   and reports the bytes per object of each class, both for the slotted
+#   layout in use and for the equivalent __dict__ based layout.
+#   Usage: python membench.py [--generate N] <basedir> [lists...]
+#===============================================================================
+import argparse
+import os
+import random
+import sys
+from collections import defaultdict
+
+class _DictBacked(object):
+   pass
+
+def _ShallowSize(obj):
+   """ Bytes of the object itself including its attribute storage, not counting the attribute values. """
+   size = sys.getsizeof(obj)
+   if hasattr(obj, "__dict__"): size += sys.getsizeof(obj.__dict__)
+   return size
+
+def _DictLayoutSize(obj):
+   """ Bytes the object would take with its attributes in a per-instance __dict__. """
+   if hasattr(obj, "__dict__"): return _ShallowSize(obj)
+   attrs = {}
+   for cls in type(obj).__mro__:
+      for slot in getattr(cls, "__slots__", ()):
+         if hasattr(obj, slot): attrs[slot] = getattr(obj, slot)
+   return sys.getsizeof(_DictBacked()) + sys.getsizeof(attrs)
+
+def GenerateLists(catalog, num, seed=0):
+   """ Generate *num* random army lists of 10-25 units with random options and items. """
+   from kowsim.kow.force import ArmyList, Detachment
+   from kowsim.kow.unit import UnitInstance
+
+   rnd = random.Random(seed)
+   forces = catalog.ListForceChoices()
+   items = catalog.ListItems()
+   lists = []
+   for i in range(num):
+      armylist = ArmyList("Generated list %d" % i, 2000)
+      det = Detachment(rnd.choice(forces))
+      armylist.AddDetachment(det)
+      for j in range(rnd.randint(10, 25)):
+         profile = rnd.choice(det.Choices().ListUnits())
+         options = [o for o in profile.ListOptions() if rnd.random() < 0.3]
+         item = rnd.choice(items) if profile.CanHaveItem() and rnd.random() < 0.3 else None
+         det.AddUnit(UnitInstance(profile, det, None, options, item))
+      lists.append(armylist)
+   return lists
+
+def CollectObjects(catalog, armylists):
+   objects = []
+   for fc in catalog.ListForceChoices():
+      for profile in fc.ListUnits():
+         objects.append(profile)
+         objects.append(profile._baseSize)
+         for opt in profile.ListOptions():
+            objects.append(opt)
+            objects.append(opt.EffectIndex())
+            objects.extend(opt._effects)
+   for item in catalog.ListItems():
+      objects.append(item)
+      objects.extend(item._effects)
+   for armylist in armylists:
+      for det in armylist.ListDetachments():
+         for unit in det.ListUnits():
+            objects.append(unit)
+            objects.append(unit.Resolved())
+   return objects
+
+def main():
+   parser = argparse.ArgumentParser(description="Report bytes per catalog and army list object.")
+   parser.add_argument("basedir", help="base directory containing data/kow")
+   parser.add_argument("lists", nargs="*", help=".lst files or directories containing them")
+   parser.add_argument("--generate", type=int, default=None, metavar="N", help="generate N random lists (default: 500 if no lists are given)")
+   args = parser.parse_args()
+
+   from kowsim.armybuilder.catalog import Catalog
+   from kowsim.kow.fileio import ArmyListReader
+
+   catalog = Catalog(args.basedir)
+   catalog.LoadForceChoices()
+   catalog.LoadItems()
+
+   filenames = []
+   for path in args.lists:
+      if os.path.isdir(path):
+         filenames.extend([os.path.join(path, fn) for fn in sorted(os.listdir(path)) if fn.endswith(".lst")])
+      else: filenames.append(path)
+   armylists = [ArmyListReader(catalog).LoadFromFile(fn)[0] for fn in filenames]
+   numGenerate = args.generate if args.generate is not None else (500 if len(filenames) == 0 else 0)
+   armylists.extend(GenerateLists(catalog, numGenerate))
+
+   count = defaultdict(int)
+   size = defaultdict(int)
+   dictSize = defaultdict(int)
+   seen = set()
+   for obj in CollectObjects(catalog, armylists):
+      if id(obj) in seen: continue
+      seen.add(id(obj))
+      name = type(obj).__name__
+      count[name] += 1
+      size[name] += _ShallowSize(obj)
+      dictSize[name] += _DictLayoutSize(obj)
+
+   print "%d forces, %d items, %d army lists" % (len(catalog.ListForceChoices()), len(catalog.ListItems()), len(armylists))
+   print "%-24s %8s %12s %12s %12s" % ("class", "objects", "dict B/obj", "slots B/obj", "total saved")
+   for name in sorted(count, key=lambda n: -count[n]):
+      n = count[name]
+      print "%-24s %8d %12.0f %12.0f %12d" % (name, n, dictSize[name] / float(n), size[name] / float(n), dictSize[name] - size[name])
+   print "total: %d bytes with __dict__, %d bytes with __slots__" % (sum(dictSize.values()), sum(size.values()))
+
+if __name__=='__main__':
+   main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# optimize.py
+#===============================================================================
+#   Search the best legal army lists of a force for a points limit and an
+#   objective and print them, optionally saving them as .lst files.
+#   Usage: python optimize.py [options] <basedir> <force> [allies...]
+#===============================================================================
+import argparse
+import os
+
+def main():
+   from kowsim.kow.optimizer import OBJECTIVES
+
+   parser = argparse.ArgumentParser(description="Find the best legal army lists of a force.")
+   parser.add_argument("basedir", help="base directory containing data/kow")
+   parser.add_argument("force", help="name of the primary force, e.g. Elves")
+   parser.add_argument("allies", nargs="*", help="names of forces for allied detachments")
+   parser.add_argument("-p", "--points", type=int, default=2000, help="points limit (default: %(default)s)")
+   parser.add_argument("-O", "--objective", choices=sorted(OBJECTIVES), default="attacks", help="value to maximize (default: %(default)s)")
+   parser.add_argument("-n", "--top", type=int, default=5, help="number of lists (default: %(default)s)")
+   parser.add_argument("-t", "--time", type=float, default=60., help="time budget in seconds (default: %(default)s)")
+   parser.add_argument("--cok", action="store_true", help="also apply the Clash of Kings tournament rules")
+   parser.add_argument("-o", "--output", default=None, metavar="DIR", help="save the lists as .lst files to DIR")
+   args = parser.parse_args()
+
+   from kowsim.armybuilder.catalog import Catalog
+   from kowsim.kow.fileio import ArmyListWriter
+   from kowsim.kow.optimizer import OptimizeArmy
+   from kowsim.kow.validation import ALL_VALIDATIONRULES, COK_ADDITIONALRULES
+
+   catalog = Catalog(args.basedir)
+   catalog.LoadForceChoices()
+   try:
+      primary = catalog.ForceChoicesByName(args.force.decode("utf-8"))
+      allies = [catalog.ForceChoicesByName(a.decode("utf-8")) for a in args.allies]
+   except KeyError as e:
+      parser.error("Unknown force %s, available: %s" % (e, ", ".join(sorted([fc.Name() for fc in catalog.ListForceChoices()]))))
+
+   rules = ALL_VALIDATIONRULES + COK_ADDITIONALRULES if args.cok else ALL_VALIDATIONRULES
+   try: result = OptimizeArmy(primary, args.points, OBJECTIVES[args.objective], allies, rules, args.top, args.time)
+   except ValueError as e: parser.error(str(e))
+
+   print "%d lists, %s after %d nodes in %.1fs." % (len(result.lists), "optimal" if result.complete else "time budget exceeded",
+                                                    result.numNodes, result.elapsed)
+   for rank, (value, armylist) in enumerate(result.lists):
+      print
+      print "#%d: %s %s, %d points" % (rank + 1, value, args.objective, armylist.PointsTotal())
+      for det in armylist.ListDetachments():
+         for unit in det.ListUnits():
+            print "   %-20s %-40s %-10s %4d" % (det.Choices().Name(), unit.DisplayName(), unit.SizeType().Name(), unit.PointsCost())
+      if args.output is not None:
+         if not os.path.isdir(args.output): os.makedirs(args.output)
+         ArmyListWriter(armylist).SaveToFile(os.path.join(args.output, "optimized%d.lst" % (rank + 1)))
+
+if __name__=='__main__':
+   main()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+# rollservice.py
+#===============================================================================
+#   Run the shared dice service, or benchmark it with many concurrent sessions.
+#   Usage: python rollservice.py serve [--address 127.0.0.1:5050] [--seed N]
+#          python rollservice.py benchmark [--sessions 50] [--rolls 200]
+#   Clients (kowsim) use the service if KOWSIM_ROLLSERVICE is set to its address.
+#===============================================================================
+import argparse
+
+def main():
+   parser = argparse.ArgumentParser(description="Shared dice service for kowsim clients.")
+   parser.add_argument("mode", choices=("serve", "benchmark"))
+   parser.add_argument("-a", "--address", default=None, help="host:port or Unix socket path (serve default: 127.0.0.1:5050, benchmark default: a local service)")
+   parser.add_argument("--seed", type=int, default=None, help="master seed of the service")
+   parser.add_argument("--sessions", type=int, default=50, help="concurrent sessions for the benchmark")
+   parser.add_argument("--rolls", type=int, default=200, help="rolls per session for the benchmark")
+   parser.add_argument("--command", default="20 4+ 4+r", help="roll command for the benchmark")
+   args = parser.parse_args()
+
+   from kowsim.rollservice import RollService, ParseAddress, Benchmark
+
+   if args.mode == "serve":
+      service = RollService(ParseAddress(args.address or "127.0.0.1:5050"), args.seed)
+      print "Roll service listening on %s (seed %d)." % (service.address, service.rng.Seed())
+      try: service.ServeForever()
+      except KeyboardInterrupt:
+         service.Shutdown()
+   else:
+      address = ParseAddress(args.address) if args.address else None
+      rate, avgBatch = Benchmark(args.sessions, args.rolls, args.command, address=address)
+      print "%d sessions x %d rolls of '%s': %.0f rolls/s" % (args.sessions, args.rolls, args.command, rate),
+      print "(average batch size %.1f)" % avgBatch if address is None else ""
+
+if __name__=='__main__':
+   main()
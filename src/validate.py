@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# validate.py
+#===============================================================================
+#   Validate army list files (as saved by the army builder) without opening
+#   them in the GUI and write a JSON or CSV report of all messages.
+#   Usage: python validate.py [options] <basedir> <files or directories...>
+#===============================================================================
+import argparse
+import sys
+
+def main():
+   parser = argparse.ArgumentParser(description="Validate army list files and report the messages of each.")
+   parser.add_argument("basedir", help="base directory containing data/kow")
+   parser.add_argument("lists", nargs="*", help="army list files (.txt, .lst) or directories containing them")
+   parser.add_argument("-r", "--rules", default="standard", metavar="SET", help="validation rule set (default: %(default)s)")
+   parser.add_argument("--cok", action="store_true", help="use the Clash of Kings tournament rules, same as --rules cok")
+   parser.add_argument("-d", "--disable", action="append", default=[], metavar="RULE", help="don't apply the rule RULE (repeatable)")
+   parser.add_argument("--list-rules", action="store_true", help="list the rule sets and rules, including those of plugins, and exit")
+   parser.add_argument("--timings", action="store_true", help="print the evaluation time of each rule")
+   parser.add_argument("-f", "--format", choices=("json", "csv"), default="json", help="report format (default: %(default)s)")
+   parser.add_argument("-o", "--output", default=None, help="report file to write (default: standard output)")
+   parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes (default: one per CPU)")
+   args = parser.parse_args()
+
+   from kowsim.armybuilder.batchvalidation import ListArmyListFiles, LoadCatalog, ValidateArmyLists
+   from kowsim.kow.validation import DefaultRegistry
+
+   stdout, sys.stdout = sys.stdout, sys.stderr # keep the parser warnings out of the report
+   try: catalog = LoadCatalog(args.basedir)
+   finally: sys.stdout = stdout
+
+   registry = DefaultRegistry()
+   if args.list_rules:
+      for name in registry.ListSetNames():
+         print "%s: %s" % (name, ", ".join([r.Name() for r in registry.Rules(name)]))
+      return
+   ruleSet = "cok" if args.cok else args.rules
+   if ruleSet not in registry.ListSetNames(): parser.error("Unknown rule set %s, available: %s" % (ruleSet, ", ".join(registry.ListSetNames())))
+   for name in args.disable:
+      try: registry.Rule(name)
+      except KeyError: parser.error("Unknown rule %s, see --list-rules" % name)
+
+   filenames = ListArmyListFiles(args.lists)
+   if len(filenames) == 0: parser.error("No army list files found.")
+   report = ValidateArmyLists(catalog, filenames, ruleSet, args.disable, args.processes)
+
+   f = open(args.output, "wb") if args.output is not None else sys.stdout
+   try:
+      if args.format == "csv": report.WriteCsv(f)
+      else: report.WriteJson(f)
+   finally:
+      if f is not sys.stdout: f.close()
+
+   sys.stderr.write("Validated %d files in %.1fs: %d valid, %d invalid, %d unreadable.\n" % (len(filenames), report.elapsed,
+                    report.NumValid(), report.NumInvalid(), report.NumErrors()))
+   if args.timings:
+      sys.stderr.write("%-32s %8s %10s %10s %10s %10s\n" % ("Rule", "Calls", "Total ms", "Mean us", "Median us", "95% us"))
+      for name, calls, total, mean, median, p95 in report.RuleTimings().Report():
+         sys.stderr.write("%-32s %8d %10.1f %10.1f %10.1f %10.1f\n" % (name, calls, total * 1e3, mean * 1e6, median * 1e6, p95 * 1e6))
+   sys.exit(0 if report.NumValid() == len(filenames) else 1)
+
+if __name__=='__main__':
+   main()